@@ -1,11 +1,15 @@
 from flask import Blueprint, jsonify, request
-from sqlalchemy import select
-from models import User, user_schema
+from models import UserSchema, user_schema, pooled_schema
 from config import db, jwt
+import queries
+from group_commit import commit_session
+from sharding import route
 from marshmallow import ValidationError
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
-from flask_jwt_extended import create_access_token
+from flask_jwt_extended import current_user, get_jwt, jwt_required
 from werkzeug.security import check_password_hash
+from tokens import family_of, get_token_families, issue_tokens
+from tokens import revoke_family
 
 
 auth_bp = Blueprint('authorization', __name__, url_prefix='/api/auth')
@@ -19,20 +23,22 @@ def user_identity_lookup(user):
 @jwt.user_lookup_loader
 def user_lookup_callback(_jwt_header, jwt_data):
     identity = jwt_data['sub']
-    return db.session.query(User).filter_by(id=int(identity)).one_or_none()
+    route(db.session, int(identity))
+    return db.session.execute(queries.USER_BY_ID, {
+        "user_id": int(identity)}).scalar_one_or_none()
 
 
 @auth_bp.route('/register', methods=['POST'])
 def register_user():
     try:
-        new_user = user_schema.load(request.get_json())
+        new_user = pooled_schema(UserSchema).load(request.get_json())
     except ValidationError as err:
         return jsonify({"error": "Invalid or missing data",
                         "details": err.messages,
                         "status": 400}), 400
     try:
         db.session.add(new_user)
-        db.session.commit()
+        commit_session()
         return jsonify(user_schema.dump(new_user)), 201
     except IntegrityError as err:
         db.session.rollback()
@@ -49,8 +55,8 @@ def register_user():
 
 @auth_bp.route('/login', methods=['POST'])
 def login():
-    query = select(User).where(User.username == request.get_json()['username'])
-    user = db.session.execute(query).scalar_one_or_none()
+    user = db.session.execute(queries.USER_BY_USERNAME, {
+        "username": request.get_json()['username']}).scalar_one_or_none()
     if not user:
         return jsonify({"error": "Username not found",
                         "status": 404}), 404
@@ -59,6 +65,28 @@ def login():
     if not password_match:
         return jsonify({"error": "Invalid password",
                         "status": 400}), 400
-    access_token = create_access_token(identity=user)
     return jsonify(user=user_schema.dump(user)['username'],
-                   access_token=access_token), 200
+                   **issue_tokens(user)), 200
+
+
+@auth_bp.route('/refresh', methods=['POST'])
+@jwt_required(refresh=True)
+def refresh():
+    # Rotation: the presented refresh token is spent and a new pair from
+    # the same family replaces it, without checking the password again
+    payload = get_jwt()
+    if not get_token_families().rotate(payload):
+        # Another request spent this token first
+        revoke_family(payload)
+        return jsonify({"error": "Refresh token was already used",
+                        "status": 401}), 401
+    return jsonify(user=current_user.username,
+                   **issue_tokens(current_user, family_of(payload),
+                                  payload.get('gen', 0) + 1)), 200
+
+
+@auth_bp.route('/logout', methods=['POST'])
+@jwt_required(verify_type=False)
+def logout():
+    revoke_family(get_jwt())
+    return jsonify({"message": "Successfully logged out"}), 200
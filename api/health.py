@@ -0,0 +1,124 @@
+import os
+import time
+from functools import wraps
+from flask import Blueprint, current_app, jsonify, request
+from flask_jwt_extended import current_user, jwt_required
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from config import db
+from profiler import get_profiler
+
+
+health_bp = Blueprint('health', __name__, url_prefix='/api/health')
+
+started_at = time.time()
+# Shorter intervals would have the sampler thread hold the GIL most of the
+# time and slow the worker down for everyone
+MIN_INTERVAL = 0.001
+
+
+def reset_started_at():
+    global started_at
+    started_at = time.time()
+
+
+# Preloaded in the supervisor; each forked worker counts from its own start
+os.register_at_fork(after_in_child=reset_started_at)
+
+
+@health_bp.route('/', methods=['GET'])
+def get_health():
+    try:
+        db.session.execute(text('SELECT 1'))
+    except SQLAlchemyError as err:
+        return jsonify({"status": "unavailable",
+                        "details": str(err),
+                        "pid": os.getpid()}), 503
+    return jsonify({"status": "ok",
+                    "pid": os.getpid(),
+                    "uptime": round(time.time() - started_at, 1)}), 200
+
+
+@health_bp.route('/queries', methods=['GET'])
+def get_query_cache_stats():
+    stats = current_app.extensions.get('query_cache_stats')
+    if stats is None:
+        return jsonify({"error": "Query cache statistics are disabled",
+                        "status": 404}), 404
+    return jsonify(stats.report()), 200
+
+
+def profiler_disabled():
+    return jsonify({"error": "Profiler is disabled",
+                    "status": 404}), 404
+
+
+def profiler_admin_required(view):
+    # Anyone can register, so being logged in is not enough to read stack
+    # samples or change the sampling rate
+    @wraps(view)
+    @jwt_required()
+    def wrapper(*args, **kwargs):
+        if current_user.id not in current_app.config['PROFILER_ADMINS']:
+            return jsonify({"error": "Profiler access is limited to admins",
+                            "status": 403}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@health_bp.route('/profile', methods=['GET'])
+@profiler_admin_required
+def get_profile_summary():
+    profiler = get_profiler()
+    if profiler is None:
+        return profiler_disabled()
+    return jsonify(profiler.summary()), 200
+
+
+@health_bp.route('/profile', methods=['POST'])
+@profiler_admin_required
+def update_profiler():
+    profiler = get_profiler()
+    if profiler is None:
+        return profiler_disabled()
+    data = request.get_json()
+    interval = data.get('interval')
+    if interval is not None and not (isinstance(interval, (int, float)) and
+                                     MIN_INTERVAL <= interval <= 1):
+        return jsonify({"error": "Invalid data",
+                        "details": {"interval": ["Must be a number of "
+                                                 "seconds in [0.001, 1]."]},
+                        "status": 400}), 400
+    if data.get('reset'):
+        profiler.reset()
+    if data.get('sampling') is True:
+        profiler.start(interval)
+    elif data.get('sampling') is False:
+        profiler.stop()
+    elif interval is not None:
+        profiler.interval = interval
+    # Each prefork worker has its own profiler and this request reached one
+    summary = profiler.summary()
+    summary['message'] = (f"Applied to worker {summary['pid']} only; other "
+                          "workers keep their own profiler settings")
+    return jsonify(summary), 200
+
+
+@health_bp.route('/profile/collapsed', methods=['GET'])
+@profiler_admin_required
+def get_profile_collapsed():
+    profiler = get_profiler()
+    if profiler is None:
+        return profiler_disabled()
+    return current_app.response_class(
+        profiler.collapsed(request.args.get('endpoint')),
+        mimetype='text/plain'), 200
+
+
+@health_bp.route('/profile/speedscope', methods=['GET'])
+@profiler_admin_required
+def get_profile_speedscope():
+    profiler = get_profiler()
+    if profiler is None:
+        return profiler_disabled()
+    return jsonify(profiler.speedscope(request.args.get('endpoint'))), 200
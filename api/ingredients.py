@@ -1,9 +1,17 @@
 from models import Ingredient, ingredient_schema, ingredients_schema
+from models import IngredientSchema, pooled_schema
+from models import recipes_schema
 from flask import Blueprint, jsonify, request
-from sqlalchemy import select
 from config import db
+import queries
+from group_commit import commit_session
 from marshmallow import ValidationError
 from sqlalchemy.exc import SQLAlchemyError
+from autocomplete import get_index
+from formats import render_list
+from catalog import get_snapshot
+from idempotency import idempotent
+from softdelete import soft_delete
 
 
 ingredients_bp = Blueprint('ingredients', __name__,
@@ -12,23 +20,36 @@ ingredients_bp = Blueprint('ingredients', __name__,
 
 @ingredients_bp.route('/', methods=['GET'])
 def get_ingredients():
-    query = select(Ingredient)
-    results = db.session.execute(query)
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return render_list(snapshot.ingredients()), 200
+    results = db.session.execute(queries.ALL_INGREDIENTS)
     ingredients = results.scalars().all()
-    return jsonify(ingredients_schema.dump(ingredients)), 200
+    return render_list(ingredients_schema.dump(ingredients)), 200
+
+
+@ingredients_bp.route('/suggest', methods=['GET'])
+def suggest_ingredients():
+    prefix = request.args.get('prefix', '')
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    category = request.args.get('category')
+    suggestions = get_index(db.session).suggest(prefix, limit, category)
+    return jsonify(suggestions), 200
 
 
 @ingredients_bp.route('/', methods=['POST'])
+@idempotent
 def create_ingredient():
     try:
-        ingredient = ingredient_schema.load(request.get_json())
+        ingredient = pooled_schema(IngredientSchema).load(
+            request.get_json())
     except ValidationError as err:
         return jsonify({"error": "Invalid data",
                         "details": err.messages,
                         "status": 400}), 400
     try:
         db.session.add(ingredient)
-        db.session.commit()
+        commit_session()
         return jsonify(ingredient_schema.dump(ingredient)), 201
     except SQLAlchemyError as err:
         db.session.rollback()
@@ -44,14 +65,15 @@ def update_ingredient(ingredient_id):
         return jsonify({"error": "Ingredient not found",
                         "status": 404}), 404
     try:
-        ingredient_schema.load(request.get_json(),
-                               instance=ingredient_to_update, partial=True)
+        pooled_schema(IngredientSchema).load(request.get_json(),
+                                             instance=ingredient_to_update,
+                                             partial=True)
     except ValidationError as err:
         return jsonify({"error": "Invalid data",
                         "details": err.messages,
                         "status": 400}), 400
     try:
-        db.session.commit()
+        commit_session()
         return jsonify(ingredient_schema.dump(ingredient_to_update)), 200
     except SQLAlchemyError as err:
         db.session.rollback()
@@ -70,6 +92,18 @@ def get_ingredient_by_id(ingredient_id):
     return jsonify(ingredient_schema.dump(ingredient)), 200
 
 
+@ingredients_bp.route('/<int:ingredient_id>/recipes', methods=['GET'])
+def get_recipes_by_ingredient(ingredient_id):
+    ingredient = db.session.get(Ingredient, ingredient_id)
+    if not ingredient:
+        return jsonify({"error": f"Ingredient with id:{ingredient_id} "
+                        "not found",
+                        "status": 404}), 404
+    recipes = db.session.execute(queries.RECIPES_WITH_INGREDIENT, {
+        "ingredient_id": ingredient_id}).scalars().all()
+    return jsonify(recipes_schema.dump(recipes)), 200
+
+
 @ingredients_bp.route('/<int:ingredient_id>', methods=['DELETE'])
 def delete_ingredient(ingredient_id):
     ingredient_to_delete = db.session.get(Ingredient, ingredient_id)
@@ -77,8 +111,8 @@ def delete_ingredient(ingredient_id):
         return jsonify({"error": f"Ingredient id {ingredient_id} not found",
                         "status": 404}), 404
     try:
-        db.session.delete(ingredient_to_delete)
-        db.session.commit()
+        soft_delete(ingredient_to_delete)
+        commit_session()
         return jsonify({"message": "Ingredient successfully deleted"}), 200
     except SQLAlchemyError as err:
         db.session.rollback()
@@ -2,11 +2,22 @@ from models import Recipe, recipe_schema, recipes_schema
 from models import Ingredient
 from models import RecipeIngredient, recipe_ingredient_schema, \
                    recipe_ingredients_schema
-from sqlalchemy import select
-from flask import Blueprint, jsonify, request
+from models import RecipeSchema, RecipeIngredientSchema, pooled_schema
+from datetime import datetime
+from flask import Blueprint, current_app, jsonify, request
 from config import db
+import queries
+from group_commit import commit_session
 from marshmallow import ValidationError
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from similarity import get_index
+import dedup
+import revisions
+from idempotency import idempotent
+from softdelete import soft_delete
+from stats import get_recorder, parse_window, trending
+from formats import render_list
+from catalog import get_snapshot
 
 
 recipes_bp = Blueprint('recipes', __name__, url_prefix='/api/recipes')
@@ -14,22 +25,104 @@ recipes_bp = Blueprint('recipes', __name__, url_prefix='/api/recipes')
 
 @recipes_bp.route('/', methods=['GET'])
 def get_recipes():
-    query = select(Recipe)
-    result = db.session.execute(query)
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return render_list(snapshot.recipes()), 200
+    result = db.session.execute(queries.ALL_RECIPES)
     recipes = result.scalars().all()
-    return jsonify(recipes_schema.dump(recipes)), 200
+    return render_list(recipes_schema.dump(recipes)), 200
 
 
 @recipes_bp.route('/<int:recipe_id>', methods=['GET'])
 def get_recipe_by_id(recipe_id):
-    recipe = db.session.get(Recipe, recipe_id)
-    if recipe:
+    as_of = request.args.get('as_of')
+    if as_of is not None:
+        try:
+            as_of = datetime.fromisoformat(as_of)
+        except ValueError:
+            return jsonify({"error": "as_of must be an ISO 8601 timestamp",
+                            "status": 400}), 400
+    snapshot = get_snapshot() if as_of is None else None
+    if snapshot is not None:
+        # Recipes created since the snapshot was built are looked up below
+        data = snapshot.recipe_by_id(recipe_id)
+        if data is not None:
+            get_recorder().record_view(recipe_id)
+            return jsonify(data), 200
+    recipe = db.session.execute(queries.RECIPE_WITH_CHILDREN, {
+        "recipe_id": recipe_id}).scalar_one_or_none()
+    if not recipe:
+        return jsonify({"error": "Recipe not found", "status": 404}), 404
+    get_recorder().record_view(recipe_id)
+    if as_of is None:
         return jsonify(recipe_schema.dump(recipe)), 200
-    else:
+    past, revision = revisions.recipe_as_of(db.session, recipe, as_of)
+    if past is None:
+        return jsonify({"error": "Recipe has no revision at that time",
+                        "status": 404}), 404
+    data = recipe_schema.dump(past)
+    data['revision'] = revision
+    return jsonify(data), 200
+
+
+@recipes_bp.route('/<int:recipe_id>/revisions', methods=['GET'])
+def get_recipe_revisions(recipe_id):
+    if not db.session.get(Recipe, recipe_id):
+        return jsonify({"error": "Recipe not found", "status": 404}), 404
+    return jsonify(revisions.revision_history(db.session, recipe_id)), 200
+
+
+@recipes_bp.route('/trending', methods=['GET'])
+def get_trending_recipes():
+    window = parse_window(request.args.get('window', '7d'))
+    if not window:
+        return jsonify({"error": "window must look like 24h or 7d and be "
+                        "between 1h and 90d",
+                        "status": 400}), 400
+    limit = min(request.args.get('limit', 10, type=int), 100)
+    # Views reach the table with the recorder's next flush
+    return jsonify(trending(db.session, window, limit)), 200
+
+
+@recipes_bp.route('/<int:recipe_id>/similar', methods=['GET'])
+def get_similar_recipes(recipe_id):
+    recipe = db.session.get(Recipe, recipe_id)
+    if not recipe:
         return jsonify({"error": "Recipe not found", "status": 404}), 404
+    limit = request.args.get('limit', 10, type=int)
+    ranked = get_index(db.session).similar(recipe_id, limit)
+    return jsonify(ranked_recipes(ranked)), 200
+
+
+@recipes_bp.route('/<int:recipe_id>/duplicates', methods=['GET'])
+def get_duplicate_recipes(recipe_id):
+    recipe = db.session.get(Recipe, recipe_id)
+    if not recipe:
+        return jsonify({"error": "Recipe not found", "status": 404}), 404
+    threshold = request.args.get('threshold',
+                                 current_app.config['DEDUP_THRESHOLD'],
+                                 type=float)
+    if not 0 < threshold <= 1:
+        return jsonify({"error": "threshold must be between 0 and 1",
+                        "status": 400}), 400
+    limit = min(request.args.get('limit', 10, type=int), 100)
+    ranked = dedup.get_index(db.session).duplicates(recipe_id, threshold,
+                                                    limit)
+    return jsonify(ranked_recipes(ranked)), 200
+
+
+def ranked_recipes(ranked):
+    if not ranked:
+        return []
+    names = dict(db.session.execute(queries.RECIPE_NAMES, {
+        "recipe_ids": [recipe_id for recipe_id, _ in ranked]}).all())
+    return [{"id": recipe_id, "name": names[recipe_id],
+             "score": round(score, 4)}
+            for recipe_id, score in ranked if recipe_id in names]
 
 
 @recipes_bp.route('/', methods=['POST'])
+@idempotent
 def add_recipe():
     try:
         raw_recipe = request.get_json()
@@ -37,14 +130,27 @@ def add_recipe():
                           'servings']
         filtered_recipe = {k: v for k, v in raw_recipe.items()
                            if k in allowed_fields}
-        recipe = recipe_schema.load(filtered_recipe)
+        recipe = pooled_schema(RecipeSchema).load(filtered_recipe)
     except ValidationError as err:
         return jsonify({"error": "Invalid data", "details": err.messages,
                         "status": 400}), 400
 
+    if request.args.get('dedup') in ('1', 'true'):
+        # Importers opt in to being refused near-copies of existing
+        # recipes; ingredients are added later, so this compares name and
+        # instructions against the same of the stored recipes
+        values = dedup.signature(dedup.text_features(recipe.name,
+                                                     recipe.instructions))
+        ranked = dedup.get_index(db.session).find_text(
+            values, current_app.config['DEDUP_THRESHOLD'])
+        if ranked:
+            return jsonify({"error": "Recipe looks like a duplicate",
+                            "duplicates": ranked_recipes(ranked),
+                            "status": 409}), 409
+
     try:
         db.session.add(recipe)
-        db.session.commit()
+        commit_session()
         return jsonify(recipe_schema.dump(recipe)), 201
     except IntegrityError as err:
         db.session.rollback()
@@ -68,14 +174,15 @@ def update_recipe(recipe_id):
                        "status": 404}), 404
 
     try:
-        recipe_schema.load(request.get_json(), instance=recipe_to_update,
-                           partial=True)
+        pooled_schema(RecipeSchema).load(request.get_json(),
+                                         instance=recipe_to_update,
+                                         partial=True)
     except ValidationError as err:
         return jsonify({"error": "Invalid data",
                         "details": err.messages, "status": 400}), 400
 
     try:
-        db.session.commit()
+        commit_session()
         return jsonify(recipe_schema.dump(recipe_to_update)), 200
     except IntegrityError as err:
         db.session.rollback()
@@ -96,8 +203,8 @@ def delete_recipe(recipe_id):
         return jsonify({"error": f"Recipe with id {recipe_id} not found",
                        "status": 404}), 404
     try:
-        db.session.delete(recipe_to_delete)
-        db.session.commit()
+        soft_delete(recipe_to_delete)
+        commit_session()
         return jsonify({"message": "Recipe successfully deleted"}), 200
     except SQLAlchemyError as err:
         db.session.rollback()
@@ -117,6 +224,7 @@ def get_ingredients_by_recipe(recipe_id):
 
 
 @recipes_bp.route('/<int:recipe_id>/ingredients', methods=['POST'])
+@idempotent
 def add_ingredient_to_recipe(recipe_id):
     recipe = db.session.get(Recipe, recipe_id)
     if not recipe:
@@ -129,21 +237,21 @@ def add_ingredient_to_recipe(recipe_id):
         return jsonify({"error": "Ingredient id "
                         f"{data['ingredient_id']} not found",
                         "status": 404}), 404
-    existing = db.session.query(RecipeIngredient).filter_by(
-               recipe_id=recipe_id,
-               ingredient_id=data['ingredient_id']).first()
-    if existing:
+    if db.session.execute(queries.RECIPE_INGREDIENT_EXISTS, {
+            "recipe_id": recipe_id,
+            "ingredient_id": data['ingredient_id']}).scalar():
         return jsonify({"error": f"Recipe id {recipe_id} already contains "
                         "this ingredient",
                         "status": 409}), 409
     try:
-        recipe_ingredient = recipe_ingredient_schema.load(data)
+        recipe_ingredient = pooled_schema(RecipeIngredientSchema,
+                                          transient=True).load(data)
     except ValidationError as err:
         return jsonify({"error": "Invalid data", "details": err.messages,
                         "status": 400}), 400
     try:
         db.session.add(recipe_ingredient)
-        db.session.commit()
+        commit_session()
         return jsonify(recipe_ingredient_schema.dump(recipe_ingredient)), 201
     except IntegrityError as err:
         db.session.rollback()
@@ -180,7 +288,7 @@ def remove_recipe_ingredient(recipe_id, ingredient_id):
                         "status": 404}), 404
     try:
         db.session.delete(recipe_ingredient)
-        db.session.commit()
+        commit_session()
         return jsonify({"message": f"Ingredient id {ingredient_id} "
                         f"successfully deleted from recipe id {recipe_id}",
                         "status": 200}), 200
@@ -204,15 +312,15 @@ def update_recipe_ingredient(recipe_id, ingredient_id):
     allowed_fields = ['unit', 'notes', 'quantity']
     filtered_data = {k: v for k, v in data.items() if k in allowed_fields}
     try:
-        recipe_ingredient_schema.load(filtered_data,
-                                      instance=recipe_ingredient,
-                                      partial=True)
+        pooled_schema(RecipeIngredientSchema).load(filtered_data,
+                                                   instance=recipe_ingredient,
+                                                   partial=True)
     except ValidationError as err:
         return jsonify({"error": "Invalid data",
                         "details": err.messages,
                         "status": 400}), 400
     try:
-        db.session.commit()
+        commit_session()
         return jsonify(recipe_ingredient_schema.dump(recipe_ingredient)), 200
     except SQLAlchemyError as err:
         db.session.rollback()
@@ -222,6 +330,7 @@ def update_recipe_ingredient(recipe_id, ingredient_id):
 
 
 @recipes_bp.route('/<int:recipe_id>/ingredients/bulk', methods=['POST'])
+@idempotent
 def add_multiple_ingredients_to_recipe(recipe_id):
     recipe = db.session.get(Recipe, recipe_id)
     if not recipe:
@@ -240,7 +349,8 @@ def add_multiple_ingredients_to_recipe(recipe_id):
                             "status": 404}), 404
         datum['recipe_id'] = recipe_id
         try:
-            ri = recipe_ingredient_schema.load(datum)
+            ri = pooled_schema(RecipeIngredientSchema,
+                               transient=True).load(datum)
         except ValidationError as err:
             return jsonify({"error": "Invalid data",
                             "details": err.messages,
@@ -248,7 +358,7 @@ def add_multiple_ingredients_to_recipe(recipe_id):
         db.session.add(ri)
         recipe_ingredients.append(ri)
     try:
-        db.session.commit()
+        commit_session()
         return jsonify(recipe_ingredients_schema.dump(recipe_ingredients)), 201
     except SQLAlchemyError as err:
         db.session.rollback()
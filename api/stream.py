@@ -0,0 +1,50 @@
+import json
+import queue
+from flask import Blueprint, Response, jsonify, request
+from flask_jwt_extended import verify_jwt_in_request, current_user
+from pubsub import get_broker
+
+
+stream_bp = Blueprint('stream', __name__, url_prefix='/api/stream')
+
+HEARTBEAT_SECONDS = 15
+
+
+def event_stream(subscription):
+    try:
+        yield ": connected\n\n"
+        while not subscription.dropped:
+            try:
+                message = subscription.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+                continue
+            yield f"event: change\ndata: {json.dumps(message)}\n\n"
+        # Events were lost; the client should resync and reconnect
+        yield "event: dropped\ndata: {}\n\n"
+    finally:
+        subscription.close()
+
+
+@stream_bp.route('/', methods=['GET'])
+def stream_changes():
+    topics = []
+    recipe_ids = request.args.get('recipes', '')
+    try:
+        topics += [f"recipe:{int(recipe_id)}"
+                   for recipe_id in recipe_ids.split(',') if recipe_id]
+    except ValueError:
+        return jsonify({"error": "recipes must be a comma separated list of "
+                        "ids",
+                        "status": 400}), 400
+    verify_jwt_in_request(optional=True)
+    if current_user:
+        topics.append(f"user:{current_user.id}")
+    if not topics:
+        return jsonify({"error": "Nothing to subscribe to",
+                        "status": 400}), 400
+    subscription = get_broker().subscribe(topics)
+    return Response(event_stream(subscription),
+                    mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache",
+                             "X-Accel-Buffering": "no"})
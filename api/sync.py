@@ -0,0 +1,20 @@
+from flask import Blueprint, jsonify, request
+from flask_jwt_extended import verify_jwt_in_request, current_user
+from config import db
+from changes import changes_since, parse_token
+
+
+sync_bp = Blueprint('sync', __name__, url_prefix='/api/sync')
+
+
+@sync_bp.route('/', methods=['GET'])
+def get_changes():
+    try:
+        since = parse_token(request.args.get('since', '0'))
+    except ValueError:
+        return jsonify({"error": "Invalid sync token",
+                        "status": 400}), 400
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
+    verify_jwt_in_request(optional=True)
+    user_id = current_user.id if current_user else None
+    return jsonify(changes_since(db.session, since, user_id, limit)), 200
@@ -1,10 +1,19 @@
 from flask import Blueprint, jsonify, request
 from models import User, user_schema, user_recipes_schema, user_recipe_schema
-from models import Recipe, UserRecipe
+from models import UserRecipeSchema, PantrySchema, pooled_schema
+from models import Recipe, UserRecipe, recipes_schema
+from models import Ingredient, Pantry, pantry_item_schema, pantry_items_schema
+from models import UserStats
 from config import db
+import queries
+from group_commit import commit_session
 from marshmallow import ValidationError
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from flask_jwt_extended import jwt_required, current_user
+from similarity import get_index
+from api.recipes import ranked_recipes
+from mealplan import generate_meal_plan, mealplan_request_schema
+from idempotency import idempotent
 
 
 users_bp = Blueprint('users', __name__, url_prefix='/api/users')
@@ -16,8 +25,60 @@ def get_user_recipes():
     return jsonify(user_recipes_schema.dump(current_user.collected_recipes)), 200
 
 
+@users_bp.route('/recommendations', methods=['GET'])
+@jwt_required()
+def get_user_recommendations():
+    limit = request.args.get('limit', 10, type=int)
+    collected = [ur.recipe_id for ur in current_user.collected_recipes]
+    ranked = get_index(db.session).recommend(collected, limit)
+    return jsonify(ranked_recipes(ranked)), 200
+
+
+@users_bp.route('/mealplans/generate', methods=['POST'])
+@jwt_required()
+def generate_user_mealplan():
+    try:
+        options = mealplan_request_schema.load(request.get_json())
+    except ValidationError as err:
+        return jsonify({"error": "Invalid data",
+                        "details": err.messages,
+                        "status": 400}), 400
+    plan = generate_meal_plan(db.session, current_user.id, options)
+    if not plan:
+        return jsonify({"error": "Not enough recipes match the meal plan "
+                        "constraints",
+                        "status": 422}), 422
+    return jsonify(plan), 200
+
+
+@users_bp.route('/recipes/summary', methods=['GET'])
+@jwt_required()
+def get_user_recipes_summary():
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 200)
+    recipes = [{"recipe_id": row.recipe_id,
+                "name": row.name,
+                "servings": row.servings,
+                "ingredient_count": row.ingredient_count,
+                "total_time": row.total_time,
+                "user_notes": row.user_notes,
+                "collected_at": row.collected_at.isoformat()}
+               for row in db.session.execute(queries.USER_COLLECTION_PAGE, {
+                   "user_id": current_user.id, "limit": per_page,
+                   "offset": (page - 1) * per_page})]
+    stats = db.session.get(UserStats, current_user.id)
+    response = jsonify({"collection_count": (stats.collection_count
+                                             if stats else 0),
+                        "page": page,
+                        "per_page": per_page,
+                        "recipes": recipes})
+    response.add_etag()
+    return response.make_conditional(request)
+
+
 @users_bp.route('/recipes', methods=['POST'])
 @jwt_required()
+@idempotent
 def add_user_recipe():
     data = request.get_json()
     recipe = db.session.get(Recipe, data['recipe_id'])
@@ -25,20 +86,21 @@ def add_user_recipe():
         return jsonify({"error": f"Recipe id {data['recipe_id']} not found",
                         "status": 404}), 404
     data['user_id'] = current_user.id
-    existing = db.session.query(UserRecipe).filter_by(
-        user_id=data['user_id'], recipe_id=data['recipe_id']).first()
-    if existing:
+    if db.session.execute(queries.USER_RECIPE_EXISTS, {
+            "user_id": data['user_id'],
+            "recipe_id": data['recipe_id']}).scalar():
         return jsonify({"error": "That recipe is already in user collection",
                         "status": 409}), 409
     try:
-        user_recipe = user_recipe_schema.load(data)
+        user_recipe = pooled_schema(UserRecipeSchema,
+                                    transient=True).load(data)
     except ValidationError as err:
         return jsonify({"error": "Invalid data",
                         "details": err.messages,
                         "status": 400}), 400
     try:
         db.session.add(user_recipe)
-        db.session.commit()
+        commit_session()
         return jsonify(user_recipe_schema.dump(user_recipe)), 201
     except SQLAlchemyError as err:
         db.session.rollback()
@@ -66,7 +128,7 @@ def delete_user_recipe(recipe_id):
                         "status": 404}), 404
     try:
         db.session.delete(user_recipe)
-        db.session.commit()
+        commit_session()
         return jsonify({"message": "Successfully deleted recipe id "
                         f"{recipe_id} from collection", "status": 200}), 200
     except SQLAlchemyError as err:
@@ -87,17 +149,114 @@ def update_user_recipe(recipe_id):
         return jsonify({"error": f"Recipe id {recipe_id} not found for user",
                         "status": 404}), 404
     try:
-        user_recipe_schema.load(filtered_data, instance=user_recipe,
-                                partial=True)
+        pooled_schema(UserRecipeSchema).load(filtered_data,
+                                             instance=user_recipe,
+                                             partial=True)
     except ValidationError as err:
         return jsonify({"error": "Invalid data",
                         "details": err.messages,
                         "status": 400}), 400
     try:
-        db.session.commit()
+        commit_session()
         return jsonify(user_recipe_schema.dump(user_recipe)), 200
     except SQLAlchemyError as err:
         db.session.rollback()
         return jsonify({"error": "Database error",
                         "details": str(err),
                         "status": 500}), 500
+
+
+@users_bp.route('/pantry', methods=['GET'])
+@jwt_required()
+def get_pantry():
+    return jsonify(pantry_items_schema.dump(current_user.pantry_items)), 200
+
+
+@users_bp.route('/pantry', methods=['POST'])
+@jwt_required()
+@idempotent
+def add_pantry_item():
+    data = request.get_json()
+    ingredient = db.session.get(Ingredient, data['ingredient_id'])
+    if not ingredient:
+        return jsonify({"error": "Ingredient id "
+                        f"{data['ingredient_id']} not found",
+                        "status": 404}), 404
+    data['user_id'] = current_user.id
+    existing = db.session.get(Pantry, (current_user.id,
+                                       data['ingredient_id']))
+    if existing:
+        return jsonify({"error": "That ingredient is already in the pantry",
+                        "status": 409}), 409
+    try:
+        pantry_item = pooled_schema(PantrySchema,
+                                    transient=True).load(data)
+    except ValidationError as err:
+        return jsonify({"error": "Invalid data",
+                        "details": err.messages,
+                        "status": 400}), 400
+    try:
+        db.session.add(pantry_item)
+        commit_session()
+        return jsonify(pantry_item_schema.dump(pantry_item)), 201
+    except SQLAlchemyError as err:
+        db.session.rollback()
+        return jsonify({"error": "Database error",
+                        "details": str(err),
+                        "status": 500}), 500
+
+
+@users_bp.route('/pantry/<int:ingredient_id>', methods=['PATCH'])
+@jwt_required()
+def update_pantry_item(ingredient_id):
+    pantry_item = db.session.get(Pantry, (current_user.id, ingredient_id))
+    if not pantry_item:
+        return jsonify({"error": f"Ingredient id {ingredient_id} not found "
+                        "in pantry",
+                        "status": 404}), 404
+    data = request.get_json()
+    allowed_fields = ['quantity', 'unit']
+    filtered_data = {k: v for k, v in data.items() if k in allowed_fields}
+    try:
+        pooled_schema(PantrySchema).load(filtered_data,
+                                         instance=pantry_item, partial=True)
+    except ValidationError as err:
+        return jsonify({"error": "Invalid data",
+                        "details": err.messages,
+                        "status": 400}), 400
+    try:
+        commit_session()
+        return jsonify(pantry_item_schema.dump(pantry_item)), 200
+    except SQLAlchemyError as err:
+        db.session.rollback()
+        return jsonify({"error": "Database error",
+                        "details": str(err),
+                        "status": 500}), 500
+
+
+@users_bp.route('/pantry/<int:ingredient_id>', methods=['DELETE'])
+@jwt_required()
+def delete_pantry_item(ingredient_id):
+    pantry_item = db.session.get(Pantry, (current_user.id, ingredient_id))
+    if not pantry_item:
+        return jsonify({"error": f"Ingredient id {ingredient_id} not found "
+                        "in pantry",
+                        "status": 404}), 404
+    try:
+        db.session.delete(pantry_item)
+        commit_session()
+        return jsonify({"message": f"Ingredient id {ingredient_id} "
+                        "removed from pantry", "status": 200}), 200
+    except SQLAlchemyError as err:
+        db.session.rollback()
+        return jsonify({"error": "Database error",
+                        "details": str(err),
+                        "status": 500}), 500
+
+
+@users_bp.route('/pantry/cookable', methods=['GET'])
+@jwt_required()
+def get_cookable_recipes():
+    recipes = db.session.execute(queries.COOKABLE_RECIPES, {
+        "user_id": current_user.id}).scalars().all()
+    return jsonify(recipes_schema.dump(recipes)), 200
@@ -0,0 +1,163 @@
+import threading
+import time
+from bisect import bisect_left, insort
+from difflib import get_close_matches
+from flask import current_app, has_app_context
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from changes import changed_keys, latest_change
+from models import Ingredient
+
+
+class IngredientIndex:
+    # Writes in this worker reach the index on commit; writes from other
+    # workers are caught up from the shared change log, checked at most
+    # every sync_interval seconds so lookups rarely touch the database.
+    # Request threads share one index, so changes to it hold the lock.
+    def __init__(self, sync_interval=0):
+        self.entries = []
+        self.by_id = {}
+        self.loaded = False
+        self.sync_interval = sync_interval
+        self.seen_change = 0
+        self.synced_at = 0
+        self.lock = threading.RLock()
+
+    def sync(self, session):
+        with self.lock:
+            if not self.loaded:
+                self.load(session)
+            else:
+                self.catch_up(session)
+
+    def load(self, session):
+        with self.lock:
+            self.entries = []
+            self.by_id = {}
+            self.seen_change = latest_change(session)
+            for ingredient_id, name, category in session.execute(
+                    select(Ingredient.id, Ingredient.name,
+                           Ingredient.category)):
+                self.add(ingredient_id, name, category)
+            self.synced_at = time.monotonic()
+            self.loaded = True
+
+    def catch_up(self, session):
+        with self.lock:
+            if time.monotonic() - self.synced_at < self.sync_interval:
+                return
+            self.synced_at = time.monotonic()
+            change = latest_change(session)
+            if change <= self.seen_change:
+                return
+            ids = {int(key) for _, key in changed_keys(
+                session, self.seen_change, change, ['ingredient'])}
+            rows = session.execute(
+                select(Ingredient.id, Ingredient.name, Ingredient.category)
+                .where(Ingredient.id.in_(ids))).all()
+            for ingredient_id, name, category in rows:
+                self.add(ingredient_id, name, category)
+            # Deleted and soft deleted ingredients are not loaded
+            for ingredient_id in ids - {row.id for row in rows}:
+                self.remove(ingredient_id)
+            self.seen_change = change
+
+    def add(self, ingredient_id, name, category):
+        with self.lock:
+            self.remove(ingredient_id)
+            entry = (name.lower(), ingredient_id, name, category)
+            insort(self.entries, entry)
+            self.by_id[ingredient_id] = entry
+
+    def remove(self, ingredient_id):
+        with self.lock:
+            entry = self.by_id.pop(ingredient_id, None)
+            if entry is not None:
+                del self.entries[bisect_left(self.entries, entry)]
+
+    def _matching(self, prefix, category):
+        position = bisect_left(self.entries, (prefix,))
+        for entry in self.entries[position:]:
+            if not entry[0].startswith(prefix):
+                break
+            if category is None or entry[3] == category:
+                yield entry
+
+    def suggest(self, prefix, limit=10, category=None):
+        prefix = prefix.lower()
+        found = []
+        for entry in self._matching(prefix, category):
+            found.append(entry)
+            if len(found) == limit:
+                break
+        if not found and prefix:
+            # Typo fallback: compare the prefix with the same-length start
+            # of every name and retry with the closest starts
+            starts = {entry[0][:len(prefix)] for entry in self.entries}
+            for close in get_close_matches(prefix, starts, n=limit,
+                                           cutoff=0.7):
+                for entry in self._matching(close, category):
+                    found.append(entry)
+                    if len(found) == limit:
+                        break
+                if len(found) == limit:
+                    break
+        return [{"id": entry[1], "name": entry[2], "category": entry[3]}
+                for entry in found]
+
+
+def init_app(app):
+    app.config.setdefault('AUTOCOMPLETE_SYNC_INTERVAL',
+                          0 if app.config.get('TESTING') else 1)
+    app.extensions['ingredient_index'] = IngredientIndex(
+        app.config['AUTOCOMPLETE_SYNC_INTERVAL'])
+
+
+def get_index(session):
+    index = current_app.extensions['ingredient_index']
+    index.sync(session)
+    return index
+
+
+def _loaded_index():
+    if not has_app_context():
+        return None
+    index = current_app.extensions.get('ingredient_index')
+    if index is None or not index.loaded:
+        return None
+    return index
+
+
+# Changes are queued per flush and only applied once the transaction
+# commits, so rolled back writes never reach the index
+@event.listens_for(Session, 'after_flush')
+def queue_ingredient_changes(session, flush_context):
+    if _loaded_index() is None:
+        return
+    pending = session.info.setdefault('ingredient_index_changes', [])
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Ingredient) and obj.deleted_at is not None:
+            pending.append((obj.id, None, None))
+        elif isinstance(obj, Ingredient):
+            pending.append((obj.id, obj.name, obj.category))
+    for obj in session.deleted:
+        if isinstance(obj, Ingredient):
+            pending.append((obj.id, None, None))
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_ingredient_changes(session):
+    pending = session.info.pop('ingredient_index_changes', [])
+    index = _loaded_index()
+    if index is None:
+        return
+    for ingredient_id, name, category in pending:
+        if name is None:
+            index.remove(ingredient_id)
+        else:
+            index.add(ingredient_id, name, category)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_ingredient_changes(session):
+    session.info.pop('ingredient_index_changes', None)
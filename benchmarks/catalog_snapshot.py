@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+import time
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import insert  # noqa: E402
+from config import create_app, db  # noqa: E402
+from models import Ingredient, Recipe, RecipeIngredient  # noqa: E402
+
+
+def run(path, recipes, snapshot, number):
+    app = create_app(config={
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{path}/catalog.db",
+        'CATALOG_SNAPSHOT': f"{path}/catalog.bin" if snapshot else None,
+        'CATALOG_SNAPSHOT_INTERVAL': 0})
+    client = app.test_client()
+    paths = {'get_recipes': '/api/recipes/',
+             'get_recipe_by_id': f'/api/recipes/{recipes // 2}',
+             'get_ingredients': '/api/ingredients/'}
+    name = 'snapshot' if snapshot else 'database'
+    for route, url in paths.items():
+        count = number if route == 'get_recipe_by_id' else max(
+            1, number // 100)
+        seconds = timeit.timeit(lambda: client.get(url),
+                                number=count) / count
+        print(f"{name:8} {route:17} {seconds * 1e3:8.3f}ms")
+
+
+def main(recipes=2000, ingredients=500, lines=8, number=1000):
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app(config={
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp}/catalog.db",
+            'CATALOG_SNAPSHOT': f"{tmp}/catalog.bin"})
+        with app.app_context():
+            db.create_all()
+            db.session.execute(insert(Ingredient), [
+                {"id": i, "name": f"i{i}", "category": "bench"}
+                for i in range(1, ingredients + 1)])
+            db.session.execute(insert(Recipe), [
+                {"id": i, "name": f"r{i}", "prep_time": 1, "cook_time": 1,
+                 "servings": 1, "instructions": "Stir. " * 20,
+                 "ingredient_count": lines}
+                for i in range(1, recipes + 1)])
+            db.session.execute(insert(RecipeIngredient), [
+                {"recipe_id": i, "ingredient_id": (i * 7 + j) % ingredients
+                 + 1, "quantity": 1, "unit": "cup"}
+                for i in range(1, recipes + 1) for j in range(lines)])
+            db.session.commit()
+            start = time.perf_counter()
+            app.extensions['catalog'].refresh(db.session)
+            built = time.perf_counter() - start
+        size = os.path.getsize(f"{tmp}/catalog.bin")
+        print(f"snapshot of {recipes:,d} recipes built in {built:.2f}s, "
+              f"{size / 1024:,.0f} KiB")
+        for snapshot in (False, True):
+            run(tmp, recipes, snapshot, number)
+
+
+if __name__ == "__main__":
+    main()
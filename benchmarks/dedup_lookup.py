@@ -0,0 +1,41 @@
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from dedup import Bands, features, signature  # noqa: E402
+
+
+WORDS = [f"word{i}" for i in range(2000)]
+INGREDIENTS = [f"ingredient {i}" for i in range(500)]
+
+
+def fake_recipe(rng):
+    return (f"recipe {rng.randrange(10 ** 6)}",
+            ' '.join(rng.choices(WORDS, k=60)),
+            rng.sample(INGREDIENTS, 10))
+
+
+def main(recipes=20000, number=1000):
+    rng = random.Random(0)
+    index = Bands()
+    samples = [fake_recipe(rng) for _ in range(recipes)]
+    for recipe_id, recipe in enumerate(samples):
+        index.add(recipe_id, signature(features(*recipe)))
+    name, instructions, ingredients = samples[0]
+    edited = (name.upper(), instructions.replace(instructions.split()[5],
+                                                 "changed"), ingredients)
+    values = signature(features(*edited))
+    print(f"matches for an edited copy: {index.find(values, 0.8)}")
+    seconds = timeit.timeit(lambda: signature(features(*edited)),
+                            number=number) / number
+    print(f"signature: {seconds * 1e6:8.1f}us")
+    seconds = timeit.timeit(lambda: index.find(values, 0.8),
+                            number=number) / number
+    print(f"lookup over {recipes:,d} recipes: {seconds * 1e6:8.1f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import json
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config import create_app, db  # noqa: E402
+import group_commit  # noqa: E402
+
+
+def run(group, threads, writes):
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app(config={
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp}/bench.db",
+            'GROUP_COMMIT': group})
+        with app.app_context():
+            db.create_all()
+        statuses = []
+
+        def writer(worker):
+            client = app.test_client()
+            for i in range(writes):
+                response = client.post(
+                    '/api/ingredients/',
+                    data=json.dumps({"name": f"i{worker}-{i}",
+                                     "category": "bench"}),
+                    content_type='application/json')
+                statuses.append(response.status_code)
+
+        workers = [threading.Thread(target=writer, args=(n,))
+                   for n in range(threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        group_commit.stop(app)
+        with app.app_context():
+            db.engine.dispose()
+    ok = statuses.count(201)
+    print(f"group_commit={group!s:5} threads={threads:2} "
+          f"{ok / elapsed:8.1f} writes/s, {len(statuses) - ok} failed")
+
+
+if __name__ == "__main__":
+    for threads in (1, 8, 32):
+        for group in (False, True):
+            run(group, threads, 200 // threads * 4)
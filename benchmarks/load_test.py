@@ -0,0 +1,312 @@
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from urllib.parse import urlsplit
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from flask_jwt_extended import create_access_token  # noqa: E402
+from sqlalchemy import insert, select  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+from config import create_app, db  # noqa: E402
+from models import Ingredient, Recipe, User  # noqa: E402
+
+PASSWORD = "load-test-secret"
+MIX = {'browse': 40, 'view': 35, 'login': 5, 'collect': 10,
+       'add_ingredient': 10}
+# Statuses a scenario may legitimately answer with; anything else is an
+# error. A virtual user that has collected every recipe gets a 409.
+EXPECTED = {'browse': {200}, 'view': {200}, 'login': {200},
+            'collect': {201, 409}, 'add_ingredient': {201, 409}}
+
+
+def seed(uri, users, recipes=200, ingredients=100):
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+        db.create_all()
+        db.session.execute(insert(Ingredient), [
+            {"id": i, "name": f"Ingredient {i}", "category": "load"}
+            for i in range(1, ingredients + 1)])
+        db.session.execute(insert(Recipe), [
+            {"id": i, "name": f"Recipe {i}", "prep_time": 10,
+             "cook_time": 20, "servings": 2,
+             "instructions": "Mix everything and cook. " * 10}
+            for i in range(1, recipes + 1)])
+        # Hashing once keeps seeding fast; logins still pay the full check
+        password_hash = generate_password_hash(PASSWORD)
+        db.session.execute(insert(User), [
+            {"username": f"load{i}", "email": f"load{i}@example.com",
+             "password_hash": password_hash} for i in range(users)])
+        db.session.commit()
+        # Tokens minted up front, so virtual users start without logging in
+        return [create_access_token(identity=user) for user in
+                db.session.execute(select(User).order_by(User.id)).scalars()]
+
+
+def start_server(uri, workers):
+    server = subprocess.Popen(
+        [sys.executable, 'server.py', '--port', '0', '--workers',
+         str(workers), '--database-uri', uri],
+        cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        text=True)
+    address = urlsplit(server.stdout.readline().split()[2])
+    return server, address.port
+
+
+def stop_server(server, timeout=10):
+    # A worker stuck on a request must not hang the sweep
+    server.terminate()
+    try:
+        server.wait(timeout)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+class VirtualUser:
+    def __init__(self, port, number, users, token, recipes, ingredients,
+                 seed):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port)
+        self.number = number
+        self.token = token
+        self.rng = random.Random(seed)
+        self.recipes = recipes
+        # Each user adds ingredients to its own recipes, so concurrent
+        # users do not race each other into 409s
+        self.lines = ((recipe, ingredient)
+                      for ingredient in range(1, ingredients + 1)
+                      for recipe in range(number + 1, recipes + 1, users))
+        self.collected = self.rng.sample(range(1, recipes + 1), recipes)
+
+    def request(self, method, path, body=None, auth=False):
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        if auth:
+            headers['Authorization'] = f"Bearer {self.token}"
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        response.read()
+        return response.status
+
+    def browse(self):
+        return self.request('GET', '/api/recipes/')
+
+    def view(self):
+        return self.request(
+            'GET', f"/api/recipes/{self.rng.randint(1, self.recipes)}")
+
+    def login(self):
+        return self.request('POST', '/api/auth/login', {
+            "username": f"load{self.number}", "password": PASSWORD})
+
+    def collect(self):
+        recipe_id = (self.collected.pop() if self.collected
+                     else self.rng.randint(1, self.recipes))
+        return self.request('POST', '/api/users/recipes',
+                            {"recipe_id": recipe_id}, auth=True)
+
+    def add_ingredient(self):
+        recipe_id, ingredient_id = next(self.lines, (1, 1))
+        return self.request(
+            'POST', f"/api/recipes/{recipe_id}/ingredients",
+            {"ingredient_id": ingredient_id, "quantity": 1, "unit": "cup"})
+
+
+def run_users(args):
+    # One client process drives several virtual users on threads; each
+    # sends its next request as soon as the previous one is answered
+    (port, numbers, users, tokens, mix, recipes, ingredients, start,
+     warmup, duration) = args
+    scenarios, weights = zip(*mix.items())
+    samples = []
+    lock = threading.Lock()
+
+    def drive(number):
+        user = VirtualUser(port, number, users, tokens[number], recipes,
+                           ingredients, seed=number)
+        rows = []
+        while time.monotonic() < start:
+            time.sleep(0.01)
+        deadline = start + warmup + duration
+        while True:
+            scenario = user.rng.choices(scenarios, weights)[0]
+            began = time.monotonic()
+            if began >= deadline:
+                break
+            try:
+                status = getattr(user, scenario)()
+            except (OSError, http.client.HTTPException):
+                status = 0
+                user.conn.close()
+            finished = time.monotonic()
+            if finished - start >= warmup and finished < deadline:
+                rows.append((scenario, status, finished - began))
+        with lock:
+            samples.extend(rows)
+
+    threads = [threading.Thread(target=drive, args=(number,))
+               for number in numbers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def percentile(ordered, fraction):
+    # Nearest rank on an already sorted list
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(concurrency, samples, duration):
+    latencies = sorted(latency for _, _, latency in samples)
+    errors = sum(status not in EXPECTED[scenario]
+                 for scenario, status, _ in samples)
+    by_scenario = defaultdict(list)
+    for scenario, _, latency in samples:
+        by_scenario[scenario].append(latency)
+    return {
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "throughput": len(samples) / duration,
+        "errors": errors,
+        "p50": percentile(latencies, 0.50) * 1e3,
+        "p95": percentile(latencies, 0.95) * 1e3,
+        "p99": percentile(latencies, 0.99) * 1e3,
+        "scenarios": {
+            scenario: {"requests": len(values),
+                       "p95": percentile(sorted(values), 0.95) * 1e3}
+            for scenario, values in sorted(by_scenario.items())},
+        "statuses": dict(Counter(status for _, status, _ in samples)),
+    }
+
+
+def run_level(concurrency, mix, workers, processes, warmup, duration,
+              recipes=200, ingredients=100):
+    # A fresh database per level, so writes from earlier levels neither
+    # slow down nor conflict with the next one
+    with tempfile.TemporaryDirectory() as tmp:
+        uri = f"sqlite:///{tmp}/load.db"
+        tokens = seed(uri, concurrency, recipes, ingredients)
+        server, port = start_server(uri, workers)
+        try:
+            processes = min(processes, concurrency)
+            start = time.monotonic() + 1
+            jobs = [(port, range(i, concurrency, processes), concurrency,
+                     tokens, mix, recipes, ingredients, start, warmup,
+                     duration) for i in range(processes)]
+            with multiprocessing.Pool(processes) as pool:
+                samples = [row for rows in pool.map(run_users, jobs)
+                           for row in rows]
+        finally:
+            stop_server(server)
+    return summarize(concurrency, samples, duration)
+
+
+def find_knee(levels, min_gain=0.1):
+    # The saturation knee is the last level whose throughput still grew by
+    # at least min_gain over the previous one; past it extra concurrency
+    # only queues up and shows as latency
+    knee = levels[0]
+    for previous, level in zip(levels, levels[1:]):
+        if level['throughput'] < previous['throughput'] * (1 + min_gain):
+            break
+        knee = level
+    return knee
+
+
+def change(after, before):
+    return f"{after / before - 1:+.0%}" if before else "n/a"
+
+
+def report(levels, knee):
+    lines = [f"{'clients':>8} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+             f"{'p99 ms':>8} {'errors':>7}"]
+    for level in levels:
+        marker = '  <- knee' if level is knee else ''
+        lines.append(
+            f"{level['concurrency']:8d} {level['throughput']:9.1f} "
+            f"{level['p50']:8.1f} {level['p95']:8.1f} {level['p99']:8.1f} "
+            f"{level['errors']:7d}{marker}")
+    lines.append('')
+    lines.append(f"Saturation knee at {knee['concurrency']} clients: "
+                 f"{knee['throughput']:.1f} req/s, p99 {knee['p99']:.1f}ms")
+    beyond = levels[levels.index(knee) + 1:]
+    if beyond:
+        last = beyond[-1]
+        lines.append(
+            f"At {last['concurrency']} clients throughput changes "
+            f"{change(last['throughput'], knee['throughput'])} while p99 "
+            f"changes {change(last['p99'], knee['p99'])}")
+    else:
+        lines.append("Throughput still grows at the highest level; "
+                     "sweep further to find the knee")
+    lines.append('')
+    lines.append("Per scenario p95 at the knee:")
+    for scenario, stats in knee['scenarios'].items():
+        lines.append(f"  {scenario:15} {stats['requests']:7d} requests "
+                     f"{stats['p95']:8.1f}ms")
+    return '\n'.join(lines)
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        scenario, _, weight = part.partition('=')
+        if scenario not in MIX:
+            raise argparse.ArgumentTypeError(
+                f"unknown scenario {scenario!r}, pick from {', '.join(MIX)}")
+        mix[scenario] = float(weight)
+    return mix
+
+
+def parse_levels(value):
+    return sorted({int(level) for level in value.split(',')})
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sweep concurrency against a local server.py")
+    parser.add_argument('--mix', type=parse_mix, default=MIX,
+                        help="scenario weights, e.g. browse=40,view=35")
+    parser.add_argument('--concurrency', type=parse_levels,
+                        default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help="client processes driving the virtual users")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+    levels = []
+    for concurrency in args.concurrency:
+        levels.append(run_level(concurrency, args.mix, args.workers,
+                                args.processes, args.warmup, args.duration))
+        print(f"{concurrency} clients: {levels[-1]['throughput']:.1f} req/s",
+              file=sys.stderr)
+    knee = find_knee(levels)
+    print(report(levels, knee))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"mix": args.mix, "levels": levels,
+                       "knee": knee['concurrency']}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
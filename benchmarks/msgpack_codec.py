@@ -0,0 +1,56 @@
+import json
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import msgpack  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+from config import create_app, db  # noqa: E402
+from models import Recipe, Ingredient, RecipeIngredient  # noqa: E402
+
+
+def seed(recipes=500, ingredients=200, per_recipe=8):
+    db.session.execute(insert(Ingredient), [
+        {"id": i, "name": f"ingredient {i}", "category": f"category {i % 12}"}
+        for i in range(1, ingredients + 1)])
+    db.session.execute(insert(Recipe), [
+        {"id": i, "name": f"recipe {i}", "instructions": "Stir. " * 20,
+         "prep_time": 10, "cook_time": 20, "servings": 4}
+        for i in range(1, recipes + 1)])
+    db.session.execute(insert(RecipeIngredient), [
+        {"recipe_id": r, "ingredient_id": (r * 7 + n) % ingredients + 1,
+         "quantity": 2, "unit": "cups"}
+        for r in range(1, recipes + 1) for n in range(per_recipe)])
+    db.session.commit()
+
+
+def main(number=20):
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        seed()
+    client = app.test_client()
+    for path in ('/api/recipes/', '/api/ingredients/'):
+        records = client.get(path).get_json()
+        body = json.dumps(records, separators=(",", ":")).encode()
+        packed = msgpack.packb(records)
+        with app.test_request_context(
+                headers={"Accept": "application/msgpack"}):
+            cases = (
+                ("json", lambda: app.json.dumps(records),
+                 lambda: json.loads(body), body),
+                ("msgpack", lambda: app.json.response(records).data,
+                 lambda: msgpack.unpackb(packed), packed),
+            )
+            for label, encode, decode, data in cases:
+                encode_ms = timeit.timeit(encode, number=number) / number
+                decode_ms = timeit.timeit(decode, number=number) / number
+                print(f"{path:18} {label:8} {len(data):9,d} bytes"
+                      f"  encode {encode_ms * 1000:6.2f}ms"
+                      f"  decode {decode_ms * 1000:6.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
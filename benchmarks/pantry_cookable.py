@@ -0,0 +1,58 @@
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import insert  # noqa: E402
+from config import create_app, db  # noqa: E402
+from models import Recipe, Ingredient, RecipeIngredient, User, Pantry  # noqa
+from queries import COOKABLE_RECIPES  # noqa: E402
+
+
+def seed(rows, ingredients=2000, per_recipe=10, pantry_size=1000):
+    rng = random.Random(0)
+    recipes = rows // per_recipe
+    db.session.execute(insert(Ingredient), [
+        {"id": i, "name": f"ingredient {i}", "category": "bench"}
+        for i in range(1, ingredients + 1)])
+    db.session.execute(insert(Recipe), [
+        {"id": i, "name": f"recipe {i}", "prep_time": 10, "cook_time": 10,
+         "servings": 2} for i in range(1, recipes + 1)])
+    lines = []
+    for recipe_id in range(1, recipes + 1):
+        for ingredient_id in rng.sample(range(1, ingredients + 1),
+                                        per_recipe):
+            lines.append({"recipe_id": recipe_id,
+                          "ingredient_id": ingredient_id,
+                          "quantity": 1, "unit": "each"})
+    db.session.execute(insert(RecipeIngredient), lines)
+    db.session.add(User(id=1, username="bench", email="bench@example.com",
+                        password_hash="x"))
+    db.session.execute(insert(Pantry), [
+        {"user_id": 1, "ingredient_id": i, "quantity": 5, "unit": "each"}
+        for i in rng.sample(range(1, ingredients + 1), pantry_size)])
+    db.session.commit()
+
+
+def main(rows=1_000_000, repeat=5):
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        started = time.perf_counter()
+        seed(rows)
+        print(f"seeded {rows} recipe_ingredient rows in "
+              f"{time.perf_counter() - started:.1f}s")
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            found = db.session.execute(COOKABLE_RECIPES, {
+                "user_id": 1}).scalars().all()
+            timings.append(time.perf_counter() - started)
+        print(f"cookable recipes: {len(found)}, best of {repeat}: "
+              f"{min(timings) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,45 @@
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import insert  # noqa: E402
+from config import create_app, db  # noqa: E402
+from models import Recipe, Ingredient, RecipeIngredient  # noqa: E402
+from compression import ENCODERS  # noqa: E402
+
+
+def seed(recipes=500, ingredients=200, per_recipe=8):
+    db.session.execute(insert(Ingredient), [
+        {"id": i, "name": f"ingredient {i}", "category": f"category {i % 12}"}
+        for i in range(1, ingredients + 1)])
+    db.session.execute(insert(Recipe), [
+        {"id": i, "name": f"recipe {i}", "instructions": "Stir. " * 20,
+         "prep_time": 10, "cook_time": 20, "servings": 4}
+        for i in range(1, recipes + 1)])
+    db.session.execute(insert(RecipeIngredient), [
+        {"recipe_id": r, "ingredient_id": (r * 7 + n) % ingredients + 1,
+         "quantity": 2, "unit": "cups"}
+        for r in range(1, recipes + 1) for n in range(per_recipe)])
+    db.session.commit()
+
+
+def main(number=5):
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        seed()
+    client = app.test_client()
+    for label, query in (("json", ""), ("columnar", "?format=columnar")):
+        body = client.get(f'/api/recipes/{query}').data
+        print(f"{label:9} identity {len(body):9,d} bytes")
+        for encoding, (compress, _) in ENCODERS.items():
+            seconds = timeit.timeit(lambda: compress(body, 6),
+                                    number=number) / number
+            print(f"{label:9} {encoding:8} {len(compress(body, 6)):9,d} bytes"
+                  f"  {seconds * 1000:6.1f}ms to encode")
+
+
+if __name__ == "__main__":
+    main()
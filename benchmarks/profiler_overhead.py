@@ -0,0 +1,45 @@
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import insert  # noqa: E402
+from config import create_app, db  # noqa: E402
+from models import Recipe  # noqa: E402
+
+
+def run(name, config, number):
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                             **config})
+    with app.app_context():
+        db.create_all()
+        db.session.execute(insert(Recipe), [
+            {"name": f"r{i}", "prep_time": 1, "cook_time": 1, "servings": 1}
+            for i in range(50)])
+        db.session.commit()
+    client = app.test_client()
+    client.get('/api/recipes/')
+    seconds = timeit.timeit(lambda: client.get('/api/recipes/'),
+                            number=number) / number
+    profiler = app.extensions.get('profiler')
+    samples = 0
+    if profiler is not None:
+        samples = sum(profiler.summary()['endpoints'].values())
+        profiler.stop()
+    print(f"{name:22} {seconds * 1e3:6.3f}ms per request, "
+          f"{samples:6,d} samples")
+    return seconds
+
+
+def main(number=300):
+    base = run('profiler off', {}, number)
+    for interval in (0.01, 0.001):
+        seconds = run(f"sampling every {interval * 1e3:g}ms", {
+            'PROFILER': True, 'PROFILER_SAMPLING': True,
+            'PROFILER_INTERVAL': interval}, number)
+        print(f"{'':22} overhead {seconds / base - 1:+.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import insert, select  # noqa: E402
+from sqlalchemy.orm import selectinload  # noqa: E402
+from config import create_app, db  # noqa: E402
+from models import Ingredient, Recipe, RecipeIngredient  # noqa: E402
+import queries  # noqa: E402
+
+
+def inline(recipe_id):
+    # How the handlers built their statements before the registry
+    return (select(Recipe).where(Recipe.id == recipe_id)
+            .options(selectinload(Recipe.recipe_ingredients)
+                     .joinedload(RecipeIngredient.ingredient)))
+
+
+def main(number=5000):
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+    with app.app_context():
+        db.create_all()
+        db.session.execute(insert(Ingredient), [
+            {"id": i, "name": f"i{i}", "category": "bench"}
+            for i in range(1, 11)])
+        db.session.execute(insert(Recipe), [
+            {"id": 1, "name": "r1", "prep_time": 1, "cook_time": 1,
+             "servings": 1}])
+        db.session.execute(insert(RecipeIngredient), [
+            {"recipe_id": 1, "ingredient_id": i, "quantity": 1,
+             "unit": "cup"} for i in range(1, 11)])
+        db.session.commit()
+        cases = (('select()', lambda: db.session.execute(inline(1))),
+                 ('registry', lambda: db.session.execute(
+                     queries.RECIPE_WITH_CHILDREN, {"recipe_id": 1})))
+        for name, execute in cases:
+            def load():
+                execute().scalar_one()
+                db.session.expunge_all()
+            load()
+            seconds = timeit.timeit(load, number=number) / number
+            print(f"{name:9} build, execute and load {seconds * 1e6:7.1f}us")
+        stats = app.extensions['query_cache_stats'].report()
+        print(f"compiled cache hit rate: {stats['(background)']['hit_rate']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import json
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import func, insert, select  # noqa: E402
+from config import create_app, db  # noqa: E402
+from models import (Ingredient, Recipe, RecipeIngredient,  # noqa: E402
+                    RecipeRevision)
+from revisions import REVISED_FIELDS, state_as_of  # noqa: E402
+
+
+INGREDIENTS = 20
+
+
+def edit(rng, recipe):
+    if rng.random() < 0.3:
+        recipe.servings = rng.randint(1, 12)
+        recipe.cook_time = rng.randint(5, 120)
+    else:
+        line = rng.choice(recipe.recipe_ingredients)
+        line.quantity = rng.randint(1, 10)
+
+
+def full_copy(recipe):
+    # What storing every revision in full would cost
+    return json.dumps({
+        "f": {field: getattr(recipe, field) for field in REVISED_FIELDS},
+        "i": {str(line.ingredient_id): [line.quantity, line.unit, line.notes]
+              for line in recipe.recipe_ingredients}},
+        separators=(',', ':'))
+
+
+def run(interval, edits, number):
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                             'REVISION_SNAPSHOT_INTERVAL': interval})
+    rng = random.Random(0)
+    with app.app_context():
+        db.create_all()
+        db.session.execute(insert(Ingredient), [
+            {"id": i, "name": f"i{i}", "category": "bench"}
+            for i in range(1, INGREDIENTS + 1)])
+        recipe = Recipe(name="Benchmark stew", prep_time=20, cook_time=60,
+                        servings=4, instructions=' '.join(["Stir."] * 100))
+        db.session.add(recipe)
+        db.session.flush()
+        for i in range(1, INGREDIENTS + 1):
+            db.session.add(RecipeIngredient(recipe_id=recipe.id,
+                                            ingredient_id=i, quantity=1,
+                                            unit="cup", notes="chopped"))
+        db.session.commit()
+        full = len(full_copy(recipe))
+        for _ in range(edits):
+            edit(rng, recipe)
+            db.session.commit()
+            full += len(full_copy(recipe))
+        stored = db.session.execute(select(
+            func.sum(func.length(RecipeRevision.delta)) +
+            func.coalesce(func.sum(func.length(RecipeRevision.snapshot)), 0))
+        ).scalar()
+        times = db.session.execute(
+            select(RecipeRevision.changed_at)).scalars().all()
+        points = rng.sample(times, number)
+        seconds = timeit.timeit(
+            lambda: state_as_of(db.session, recipe.id, points.pop()),
+            number=number) / number
+    print(f"snapshot every {interval:4d}: {stored:9,d} bytes "
+          f"({stored / full:6.1%} of full copies), "
+          f"as_of {seconds * 1e6:8.1f}us")
+
+
+def main(edits=500, number=200):
+    for interval in (1, 10, 50, edits + 1):
+        run(interval, edits, number)
+
+
+if __name__ == "__main__":
+    main()
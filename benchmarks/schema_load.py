@@ -0,0 +1,44 @@
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import event  # noqa: E402
+from config import create_app, db  # noqa: E402
+from models import Recipe, Ingredient, RecipeIngredientSchema  # noqa: E402
+from models import recipe_ingredient_schema, pooled_schema  # noqa: E402
+
+
+def main(number=5000):
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        db.session.add(Recipe(id=1, name="Bench", prep_time=1, cook_time=1,
+                              servings=1))
+        db.session.add(Ingredient(id=1, name="Bench", category="bench"))
+        db.session.commit()
+        data = {"recipe_id": 1, "ingredient_id": 1, "quantity": 2,
+                "unit": "cups", "notes": "diced"}
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda *args: statements.append(args[2]))
+        variants = {
+            "new schema per request": lambda: RecipeIngredientSchema().load(
+                data),
+            "shared schema with lookup": lambda: recipe_ingredient_schema.load(
+                data),
+            "pooled transient schema": lambda: pooled_schema(
+                RecipeIngredientSchema, transient=True).load(data),
+        }
+        for label, load in variants.items():
+            statements.clear()
+            elapsed = timeit.timeit(load, number=number)
+            db.session.expunge_all()
+            print(f"{label:28} {elapsed / number * 1e6:8.1f}us/load "
+                  f"{len(statements) / number:.1f} queries/load")
+
+
+if __name__ == "__main__":
+    main()
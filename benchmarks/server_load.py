@@ -0,0 +1,86 @@
+import http.client
+import json
+import multiprocessing
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from config import create_app, db  # noqa: E402
+from models import Recipe  # noqa: E402
+
+DEV_SERVER = ("from config import create_app; "
+              "create_app(config={{'SQLALCHEMY_DATABASE_URI': {uri!r}}})"
+              ".run(port={port})")
+
+
+def seed(uri, recipes=50):
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+        db.create_all()
+        db.session.add_all(Recipe(name=f"Recipe {i}", prep_time=10,
+                                  cook_time=10, servings=2)
+                           for i in range(recipes))
+        db.session.commit()
+
+
+def wait_until_up(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/api/health/')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def hammer(args):
+    port, path, duration = args
+    done = 0
+    deadline = time.monotonic() + duration
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    while time.monotonic() < deadline:
+        conn.request('GET', path)
+        response = conn.getresponse()
+        json.loads(response.read())
+        done += 1
+    return done
+
+
+def measure(command, port, clients, duration):
+    server = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(port)
+        with multiprocessing.Pool(clients) as pool:
+            counts = pool.map(hammer, [(port, '/api/recipes/', duration)] *
+                              clients)
+    finally:
+        server.terminate()
+        server.wait()
+    return sum(counts) / duration
+
+
+def main(clients=8, duration=5):
+    with tempfile.TemporaryDirectory() as tmp:
+        uri = f"sqlite:///{tmp}/bench.db"
+        seed(uri)
+        dev = measure([sys.executable, '-c',
+                       DEV_SERVER.format(uri=uri, port=8801)],
+                      8801, clients, duration)
+        prefork = measure([sys.executable, 'server.py', '--port', '8802',
+                           '--database-uri', uri],
+                          8802, clients, duration)
+    print(f"dev server:     {dev:8.1f} req/s")
+    print(f"prefork server: {prefork:8.1f} req/s ({prefork / dev:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
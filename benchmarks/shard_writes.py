@@ -0,0 +1,87 @@
+import json
+import multiprocessing
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import insert  # noqa: E402
+from config import create_app, db  # noqa: E402
+from models import Ingredient, Recipe  # noqa: E402
+
+
+ROWS = 5000
+
+
+def pantry_item(i):
+    return {"ingredient_id": i, "quantity": 1, "unit": "cup"}
+
+
+def collected_recipe(i):
+    return {"recipe_id": i}
+
+
+WRITES = {'pantry': pantry_item, 'recipes': collected_recipe}
+
+
+def setup(config, users):
+    app = create_app(config=config)
+    with app.app_context():
+        db.create_all()
+        db.session.execute(insert(Ingredient), [
+            {"id": i, "name": f"i{i}", "category": "bench"}
+            for i in range(1, ROWS + 1)])
+        db.session.execute(insert(Recipe), [
+            {"id": i, "name": f"r{i}", "prep_time": 1, "cook_time": 1,
+             "servings": 1} for i in range(1, ROWS + 1)])
+        db.session.commit()
+    client = app.test_client()
+    tokens = []
+    for n in range(users):
+        user = {"username": f"user{n}", "password": "1234secret",
+                "email": f"user{n}@example.com"}
+        client.post('/api/auth/register', data=json.dumps(user),
+                    content_type='application/json')
+        tokens.append(client.post('/api/auth/login', data=json.dumps(user),
+                                  content_type='application/json'
+                                  ).get_json()['access_token'])
+    with app.app_context():
+        db.engine.dispose()
+    return tokens
+
+
+def writer(args):
+    # One process per user so the GIL does not hide lock contention
+    config, kind, token, duration = args
+    client = create_app(config=config).test_client()
+    headers = {"Authorization": f"Bearer {token}"}
+    done = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline and done < ROWS:
+        response = client.post(f'/api/users/{kind}', headers=headers,
+                               data=json.dumps(WRITES[kind](done + 1)),
+                               content_type='application/json')
+        if response.status_code != 201:
+            raise RuntimeError(response.get_json())
+        done += 1
+    return done
+
+
+def run(shards, kind, users, duration):
+    with tempfile.TemporaryDirectory() as tmp:
+        config = {'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp}/bench.db",
+                  'USER_SHARDS': shards}
+        tokens = setup(config, users)
+        with multiprocessing.Pool(users) as pool:
+            counts = pool.map(writer, [(config, kind, token, duration)
+                                       for token in tokens])
+    print(f"{kind:7} shards={shards} users={users:2} "
+          f"{sum(counts) / duration:8.1f} writes/s")
+
+
+if __name__ == "__main__":
+    for kind in WRITES:
+        for shards in (0, 2, 4, 8):
+            run(shards, kind, users=8, duration=3)
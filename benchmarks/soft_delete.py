@@ -0,0 +1,48 @@
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import insert  # noqa: E402
+from config import create_app, db  # noqa: E402
+from models import Ingredient, Recipe, RecipeIngredient  # noqa: E402
+from softdelete import purge_deleted  # noqa: E402
+
+
+def run(fan_out, batch_size):
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                             'PURGE_INTERVAL': 0})
+    with app.app_context():
+        db.create_all()
+        db.session.execute(insert(Ingredient), [
+            {"id": 1, "name": "popular", "category": "bench"}])
+        db.session.execute(insert(Recipe), [
+            {"id": i, "name": f"r{i}", "prep_time": 1, "cook_time": 1,
+             "servings": 1, "ingredient_count": 1}
+            for i in range(1, fan_out + 1)])
+        db.session.execute(insert(RecipeIngredient), [
+            {"recipe_id": i, "ingredient_id": 1, "quantity": 1,
+             "unit": "cup"} for i in range(1, fan_out + 1)])
+        db.session.commit()
+    client = app.test_client()
+    start = time.perf_counter()
+    response = client.delete('/api/ingredients/1')
+    deleted = time.perf_counter() - start
+    assert response.status_code == 200
+    with app.app_context():
+        start = time.perf_counter()
+        removed = purge_deleted(db.session, batch_size)
+        purged = time.perf_counter() - start
+    print(f"fan-out {fan_out:6,d}: DELETE {deleted * 1e3:7.2f}ms, "
+          f"purge {removed:6,d} rows in {purged:6.2f}s "
+          f"({removed / purged:8,.0f} rows/s)")
+
+
+def main(batch_size=500):
+    for fan_out in (10, 1000, 10000):
+        run(fan_out, batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+STARTUP_CODE = ("import time; started = time.perf_counter(); "
+                "from config import create_app; create_app({!r}); "
+                "print(time.perf_counter() - started)")
+
+
+def measure(config_type):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         STARTUP_CODE.format(config_type)],
+        capture_output=True, text=True, cwd=ROOT, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        modules.append((int(self_us), name.strip()))
+    return float(result.stdout), modules
+
+
+def main():
+    for config_type in ('testing', 'development'):
+        elapsed, modules = measure(config_type)
+        total = sum(self_us for self_us, _ in modules)
+        print(f"{config_type}: {elapsed * 1000:.0f}ms to a ready app, "
+              f"{total / 1000:.0f}ms importing {len(modules)} modules")
+        for self_us, name in sorted(modules, reverse=True)[:10]:
+            print(f"  {self_us / 1000:7.1f}ms {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import json
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config import create_app, db  # noqa: E402
+
+
+def main(number=50):
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+    with app.app_context():
+        db.create_all()
+    client = app.test_client()
+    credentials = {"username": "bench", "password": "bench-secret"}
+    client.post('/api/auth/register', data=json.dumps(
+        {**credentials, "email": "bench@example.com"}),
+        content_type='application/json')
+
+    def login():
+        response = client.post('/api/auth/login',
+                               data=json.dumps(credentials),
+                               content_type='application/json')
+        return response.get_json()['refresh_token']
+
+    refresh_token = login()
+
+    def refresh():
+        nonlocal refresh_token
+        response = client.post('/api/auth/refresh', headers={
+            "Authorization": f"Bearer {refresh_token}"})
+        refresh_token = response.get_json()['refresh_token']
+
+    results = {}
+    for name, call in (('login', login), ('refresh', refresh)):
+        results[name] = timeit.timeit(call, number=number) / number
+        print(f"{name:8} {results[name] * 1e3:8.2f}ms")
+    print(f"a refresh costs {results['refresh'] / results['login']:.1%} "
+          f"of a login")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+import fcntl
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+import click
+from flask import current_app
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+from config import db
+from models import ChangeLog, Ingredient, IngredientSchema, Recipe
+from models import RecipeIngredient, RecipeIngredientSchema, RecipeSchema
+
+
+# The public catalog as one read-only file that every worker maps: each
+# column is a typed array, strings live in one shared table and columns
+# refer to them by number. Files are replaced, never rewritten, so a
+# worker still serving from the previous mapping is not disturbed.
+MAGIC = b'RCATLG01'
+HEADER = struct.Struct('=8s1sxxxqdI')
+SECTION = struct.Struct('=24s1s7xQQ')
+NONE = 0xFFFFFFFF
+CATALOG_ENTITIES = ('recipe', 'ingredient', 'recipe_ingredient')
+
+# Dumped field -> column type; 's' columns hold string table numbers
+RECIPE_COLUMNS = {'id': 'q', 'name': 's', 'instructions': 's',
+                  'prep_time': 'i', 'cook_time': 'i', 'servings': 'i',
+                  'created_at': 's', 'ingredient_count': 'i',
+                  'total_time': 'i'}
+INGREDIENT_COLUMNS = {'id': 'q', 'name': 's', 'category': 's'}
+LINE_COLUMNS = {'quantity': 'i', 'unit': 's', 'notes': 's'}
+
+# Responses list fields in the order the schemas dump them, which the
+# columnar and MessagePack formats preserve
+RECIPE_FIELDS = list(RecipeSchema().dump_fields)
+INGREDIENT_FIELDS = list(IngredientSchema().dump_fields)
+LINE_FIELDS = list(RecipeIngredientSchema().dump_fields)
+
+recipe_rows_schema = RecipeSchema(many=True, exclude=['recipe_ingredients'])
+ingredient_rows_schema = IngredientSchema(many=True)
+line_rows_schema = RecipeIngredientSchema(many=True, exclude=['ingredient'])
+
+
+class StringTable:
+    def __init__(self):
+        self.numbers = {}
+        self.data = bytearray()
+        self.offsets = array('I', [0])
+
+    def add(self, value):
+        if value is None:
+            return NONE
+        number = self.numbers.get(value)
+        if number is None:
+            number = self.numbers[value] = len(self.offsets) - 1
+            self.data += value.encode()
+            self.offsets.append(len(self.data))
+        return number
+
+
+def _columns(prefix, spec, rows, strings):
+    sections = {}
+    for field, kind in spec.items():
+        if kind == 's':
+            values = [strings.add(row[field]) for row in rows]
+            sections[f'{prefix}.{field}'] = array('I', values)
+        else:
+            sections[f'{prefix}.{field}'] = array(
+                kind, [row[field] for row in rows])
+    return sections
+
+
+def _check_fields(rows, spec, extra=()):
+    # A field added to a schema has to get a column here too, or the
+    # snapshot would quietly serve responses without it
+    for row in rows[:1]:
+        missing = set(row) - set(spec) - set(extra)
+        if missing:
+            raise ValueError(f"no snapshot column for {sorted(missing)}")
+
+
+def watermark(session):
+    # Latest change log entry that touched the catalog; one index lookup
+    # per entity
+    return max(session.execute(
+        select(func.max(ChangeLog.id)).where(ChangeLog.entity == entity))
+        .scalar() or 0 for entity in CATALOG_ENTITIES)
+
+
+def build(session, path):
+    mark = watermark(session)
+    # Soft deleted rows are left out by the loader criteria
+    recipes = recipe_rows_schema.dump(session.execute(
+        select(Recipe).order_by(Recipe.id)).scalars())
+    ingredients = ingredient_rows_schema.dump(session.execute(
+        select(Ingredient).order_by(Ingredient.id)).scalars())
+    lines = line_rows_schema.dump(session.execute(
+        select(RecipeIngredient).order_by(RecipeIngredient.recipe_id,
+                                          RecipeIngredient.ingredient_id))
+        .scalars())
+    _check_fields(recipes, RECIPE_COLUMNS)
+    _check_fields(ingredients, INGREDIENT_COLUMNS)
+    _check_fields(lines, LINE_COLUMNS, ('recipe_id', 'ingredient_id'))
+
+    ingredient_rows = {row['id']: number
+                       for number, row in enumerate(ingredients)}
+    recipe_rows = {row['id']: number for number, row in enumerate(recipes)}
+    lines = [line for line in lines
+             if line['recipe_id'] in recipe_rows and
+             line['ingredient_id'] in ingredient_rows]
+    line_starts = array('I', [0] * (len(recipes) + 1))
+    for line in lines:
+        line_starts[recipe_rows[line['recipe_id']] + 1] += 1
+    for number in range(len(recipes)):
+        line_starts[number + 1] += line_starts[number]
+
+    # Dense id -> row index; ids come from autoincrement, so it stays
+    # close to the number of recipes
+    index = array('I', [NONE]) * (max(recipe_rows, default=0) + 1)
+    for recipe_id, number in recipe_rows.items():
+        index[recipe_id] = number
+
+    strings = StringTable()
+    sections = {'recipe.index': index, 'recipe.lines': line_starts,
+                'line.ingredient': array('I', [
+                    ingredient_rows[line['ingredient_id']]
+                    for line in lines])}
+    sections.update(_columns('recipe', RECIPE_COLUMNS, recipes, strings))
+    sections.update(_columns('ingredient', INGREDIENT_COLUMNS, ingredients,
+                             strings))
+    sections.update(_columns('line', LINE_COLUMNS, lines, strings))
+    sections['strings.offsets'] = strings.offsets
+    sections['strings.data'] = array('B', strings.data)
+    _write(path, mark, sections)
+    return mark
+
+
+def _write(path, mark, sections):
+    offset = HEADER.size + SECTION.size * len(sections)
+    directory = []
+    for name, values in sections.items():
+        offset += -offset % 8
+        directory.append(SECTION.pack(name.encode(), values.typecode.encode(),
+                                      offset, len(values)))
+        offset += len(values) * values.itemsize
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, sys.byteorder[0].encode(), mark,
+                            time.time(), len(sections)))
+        f.write(b''.join(directory))
+        for values in sections.values():
+            f.write(b'\0' * (-f.tell() % 8))
+            values.tofile(f)
+    os.replace(tmp, path)
+
+
+class Snapshot:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        magic, byteorder, self.watermark, self.built_at, count = \
+            HEADER.unpack_from(view)
+        if magic != MAGIC or byteorder != sys.byteorder[0].encode():
+            raise ValueError(f"{path} is not a catalog snapshot for this "
+                             "machine")
+        self.sections = {}
+        for number in range(count):
+            name, typecode, offset, length = SECTION.unpack_from(
+                view, HEADER.size + SECTION.size * number)
+            typecode = typecode.decode()
+            size = array(typecode).itemsize
+            self.sections[name.rstrip(b'\0').decode()] = (
+                view[offset:offset + length * size].cast(typecode))
+        self.strings = self.sections['strings.data']
+        self.string_offsets = self.sections['strings.offsets']
+        self.recipe_count = len(self.sections['recipe.id'])
+        self.ingredient_count = len(self.sections['ingredient.id'])
+
+    def string(self, number):
+        if number == NONE:
+            return None
+        offsets = self.string_offsets
+        return str(self.strings[offsets[number]:offsets[number + 1]],
+                   'utf-8')
+
+    def _row(self, prefix, spec, number):
+        sections = self.sections
+        row = {}
+        for field, kind in spec.items():
+            value = sections[f'{prefix}.{field}'][number]
+            row[field] = self.string(value) if kind == 's' else value
+        return row
+
+    def ingredient(self, number):
+        row = self._row('ingredient', INGREDIENT_COLUMNS, number)
+        return {field: row[field] for field in INGREDIENT_FIELDS}
+
+    def ingredients(self):
+        return [self.ingredient(number)
+                for number in range(self.ingredient_count)]
+
+    def recipe(self, number):
+        # Shaped like recipe_schema.dump()
+        data = self._row('recipe', RECIPE_COLUMNS, number)
+        starts = self.sections['recipe.lines']
+        ingredients = self.sections['line.ingredient']
+        lines = []
+        for line in range(starts[number], starts[number + 1]):
+            row = self._row('line', LINE_COLUMNS, line)
+            ingredient = self.ingredient(ingredients[line])
+            row['recipe_id'] = data['id']
+            row['ingredient_id'] = ingredient.pop('id')
+            row['ingredient'] = ingredient
+            lines.append({field: row[field] for field in LINE_FIELDS})
+        data['recipe_ingredients'] = lines
+        return {field: data[field] for field in RECIPE_FIELDS}
+
+    def recipes(self):
+        return [self.recipe(number) for number in range(self.recipe_count)]
+
+    def recipe_by_id(self, recipe_id):
+        index = self.sections['recipe.index']
+        if not 0 <= recipe_id < len(index) or index[recipe_id] == NONE:
+            return None
+        return self.recipe(index[recipe_id])
+
+
+class Catalog:
+    # Every worker maps the current file and checks for a newer one every
+    # interval. When the catalog changed, the first worker to take the
+    # file lock rebuilds it and the others pick the new file up.
+    def __init__(self, app, path, interval):
+        self.app = app
+        self.path = path
+        self.interval = interval
+        self.snapshot = None
+        self.reload_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def current(self):
+        if self.interval and self.thread is None:
+            with self.start_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self.run, name='catalog-snapshot',
+                        daemon=True)
+                    self.thread.start()
+        if self.snapshot is None:
+            self.reload()
+        return self.snapshot
+
+    def reload(self):
+        with self.reload_lock:
+            try:
+                inode = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                return
+            if self.snapshot is None or self.snapshot.inode != inode:
+                # Requests holding the old snapshot finish with it; the
+                # mapping goes away with the last reference
+                self.snapshot = Snapshot(self.path)
+
+    def refresh(self, session, force=False):
+        self.reload()
+        mark = watermark(session)
+        if (not force and self.snapshot is not None and
+                self.snapshot.watermark == mark):
+            return False
+        with open(f"{self.path}.lock", 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is building it
+                return False
+            self.reload()
+            if (force or self.snapshot is None or
+                    self.snapshot.watermark != mark):
+                build(session, self.path)
+                self.reload()
+                return True
+        return False
+
+    def run(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    self.refresh(db.session)
+                except (SQLAlchemyError, OSError, ValueError):
+                    current_app.logger.exception(
+                        "Catalog snapshot refresh failed")
+                finally:
+                    db.session.remove()
+            if self.stopped.wait(self.interval):
+                return
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def init_app(app):
+    app.config.setdefault('CATALOG_SNAPSHOT', None)
+    app.config.setdefault('CATALOG_SNAPSHOT_INTERVAL',
+                          0 if app.config.get('TESTING') else 30)
+    if app.config['CATALOG_SNAPSHOT']:
+        app.extensions['catalog'] = Catalog(
+            app, app.config['CATALOG_SNAPSHOT'],
+            app.config['CATALOG_SNAPSHOT_INTERVAL'])
+
+    @app.cli.command('build-catalog')
+    def build_catalog_command():
+        """Export the catalog snapshot now, even if it looks current."""
+        catalog = app.extensions.get('catalog')
+        if catalog is None:
+            raise click.UsageError("CATALOG_SNAPSHOT is not configured")
+        catalog.refresh(db.session, force=True)
+        click.echo(f"Catalog snapshot written to {catalog.path}")
+
+
+def get_snapshot():
+    # None when snapshots are off or not built yet; callers then query
+    catalog = current_app.extensions.get('catalog')
+    return catalog.current() if catalog is not None else None
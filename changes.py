@@ -0,0 +1,180 @@
+from datetime import datetime
+from heapq import merge
+from itertools import islice
+from sqlalchemy import column, event, func, insert, select, tuple_
+from sqlalchemy.orm import Session
+from models import ChangeLog, Ingredient, Recipe, RecipeIngredient
+from models import UserChangeLog, UserRecipe, RecipeSchema, IngredientSchema
+from models import RecipeIngredientSchema, UserRecipeSchema
+from sharding import execute_all
+
+
+# Nested children are synced as entities of their own, so each payload
+# carries only the row itself
+ENTITIES = {
+    'recipe': (Recipe, RecipeSchema(exclude=['recipe_ingredients'])),
+    'ingredient': (Ingredient, IngredientSchema()),
+    'recipe_ingredient': (RecipeIngredient,
+                          RecipeIngredientSchema(exclude=['ingredient'])),
+    'user_recipe': (UserRecipe, UserRecipeSchema(exclude=['recipe'])),
+}
+ENTITY_NAMES = {model: name for name, (model, _) in ENTITIES.items()}
+
+
+def _entry(obj, operation, now):
+    model = type(obj)
+    key = [getattr(obj, column.key)
+           for column in model.__mapper__.primary_key]
+    return {"entity": ENTITY_NAMES[model],
+            "entity_key": ':'.join(str(part) for part in key),
+            "operation": operation,
+            "user_id": obj.user_id if model is UserRecipe else None,
+            "changed_at": now}
+
+
+@event.listens_for(Session, 'after_flush')
+def record_changes(session, flush_context):
+    now = datetime.now()
+    entries = []
+    for obj in session.new | session.dirty:
+        if type(obj) in ENTITY_NAMES and (obj in session.new or
+                                          session.is_modified(obj)):
+            entries.append(_entry(obj, 'upsert', now))
+    for obj in session.deleted:
+        if type(obj) in ENTITY_NAMES:
+            entries.append(_entry(obj, 'delete', now))
+    if entries:
+        connection = session.connection()
+        catalog = [{key: value for key, value in entry.items()
+                    if key != 'user_id'}
+                   for entry in entries if entry['user_id'] is None]
+        if catalog:
+            connection.execute(insert(ChangeLog), catalog)
+        # Per-user changes go to the user's shard, which this flush has
+        # already written to, so the main database is not locked for them
+        user_rows = _number_user_changes(
+            connection, [entry for entry in entries
+                         if entry['user_id'] is not None])
+        if user_rows:
+            connection.execute(insert(UserChangeLog), user_rows)
+        # Kept until the transaction ends for listeners that act on commit
+        session.info.setdefault('committed_changes', []).extend(entries)
+
+
+def _number_user_changes(connection, entries):
+    # The flush holds the shard's write lock, so nobody else can take the
+    # next number in between
+    seqs = {}
+    rows = []
+    for entry in entries:
+        user_id = entry['user_id']
+        if user_id not in seqs:
+            seqs[user_id] = connection.execute(
+                select(func.coalesce(func.max(UserChangeLog.seq), 0))
+                .where(UserChangeLog.user_id == user_id)).scalar()
+        seqs[user_id] += 1
+        rows.append(dict(entry, seq=seqs[user_id]))
+    return rows
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes(session):
+    session.info.pop('committed_changes', None)
+
+
+def latest_change(session):
+    # Shared by every worker, unlike flush events, so in-process indexes
+    # compare it with the change they were last brought up to
+    return session.execute(select(func.max(ChangeLog.id))).scalar() or 0
+
+
+def latest_user_changes(session):
+    # Per-user changes are numbered per user, so the rowid of each shard's
+    # log is what tells whether anything was added to it
+    return tuple(execute_all(session, select(func.max(column('rowid')))
+                             .select_from(UserChangeLog.__table__)))
+
+
+def changed_keys(session, since, until, entities):
+    # Keys of the given entities written between two latest_change() values
+    return session.execute(
+        select(ChangeLog.entity, ChangeLog.entity_key)
+        .where(ChangeLog.id > since, ChangeLog.id <= until,
+               ChangeLog.entity.in_(entities))
+        .distinct()).all()
+
+
+def _load(session, entity, keys):
+    model, schema = ENTITIES[entity]
+    columns = list(model.__mapper__.primary_key)
+    parsed = [tuple(int(part) for part in key.split(':')) for key in keys]
+    if len(columns) == 1:
+        condition = columns[0].in_([key[0] for key in parsed])
+    else:
+        condition = tuple_(*columns).in_(parsed)
+    found = {}
+    for obj in session.execute(select(model).where(condition)).scalars():
+        key = ':'.join(str(getattr(obj, column.key)) for column in columns)
+        found[key] = schema.dump(obj)
+    return found
+
+
+def parse_token(value):
+    # "<change_log id>:<user change seq>"; a bare number is a token from
+    # before any per-user change was seen
+    catalog, _, user = value.partition(':')
+    return int(catalog), int(user or 0)
+
+
+def format_token(catalog, user):
+    return f"{catalog}:{user}"
+
+
+def changes_since(session, since, user_id=None, limit=100):
+    since, user_since = since
+    rows = session.execute(
+        select(ChangeLog).where(ChangeLog.id > since)
+        .order_by(ChangeLog.id).limit(limit + 1)).scalars().all()
+    user_rows = []
+    if user_id is not None:
+        user_rows = session.execute(
+            select(UserChangeLog)
+            .where(UserChangeLog.user_id == user_id,
+                   UserChangeLog.seq > user_since)
+            .order_by(UserChangeLog.seq).limit(limit + 1)).scalars().all()
+    has_more = len(rows) + len(user_rows) > limit
+    # Each log is consumed in its own order, so the token can hold one
+    # position per log
+    page = islice(merge(rows, user_rows, key=lambda row: row.changed_at),
+                  limit)
+
+    # Only the latest change per entity matters to a client that replays
+    # the page, and its payload is the row as it is now
+    latest = {}
+    for position, row in enumerate(page):
+        if isinstance(row, UserChangeLog):
+            user_since = row.seq
+        else:
+            since = row.id
+        latest[(row.entity, row.entity_key)] = (
+            position, row, format_token(since, user_since))
+    upserts = {}
+    for entity in ENTITIES:
+        keys = [key for (name, key), (_, row, _) in latest.items()
+                if name == entity and row.operation == 'upsert']
+        if keys:
+            upserts[entity] = _load(session, entity, keys)
+
+    changes = []
+    for (entity, key), (_, row, token) in sorted(latest.items(),
+                                                 key=lambda e: e[1][0]):
+        data = upserts.get(entity, {}).get(key)
+        operation = row.operation if data is not None else 'delete'
+        changes.append({"token": token,
+                        "entity": entity,
+                        "key": [int(part) for part in key.split(':')],
+                        "operation": operation,
+                        "data": data})
+    return {"changes": changes,
+            "next": format_token(since, user_since),
+            "has_more": has_more}
@@ -0,0 +1,117 @@
+import gzip
+import zlib
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional
+    zstandard = None
+
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/event-stream',
+                          'application/msgpack', 'text/html', 'text/plain'}
+
+
+class GzipStream:
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, chunk):
+        return (self.compressor.compress(chunk) +
+                self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliStream:
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, chunk):
+        return self.compressor.process(chunk) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class ZstdStream:
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, chunk):
+        return (self.compressor.compress(chunk) +
+                self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+def _encoders():
+    encoders = {}
+    if zstandard is not None:
+        encoders['zstd'] = (
+            lambda data, level: zstandard.ZstdCompressor(
+                level=level).compress(data), ZstdStream)
+    if brotli is not None:
+        encoders['br'] = (
+            lambda data, level: brotli.compress(data,
+                                                quality=min(level, 11)),
+            BrotliStream)
+    encoders['gzip'] = (
+        lambda data, level: gzip.compress(data, compresslevel=level, mtime=0),
+        GzipStream)
+    return encoders
+
+
+ENCODERS = _encoders()
+
+
+def _stream(chunks, stream):
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = stream.compress(chunk)
+        if data:
+            yield data
+    yield stream.finish()
+
+
+def compress_response(response):
+    response.vary.add('Accept-Encoding')
+    if (response.direct_passthrough or
+            'Content-Encoding' in response.headers or
+            response.status_code < 200 or response.status_code in (204, 304)
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    encoding = request.accept_encodings.best_match(ENCODERS)
+    if encoding is None:
+        return response
+    compress, stream_class = ENCODERS[encoding]
+    level = current_app.config['COMPRESS_LEVEL']
+
+    if response.is_streamed:
+        response.response = _stream(response.response, stream_class(level))
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compress(data, level))
+    response.headers['Content-Encoding'] = encoding
+    # The body bytes changed, so a strong validator no longer applies
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.after_request(compress_response)
@@ -1,41 +1,109 @@
+import gc
+import importlib
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
-from flask_migrate import Migrate
 from flask_jwt_extended import JWTManager
 
 db = SQLAlchemy()
 ma = Marshmallow()
-migrate = Migrate()
 jwt = JWTManager()
 
+BLUEPRINTS = {
+    'recipes': 'api.recipes:recipes_bp',
+    'ingredients': 'api.ingredients:ingredients_bp',
+    'auth': 'api.auth:auth_bp',
+    'users': 'api.users:users_bp',
+    'health': 'api.health:health_bp',
+    'sync': 'api.sync:sync_bp',
+    'stream': 'api.stream:stream_bp',
+}
 
-def create_app(config_type='development'):
+
+def create_app(config_type='development', config=None):
     app = Flask(__name__)
 
     if config_type == 'testing':
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         app.config['TESTING'] = True
+        app.config['MIGRATIONS'] = False
 
     else:
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///recipes.db'
+        app.config['MIGRATIONS'] = True
 
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['JWT_SECRET_KEY'] = "super-secret"  # Change
+    app.config.update(config or {})
 
     db.init_app(app)
     ma.init_app(app)
-    migrate.init_app(app, db)
     jwt.init_app(app)
 
-    from api.recipes import recipes_bp
-    from api.ingredients import ingredients_bp
-    from api.auth import auth_bp
-    from api.users import users_bp
+    if app.config['MIGRATIONS']:
+        # Flask-Migrate pulls in alembic, a large share of startup time,
+        # and only the `flask db` commands need it
+        from flask_migrate import Migrate
+        from sharding import MigrationTarget
+        Migrate(app, MigrationTarget(db),
+                include_object=MigrationTarget.include_object)
+
+    import sharding
+    import similarity
+    import autocomplete
+    import dedup
+    import group_commit
+    import counters
+    import stats
+    import changes  # noqa: F401 (registers the change log listener)
+    import pubsub
+    import compression
+    import formats
+    import idempotency
+    import revisions
+    import softdelete
+    import queries
+    import profiler
+    import tokens
+    import catalog
+    sharding.init_app(app)
+    similarity.init_app(app)
+    autocomplete.init_app(app)
+    dedup.init_app(app)
+    group_commit.init_app(app)
+    counters.init_app(app)
+    stats.init_app(app)
+    pubsub.init_app(app)
+    compression.init_app(app)
+    formats.init_app(app)
+    idempotency.init_app(app)
+    revisions.init_app(app)
+    softdelete.init_app(app)
+    queries.init_app(app)
+    profiler.init_app(app)
+    tokens.init_app(app)
+    catalog.init_app(app)
+
+    # Blueprint modules are only imported when enabled, so a worker that
+    # serves a subset of the API does not pay for the rest
+    blueprints = app.config.get('BLUEPRINTS', BLUEPRINTS)
+    for name in blueprints:
+        module_name, blueprint_name = BLUEPRINTS[name].split(':')
+        module = importlib.import_module(module_name)
+        app.register_blueprint(getattr(module, blueprint_name))
+
+    return app
+
 
-    app.register_blueprint(recipes_bp)
-    app.register_blueprint(ingredients_bp)
-    app.register_blueprint(auth_bp)
-    app.register_blueprint(users_bp)
+def create_preloaded_app(config_type='development', config=None):
+    # For prefork servers: build everything that is shared and read-only
+    # once in the parent, then freeze it out of the garbage collector so
+    # forked workers keep sharing those pages copy-on-write
+    from sqlalchemy.orm import configure_mappers
+    from models import warm_schemas
 
+    app = create_app(config_type, config)
+    configure_mappers()
+    warm_schemas()
+    gc.freeze()
     return app
@@ -0,0 +1,85 @@
+from collections import Counter
+import click
+from sqlalchemy import delete, event, func, insert, select, update
+from sqlalchemy.dialects.sqlite import insert as upsert
+from sqlalchemy.orm import Session
+from config import db
+from models import Recipe, RecipeIngredient, UserRecipe, UserStats
+from sharding import shard_execution_options
+
+
+def _bump(session, model, column, deltas):
+    for row_id, delta in deltas.items():
+        if not delta:
+            continue
+        session.connection().execute(
+            update(model.__table__).where(model.__table__.c.id == row_id)
+            .values({column: getattr(model.__table__.c, column) + delta}))
+        cached = session.identity_map.get((model, (row_id,), None))
+        if cached is not None:
+            session.expire(cached, [column])
+
+
+def _bump_collections(session, deltas):
+    # A user's first collected recipe creates the row
+    table = UserStats.__table__
+    for user_id, delta in deltas.items():
+        if not delta:
+            continue
+        statement = upsert(table).values(user_id=user_id,
+                                         collection_count=delta)
+        session.connection().execute(statement.on_conflict_do_update(
+            index_elements=[table.c.user_id],
+            set_={"collection_count": table.c.collection_count + delta}))
+        cached = session.identity_map.get((UserStats, (user_id,), None))
+        if cached is not None:
+            session.expire(cached, ['collection_count'])
+
+
+@event.listens_for(Session, 'before_flush')
+def maintain_counters(session, flush_context, instances):
+    ingredient_deltas = Counter()
+    collection_deltas = Counter()
+    for obj in session.new:
+        if isinstance(obj, RecipeIngredient):
+            ingredient_deltas[obj.recipe_id] += 1
+        elif isinstance(obj, UserRecipe):
+            collection_deltas[obj.user_id] += 1
+    for obj in session.deleted:
+        if isinstance(obj, RecipeIngredient):
+            ingredient_deltas[obj.recipe_id] -= 1
+        elif isinstance(obj, UserRecipe):
+            collection_deltas[obj.user_id] -= 1
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Recipe):
+            obj.total_time = (obj.prep_time or 0) + (obj.cook_time or 0)
+    _bump(session, Recipe, 'ingredient_count', ingredient_deltas)
+    _bump_collections(session, collection_deltas)
+
+
+def refresh_counters():
+    ingredient_counts = (select(func.count())
+                         .where(RecipeIngredient.recipe_id == Recipe.id)
+                         .scalar_subquery())
+    db.session.execute(update(Recipe).values(
+        ingredient_count=ingredient_counts,
+        total_time=Recipe.prep_time + Recipe.cook_time))
+    # Each user's rows and counters live in the same shard
+    for options in shard_execution_options():
+        db.session.execute(delete(UserStats.__table__),
+                           execution_options=options)
+        db.session.execute(
+            insert(UserStats.__table__).from_select(
+                ['user_id', 'collection_count'],
+                select(UserRecipe.user_id, func.count())
+                .group_by(UserRecipe.user_id)),
+            execution_options=options)
+    db.session.commit()
+
+
+def init_app(app):
+    @app.cli.command('refresh-counters')
+    def refresh_counters_command():
+        """Recompute denormalized recipe and collection counters."""
+        refresh_counters()
+        click.echo("Counters refreshed")
@@ -0,0 +1,284 @@
+import hashlib
+import re
+import threading
+import time
+from array import array
+from collections import defaultdict
+from flask import current_app, has_app_context
+from sqlalchemy import delete, event, inspect, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from changes import changed_keys, latest_change
+from models import Ingredient, Recipe, RecipeIngredient, RecipeSignature
+
+
+NUM_PERM = 128
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def text_features(name, instructions):
+    # Name and instructions become overlapping word shingles, so case,
+    # punctuation and small edits only change a few of them
+    words = WORD_PATTERN.findall(f"{name} {instructions or ''}".lower())
+    return {'w:' + ' '.join(words[i:i + SHINGLE_SIZE])
+            for i in range(max(len(words) - SHINGLE_SIZE, 0) + 1)}
+
+
+def features(name, instructions, ingredient_names):
+    # Ingredient names count as whole tokens
+    tokens = {'i:' + ' '.join(WORD_PATTERN.findall(ingredient.lower()))
+              for ingredient in ingredient_names}
+    return tokens | text_features(name, instructions)
+
+
+def signature(tokens):
+    # One extendable-output hash per token supplies all NUM_PERM 32-bit
+    # hash values at once, and the column-wise minimum is the signature
+    columns = [array('I', hashlib.shake_128(token.encode())
+                     .digest(NUM_PERM * 4))
+               for token in tokens]
+    return list(map(min, zip(*columns)))
+
+
+def similarity(first, second):
+    return sum(a == b for a, b in zip(first, second)) / NUM_PERM
+
+
+class Bands:
+    # Locality sensitive hashing: a signature is cut into bands and two
+    # recipes become candidates when any band matches exactly, so a lookup
+    # touches BANDS buckets instead of every stored signature
+    def __init__(self):
+        self.signatures = {}
+        self.buckets = defaultdict(set)
+
+    @staticmethod
+    def _bands(values):
+        return [(band, tuple(values[band * ROWS:(band + 1) * ROWS]))
+                for band in range(BANDS)]
+
+    def add(self, recipe_id, values):
+        self.remove(recipe_id)
+        self.signatures[recipe_id] = values
+        for key in self._bands(values):
+            self.buckets[key].add(recipe_id)
+
+    def remove(self, recipe_id):
+        values = self.signatures.pop(recipe_id, None)
+        if values is None:
+            return
+        for key in self._bands(values):
+            self.buckets[key].discard(recipe_id)
+            if not self.buckets[key]:
+                del self.buckets[key]
+
+    def find(self, values, threshold, limit=10, exclude=None):
+        candidates = set()
+        for key in self._bands(values):
+            candidates |= self.buckets.get(key, set())
+        candidates.discard(exclude)
+        scored = [(recipe_id, similarity(values, self.signatures[recipe_id]))
+                  for recipe_id in candidates]
+        ranked = sorted((s for s in scored if s[1] >= threshold),
+                        key=lambda s: (-s[1], s[0]))
+        return ranked[:limit]
+
+
+class DuplicateIndex:
+    # Full signatures find duplicates among stored recipes; text ones let
+    # an import, which has no ingredients yet, be compared like for like.
+    # Signatures written by other workers are caught up from the shared
+    # change log, checked at most every sync_interval seconds. Request
+    # threads share one index, so everything that touches it holds the
+    # lock.
+    def __init__(self, sync_interval=0):
+        self.recipes = Bands()
+        self.texts = Bands()
+        self.loaded = False
+        self.sync_interval = sync_interval
+        self.seen_change = 0
+        self.synced_at = 0
+        self.lock = threading.RLock()
+
+    def sync(self, session):
+        with self.lock:
+            if not self.loaded:
+                self.load(session)
+            else:
+                self.catch_up(session)
+
+    def load(self, session):
+        with self.lock:
+            self.recipes = Bands()
+            self.texts = Bands()
+            self.seen_change = latest_change(session)
+            for row in session.execute(select(RecipeSignature)).scalars():
+                self.add(row.recipe_id, unpack(row))
+            self.synced_at = time.monotonic()
+            self.loaded = True
+
+    def catch_up(self, session):
+        with self.lock:
+            if time.monotonic() - self.synced_at < self.sync_interval:
+                return
+            self.synced_at = time.monotonic()
+            change = latest_change(session)
+            if change <= self.seen_change:
+                return
+            recipe_ids = set()
+            renamed = set()
+            for entity, key in changed_keys(
+                    session, self.seen_change, change,
+                    ['recipe', 'recipe_ingredient', 'ingredient']):
+                if entity == 'ingredient':
+                    renamed.add(int(key))
+                else:
+                    recipe_ids.add(int(key.split(':')[0]))
+            if renamed:
+                recipe_ids.update(session.execute(
+                    select(RecipeIngredient.recipe_id)
+                    .where(RecipeIngredient.ingredient_id.in_(renamed)))
+                    .scalars())
+            rows = session.execute(
+                select(RecipeSignature)
+                .where(RecipeSignature.recipe_id.in_(recipe_ids))
+            ).scalars().all()
+            for row in rows:
+                self.add(row.recipe_id, unpack(row))
+            # Deleted recipes lose their signature in the same transaction
+            for recipe_id in recipe_ids - {row.recipe_id for row in rows}:
+                self.remove(recipe_id)
+            self.seen_change = change
+
+    def add(self, recipe_id, values):
+        full, text = values
+        with self.lock:
+            self.recipes.add(recipe_id, full)
+            self.texts.add(recipe_id, text)
+
+    def remove(self, recipe_id):
+        with self.lock:
+            self.recipes.remove(recipe_id)
+            self.texts.remove(recipe_id)
+
+    # Lookups hold the lock too: a bucket set changing while it is read
+    # would raise
+    def find_text(self, values, threshold, limit=10):
+        with self.lock:
+            return self.texts.find(values, threshold, limit)
+
+    def duplicates(self, recipe_id, threshold, limit=10):
+        with self.lock:
+            values = self.recipes.signatures.get(recipe_id)
+            if values is None:
+                return []
+            return self.recipes.find(values, threshold, limit,
+                                     exclude=recipe_id)
+
+
+def unpack(row):
+    return (array('I', row.signature).tolist(),
+            array('I', row.text_signature).tolist())
+
+
+def init_app(app):
+    app.config.setdefault('DEDUP_THRESHOLD', 0.8)
+    app.config.setdefault('DEDUP_SYNC_INTERVAL',
+                          0 if app.config.get('TESTING') else 1)
+    app.extensions['duplicate_index'] = DuplicateIndex(
+        app.config['DEDUP_SYNC_INTERVAL'])
+
+
+def get_index(session):
+    index = current_app.extensions['duplicate_index']
+    index.sync(session)
+    return index
+
+
+def _recipe_signatures(connection, recipe_ids):
+    ingredient_names = defaultdict(list)
+    for recipe_id, name in connection.execute(
+            select(RecipeIngredient.recipe_id, Ingredient.name)
+            .join(Ingredient)
+            .where(RecipeIngredient.recipe_id.in_(recipe_ids))):
+        ingredient_names[recipe_id].append(name)
+    return {recipe_id: (signature(features(name, instructions,
+                                           ingredient_names[recipe_id])),
+                        signature(text_features(name, instructions)))
+            for recipe_id, name, instructions in connection.execute(
+                select(Recipe.id, Recipe.name, Recipe.instructions)
+                .where(Recipe.id.in_(recipe_ids)))}
+
+
+# Signatures are rewritten in the same transaction as the rows they cover;
+# the in-memory index only picks them up once that transaction commits
+@event.listens_for(Session, 'after_flush')
+def update_signatures(session, flush_context):
+    changed = set()
+    renamed = set()
+    removed = set()
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Recipe) and obj.deleted_at is not None:
+            removed.add(obj.id)
+        elif isinstance(obj, Recipe) and (obj in session.new or
+                                          session.is_modified(obj)):
+            changed.add(obj.id)
+        elif isinstance(obj, RecipeIngredient):
+            changed.add(obj.recipe_id)
+        elif (isinstance(obj, Ingredient) and obj not in session.new and
+              inspect(obj).attrs.name.history.has_changes()):
+            renamed.add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Recipe):
+            removed.add(obj.id)
+        elif isinstance(obj, RecipeIngredient):
+            changed.add(obj.recipe_id)
+    if not changed | renamed | removed:
+        return
+
+    connection = session.connection()
+    if renamed:
+        changed.update(connection.execute(
+            select(RecipeIngredient.recipe_id)
+            .where(RecipeIngredient.ingredient_id.in_(renamed))).scalars())
+    changed -= removed
+    pending = session.info.setdefault('duplicate_index_changes', [])
+    if changed:
+        signatures = _recipe_signatures(connection, changed)
+        statement = insert(RecipeSignature).values([
+            {"recipe_id": recipe_id,
+             "signature": array('I', full).tobytes(),
+             "text_signature": array('I', text).tobytes()}
+            for recipe_id, (full, text) in signatures.items()])
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=['recipe_id'],
+            set_={"signature": statement.excluded.signature,
+                  "text_signature": statement.excluded.text_signature}))
+        pending.extend(signatures.items())
+    if removed:
+        connection.execute(delete(RecipeSignature).where(
+            RecipeSignature.recipe_id.in_(removed)))
+        pending.extend((recipe_id, None) for recipe_id in removed)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_signature_changes(session):
+    pending = session.info.pop('duplicate_index_changes', [])
+    if not pending or not has_app_context():
+        return
+    index = current_app.extensions.get('duplicate_index')
+    if index is None or not index.loaded:
+        return
+    for recipe_id, values in pending:
+        if values is None:
+            index.remove(recipe_id)
+        else:
+            index.add(recipe_id, values)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_signature_changes(session):
+    session.info.pop('duplicate_index_changes', None)
@@ -0,0 +1,114 @@
+from flask import Request, has_request_context, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import BadRequest, UnsupportedMediaType
+
+try:
+    import msgpack
+except ImportError:  # optional
+    msgpack = None
+
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+
+def _columnar(records, lookups, tables):
+    fields = []
+    for record in records:
+        for key in record:
+            if key not in fields:
+                fields.append(key)
+    rows = []
+    for record in records:
+        row = []
+        for field in fields:
+            value = record.get(field)
+            if field in lookups and isinstance(value, dict):
+                value = _lookup_index(tables, field, value)
+            elif (isinstance(value, list) and value and
+                  all(isinstance(item, dict) for item in value)):
+                value = _columnar(value, lookups, tables)
+            row.append(value)
+        rows.append(row)
+    return {"fields": fields, "rows": rows}
+
+
+def _lookup_index(tables, name, value):
+    table = tables.setdefault(name, {"fields": list(value), "rows": [],
+                                     "index": {}})
+    key = tuple(value.get(field) for field in table['fields'])
+    if key not in table['index']:
+        table['index'][key] = len(table['rows'])
+        table['rows'].append(list(key))
+    return table['index'][key]
+
+
+def to_columnar(records, lookups=('ingredient',)):
+    # Field names are emitted once per list, nested lists become nested
+    # column sets, and objects under a lookup key are replaced by their
+    # position in a shared, deduplicated table
+    tables = {}
+    data = _columnar(records, set(lookups), tables)
+    data['lookups'] = {name: {"fields": table['fields'],
+                              "rows": table['rows']}
+                       for name, table in tables.items()}
+    return data
+
+
+def render_list(records):
+    if request.args.get('format') == 'columnar':
+        return jsonify(to_columnar(records))
+    return jsonify(records)
+
+
+def wants_msgpack():
+    if msgpack is None or not has_request_context():
+        return False
+    best = request.accept_mimetypes.best_match(
+        ['application/json', MSGPACK_MIMETYPE])
+    return best == MSGPACK_MIMETYPE
+
+
+class NegotiatingJSONProvider(DefaultJSONProvider):
+    # Every handler and error handler goes through jsonify, so answering
+    # here serves MessagePack from the same dumped dicts without a JSON
+    # round trip
+    def response(self, *args, **kwargs):
+        if wants_msgpack():
+            obj = self._prepare_response_obj(args, kwargs)
+            response = self._app.response_class(
+                msgpack.packb(obj, default=self.default),
+                mimetype=MSGPACK_MIMETYPE)
+        else:
+            response = super().response(*args, **kwargs)
+        if msgpack is not None:
+            response.vary.add('Accept')
+        return response
+
+
+class NegotiatingRequest(Request):
+    # Write handlers read bodies with get_json(), so MessagePack bodies
+    # are decoded there and the handlers stay format agnostic
+    def get_json(self, force=False, silent=False, cache=True):
+        if self.mimetype != MSGPACK_MIMETYPE:
+            return super().get_json(force=force, silent=silent, cache=cache)
+        if msgpack is None:
+            if silent:
+                return None
+            raise UnsupportedMediaType(
+                "MessagePack request bodies are not supported")
+        if cache and hasattr(self, '_cached_msgpack'):
+            return self._cached_msgpack
+        try:
+            data = msgpack.unpackb(self.get_data(cache=cache))
+        except ValueError:
+            if silent:
+                return None
+            raise BadRequest("Failed to decode MessagePack body")
+        if cache:
+            self._cached_msgpack = data
+        return data
+
+
+def init_app(app):
+    app.json = NegotiatingJSONProvider(app)
+    app.request_class = NegotiatingRequest
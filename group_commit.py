@@ -0,0 +1,180 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from flask import current_app
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from config import db
+from sharding import use_shard
+
+
+class WriteJob:
+    # Column values captured from a request session. Only column
+    # attributes are carried over, which covers every write handler since
+    # they all set foreign keys rather than relationships.
+    def __init__(self, new=(), dirty=(), deleted=(), shard=None):
+        self.new = list(new)
+        self.dirty = list(dirty)
+        self.deleted = list(deleted)
+        self.shard = shard
+        self.future = Future()
+
+    @classmethod
+    def from_session(cls, session):
+        return cls(
+            new=[(obj, type(obj), cls.values(obj, changed_only=False))
+                 for obj in session.new],
+            dirty=[(type(obj), inspect(obj).identity,
+                    cls.values(obj, changed_only=True))
+                   for obj in session.dirty if session.is_modified(obj)],
+            deleted=[(type(obj), inspect(obj).identity)
+                     for obj in session.deleted],
+            shard=session.info.get('user_shard'))
+
+    @staticmethod
+    def values(obj, changed_only):
+        state = inspect(obj)
+        values = {}
+        for attr in state.mapper.column_attrs:
+            if changed_only:
+                if not state.attrs[attr.key].history.has_changes():
+                    continue
+            elif attr.key not in state.dict:
+                continue
+            values[attr.key] = state.dict[attr.key]
+        return values
+
+    def apply(self, session):
+        use_shard(session, self.shard)
+        created = []
+        for _, model, values in self.new:
+            obj = model(**values)
+            session.add(obj)
+            created.append(obj)
+        for model, identity, values in self.dirty:
+            obj = session.get(model, identity)
+            for key, value in values.items():
+                setattr(obj, key, value)
+        for model, identity in self.deleted:
+            obj = session.get(model, identity)
+            if obj is not None:
+                session.delete(obj)
+        session.flush()
+        return [inspect(obj).identity for obj in created]
+
+
+class GroupCommitter:
+    def __init__(self, app, window, max_batch):
+        self.app = app
+        self.window = window
+        self.max_batch = max_batch
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='group-commit',
+                                       daemon=True)
+        self.thread.start()
+
+    def submit(self, job):
+        self.jobs.put(job)
+        return job.future
+
+    def stop(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                batch = [job]
+                deadline = time.monotonic() + self.window
+                while len(batch) < self.max_batch:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        job = self.jobs.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        self.jobs.put(None)
+                        break
+                    batch.append(job)
+                self.write(batch)
+            db.session.remove()
+
+    def write(self, batch):
+        # Each request gets its own savepoint so one failing write only
+        # rolls back itself; the batch shares a single commit and fsync
+        applied = []
+        for job in batch:
+            try:
+                with db.session.begin_nested():
+                    applied.append((job, job.apply(db.session)))
+            except Exception as err:
+                job.future.set_exception(err)
+        try:
+            db.session.commit()
+        except Exception as err:
+            db.session.rollback()
+            for job, _ in applied:
+                job.future.set_exception(err)
+            return
+        for job, identities in applied:
+            job.future.set_result(identities)
+
+
+def init_app(app):
+    app.config.setdefault('GROUP_COMMIT', False)
+    app.config.setdefault('GROUP_COMMIT_WINDOW_MS', 2)
+    app.config.setdefault('GROUP_COMMIT_MAX_BATCH', 64)
+
+    @app.before_request
+    def disable_autoflush():
+        # Pending rows have to stay in session.new until commit_session()
+        # hands them to the writer thread
+        if app.config['GROUP_COMMIT']:
+            db.session.autoflush = False
+
+
+_start_lock = threading.Lock()
+
+
+def get_committer(app):
+    committer = app.extensions.get('group_commit')
+    if committer is None:
+        with _start_lock:
+            committer = app.extensions.get('group_commit')
+            if committer is None:
+                committer = GroupCommitter(
+                    app, app.config['GROUP_COMMIT_WINDOW_MS'] / 1000,
+                    app.config['GROUP_COMMIT_MAX_BATCH'])
+                app.extensions['group_commit'] = committer
+    return committer
+
+
+def stop(app):
+    committer = app.extensions.pop('group_commit', None)
+    if committer is not None:
+        committer.stop()
+
+
+def commit_session():
+    app = current_app._get_current_object()
+    if not app.config['GROUP_COMMIT']:
+        db.session.commit()
+        return
+    session = db.session
+    job = WriteJob.from_session(session)
+    # Release the request's connection before waiting so the writer
+    # thread never queues behind this request's own read transaction
+    session.rollback()
+    identities = get_committer(app).submit(job).result()
+    for (obj, model, _), identity in zip(job.new, identities):
+        for column, value in zip(inspect(model).primary_key, identity):
+            setattr(obj, inspect(model).get_property_by_column(column).key,
+                    value)
+        make_transient_to_detached(obj)
+        session.add(obj)
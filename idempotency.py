@@ -0,0 +1,209 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import current_app, jsonify, make_response, request
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from config import db
+from formats import wants_msgpack
+from models import IdempotencyRecord
+
+
+IN_PROGRESS = object()
+
+
+class Record:
+    __slots__ = ('fingerprint', 'status', 'mimetype', 'body', 'created_at')
+
+    def __init__(self, fingerprint, status, mimetype, body, created_at):
+        self.fingerprint = fingerprint
+        self.status = status
+        self.mimetype = mimetype
+        self.body = body
+        self.created_at = created_at
+
+
+class IdempotencyStore:
+    # Finished responses are kept in the idempotency_key table, shared by
+    # every worker, with an LRU in front so a retry is usually answered
+    # without a query. Requests still running are claimed by a row with a
+    # NULL status; duplicates in this process wait for the owner, those
+    # in another process get a 409 and retry.
+    def __init__(self, size, ttl, lock_timeout):
+        self.size = size
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.cache = OrderedDict()
+        self.running = {}
+        self.lock = threading.Lock()
+
+    def _cached(self, key, now):
+        record = self.cache.get(key)
+        if record is None:
+            return None
+        if record.created_at < now - self.ttl:
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return record
+
+    def _remember(self, key, record):
+        self.cache[key] = record
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    def begin(self, key, fingerprint, wait):
+        # Returns None when the caller owns the key and has to run the
+        # request, otherwise the stored Record or IN_PROGRESS
+        now = datetime.now()
+        with self.lock:
+            record = self._cached(key, now)
+            if record is not None:
+                return record
+            done = self.running.get(key)
+            if done is None:
+                self.running[key] = threading.Event()
+        if done is not None:
+            done.wait(wait)
+            with self.lock:
+                return self._cached(key, datetime.now()) or IN_PROGRESS
+        try:
+            record = self._claim(key, fingerprint, now)
+        except Exception:
+            self._release(key)
+            raise
+        if record is not None:
+            if record is not IN_PROGRESS:
+                with self.lock:
+                    self._remember(key, record)
+            self._release(key)
+        return record
+
+    def _claim(self, key, fingerprint, now):
+        table = IdempotencyRecord.__table__
+        condition = (table.c.scope == key[0]) & (table.c.key == key[1])
+        with db.engine.begin() as connection:
+            row = connection.execute(select(table).where(condition)).first()
+            if row is not None and row.created_at >= now - self.ttl:
+                if row.status is not None:
+                    return Record(row.fingerprint, row.status, row.mimetype,
+                                  row.body, row.created_at)
+                if row.created_at >= now - self.lock_timeout:
+                    return IN_PROGRESS
+                # The owner died mid-request; take the claim over
+                connection.execute(update(table).where(condition).values(
+                    fingerprint=fingerprint, created_at=now))
+                return None
+            connection.execute(delete(table).where(
+                table.c.created_at < now - self.ttl))
+            try:
+                connection.execute(insert(table).values(
+                    scope=key[0], key=key[1], fingerprint=fingerprint,
+                    created_at=now))
+            except IntegrityError:
+                return IN_PROGRESS
+        return None
+
+    def finish(self, key, fingerprint, response):
+        table = IdempotencyRecord.__table__
+        condition = (table.c.scope == key[0]) & (table.c.key == key[1])
+        try:
+            with db.engine.begin() as connection:
+                if response is None or response.status_code >= 500:
+                    # Server errors are not final; let the retry run again
+                    connection.execute(delete(table).where(condition))
+                    return
+                record = Record(fingerprint, response.status_code,
+                                response.mimetype, response.get_data(),
+                                datetime.now())
+                connection.execute(update(table).where(condition).values(
+                    status=record.status, mimetype=record.mimetype,
+                    body=record.body))
+            with self.lock:
+                self._remember(key, record)
+        finally:
+            self._release(key)
+
+    def _release(self, key):
+        with self.lock:
+            done = self.running.pop(key, None)
+        if done is not None:
+            done.set()
+
+
+def init_app(app):
+    app.config.setdefault('IDEMPOTENCY_CACHE_SIZE', 10000)
+    app.config.setdefault('IDEMPOTENCY_TTL', 24 * 3600)
+    app.config.setdefault('IDEMPOTENCY_LOCK_TIMEOUT', 60)
+    app.config.setdefault('IDEMPOTENCY_WAIT', 10)
+    app.extensions['idempotency'] = IdempotencyStore(
+        app.config['IDEMPOTENCY_CACHE_SIZE'],
+        timedelta(seconds=app.config['IDEMPOTENCY_TTL']),
+        timedelta(seconds=app.config['IDEMPOTENCY_LOCK_TIMEOUT']))
+
+
+def _scope():
+    try:
+        return get_jwt_identity() or ''
+    except RuntimeError:
+        return ''
+
+
+def _fingerprint():
+    digest = hashlib.sha256()
+    digest.update(f"{request.method} {request.full_path}\n".encode())
+    # The stored body is in the negotiated format, so a retry asking for
+    # the other one is a different request, not a replay
+    digest.update(b'msgpack\n' if wants_msgpack() else b'json\n')
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _replay(record):
+    response = current_app.response_class(record.body, status=record.status,
+                                          mimetype=record.mimetype)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    # Goes below @jwt_required so keys are scoped to the caller
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+        if not 0 < len(key) <= 255:
+            return jsonify({"error": "Idempotency-Key must be 1 to 255 "
+                            "characters",
+                            "status": 400}), 400
+        store = current_app.extensions['idempotency']
+        key = (_scope(), key)
+        fingerprint = _fingerprint()
+        record = store.begin(key, fingerprint,
+                             current_app.config['IDEMPOTENCY_WAIT'])
+        if record is IN_PROGRESS:
+            response = jsonify({"error": "A request with this "
+                                "Idempotency-Key is still in progress",
+                                "status": 409})
+            response.status_code = 409
+            response.headers['Retry-After'] = '1'
+            return response
+        if record is not None:
+            if record.fingerprint != fingerprint:
+                return jsonify({"error": "Idempotency-Key was already used "
+                                "for a different request",
+                                "status": 422}), 422
+            return _replay(record)
+
+        response = None
+        try:
+            response = make_response(view(*args, **kwargs))
+            return response
+        finally:
+            store.finish(key, fingerprint, response)
+    return wrapper
@@ -0,0 +1,178 @@
+import heapq
+import random
+import time
+from datetime import timedelta
+from marshmallow import Schema, validate, validates_schema, ValidationError
+from marshmallow.fields import Boolean, Date, Integer, List
+from sqlalchemy import select
+from models import Recipe, RecipeIngredient, UserRecipe
+
+
+INGREDIENT_WEIGHT = 30
+OVERFLOW_PENALTY = 1000
+SHORTLIST_SIZE = 500
+MAX_STALE_TRIALS = 2000
+
+
+class MealPlanRequestSchema(Schema):
+    start_date = Date(required=True)
+    end_date = Date(required=True)
+    meals_per_day = Integer(load_default=1,
+                            validate=validate.Range(min=1, max=5))
+    max_time_per_day = Integer(load_default=None, allow_none=True,
+                               validate=validate.Range(min=1))
+    servings = Integer(load_default=1, validate=validate.Range(min=1))
+    exclude_ingredients = List(Integer(), load_default=list)
+    collected_only = Boolean(load_default=True)
+    time_budget_ms = Integer(load_default=500,
+                             validate=validate.Range(min=10, max=5000))
+
+    @validates_schema
+    def validate_range(self, data, **kwargs):
+        if data['end_date'] < data['start_date']:
+            raise ValidationError("end_date must not be before start_date",
+                                  field_name='end_date')
+        if (data['end_date'] - data['start_date']).days >= 31:
+            raise ValidationError("Date range is limited to 31 days",
+                                  field_name='end_date')
+
+
+mealplan_request_schema = MealPlanRequestSchema()
+
+
+class Candidate:
+    __slots__ = ('id', 'name', 'mask', 'time')
+
+    def __init__(self, recipe_id, name, mask, total_time):
+        self.id = recipe_id
+        self.name = name
+        self.mask = mask
+        self.time = total_time
+
+
+def load_candidates(session, user_id, options):
+    query = select(Recipe.id, Recipe.name, Recipe.prep_time,
+                   Recipe.cook_time).where(
+        Recipe.servings >= options['servings'])
+    if options['collected_only']:
+        query = query.join(UserRecipe).where(UserRecipe.user_id == user_id)
+    if options['max_time_per_day']:
+        query = query.where(Recipe.prep_time + Recipe.cook_time <=
+                            options['max_time_per_day'])
+    recipes = {row.id: row for row in session.execute(query)}
+
+    # Ingredient sets are stored as int bitsets over a dense ingredient
+    # index so set union and size are single integer operations
+    masks = dict.fromkeys(recipes, 0)
+    bits = {}
+    excluded = set(options['exclude_ingredients'])
+    pairs = session.execute(
+        select(RecipeIngredient.recipe_id, RecipeIngredient.ingredient_id)
+        .where(RecipeIngredient.recipe_id.in_(
+            query.with_only_columns(Recipe.id))))
+    for recipe_id, ingredient_id in pairs:
+        if recipe_id not in masks:
+            continue
+        if ingredient_id in excluded:
+            masks[recipe_id] = None
+            continue
+        if masks[recipe_id] is not None:
+            bit = bits.setdefault(ingredient_id, len(bits))
+            masks[recipe_id] |= 1 << bit
+    return [Candidate(recipe_id, row.name, masks[recipe_id],
+                      row.prep_time + row.cook_time)
+            for recipe_id, row in recipes.items()
+            if masks[recipe_id] is not None]
+
+
+def assign_days(plan, days, max_time):
+    # Longest-processing-time first: each recipe goes to the least loaded
+    # day that still has a free meal slot
+    slots = len(plan) // days
+    loads = [[0, day, []] for day in range(days)]
+    for candidate in sorted(plan, key=lambda c: -c.time):
+        load = min((d for d in loads if len(d[2]) < slots),
+                   key=lambda d: (d[0], d[1]))
+        load[0] += candidate.time
+        load[2].append(candidate)
+    overflow = 0
+    if max_time:
+        overflow = sum(max(0, load[0] - max_time) for load in loads)
+    return sorted(loads, key=lambda d: d[1]), overflow
+
+
+def plan_cost(plan, days, max_time):
+    union = 0
+    total_time = 0
+    for candidate in plan:
+        union |= candidate.mask
+        total_time += candidate.time
+    _, overflow = assign_days(plan, days, max_time)
+    return (INGREDIENT_WEIGHT * union.bit_count() + total_time +
+            OVERFLOW_PENALTY * overflow)
+
+
+def solve(candidates, count, days, max_time, time_budget, seed=0):
+    deadline = time.perf_counter() + time_budget
+    pool = heapq.nsmallest(SHORTLIST_SIZE, candidates,
+                           key=lambda c: (INGREDIENT_WEIGHT *
+                                          c.mask.bit_count() + c.time, c.id))
+
+    plan = []
+    union = 0
+    remaining = list(pool)
+    while len(plan) < count:
+        best = min(remaining, key=lambda c: (
+            INGREDIENT_WEIGHT * (c.mask & ~union).bit_count() + c.time,
+            c.id))
+        remaining.remove(best)
+        plan.append(best)
+        union |= best.mask
+
+    cost = plan_cost(plan, days, max_time)
+    if not remaining:
+        return plan
+    rng = random.Random(seed)
+    stale_trials = 0
+    while (stale_trials < MAX_STALE_TRIALS and
+           time.perf_counter() < deadline):
+        stale_trials += 1
+        position = rng.randrange(count)
+        swap_index = rng.randrange(len(remaining))
+        trial = list(plan)
+        trial[position] = remaining[swap_index]
+        trial_cost = plan_cost(trial, days, max_time)
+        if trial_cost < cost:
+            remaining[swap_index] = plan[position]
+            plan, cost = trial, trial_cost
+            stale_trials = 0
+    return plan
+
+
+def generate_meal_plan(session, user_id, options):
+    days = (options['end_date'] - options['start_date']).days + 1
+    count = days * options['meals_per_day']
+    candidates = load_candidates(session, user_id, options)
+    if len(candidates) < count:
+        return None
+    plan = solve(candidates, count, days, options['max_time_per_day'],
+                 options['time_budget_ms'] / 1000)
+    schedule, overflow = assign_days(plan, days,
+                                     options['max_time_per_day'])
+    if overflow:
+        return None
+    union = 0
+    for candidate in plan:
+        union |= candidate.mask
+    return {
+        "start_date": options['start_date'].isoformat(),
+        "end_date": options['end_date'].isoformat(),
+        "days": [{"date": (options['start_date'] +
+                           timedelta(days=day)).isoformat(),
+                  "total_time": load,
+                  "recipes": [{"id": c.id, "name": c.name, "time": c.time}
+                              for c in recipes]}
+                 for load, day, recipes in schedule],
+        "distinct_ingredients": union.bit_count(),
+        "total_time": sum(c.time for c in plan)
+    }
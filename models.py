@@ -1,3 +1,4 @@
+import threading
 from config import db, ma
 from datetime import datetime
 from marshmallow.fields import String, DateTime, Integer, Nested, Email
@@ -5,14 +6,34 @@ from marshmallow import validate, post_load
 from werkzeug.security import generate_password_hash
 
 
+# Placeholder schema for per-user tables; sharding.py translates it to the
+# database that holds the current user's rows
+USER_SHARD_SCHEMA = 'user_shard'
+
+
 class Recipe(db.Model):
+    __table_args__ = (
+        db.Index('ix_recipe_deleted_at', 'deleted_at',
+                 sqlite_where=db.text('deleted_at IS NOT NULL')),
+        # Unique among live rows only, so a soft deleted recipe's name can
+        # be used again before the purger removes it
+        db.Index('uq_recipe_name_live', 'name', unique=True,
+                 sqlite_where=db.text('deleted_at IS NULL')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), index=True, unique=True, nullable=False)
+    name = db.Column(db.String(50), index=True, nullable=False)
     instructions = db.Column(db.Text)
     prep_time = db.Column(db.Integer, index=True, nullable=False)
     cook_time = db.Column(db.Integer, index=True, nullable=False)
     servings = db.Column(db.Integer, index=True, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    # Denormalized, kept current by counters.py
+    ingredient_count = db.Column(db.Integer, default=0, nullable=False)
+    total_time = db.Column(db.Integer, default=0, nullable=False)
+    # Set by a soft delete; the row is hidden from queries until
+    # softdelete.py purges it
+    deleted_at = db.Column(db.DateTime, nullable=True)
 
     recipe_ingredients = db.relationship('RecipeIngredient',
                                          back_populates='recipe')
@@ -20,9 +41,17 @@ class Recipe(db.Model):
 
 
 class Ingredient(db.Model):
+    __table_args__ = (
+        db.Index('ix_ingredient_deleted_at', 'deleted_at',
+                 sqlite_where=db.text('deleted_at IS NOT NULL')),
+        db.Index('uq_ingredient_name_live', 'name', unique=True,
+                 sqlite_where=db.text('deleted_at IS NULL')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(25), index=True, unique=True, nullable=False)
+    name = db.Column(db.String(25), index=True, nullable=False)
     category = db.Column(db.String(20), index=True, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=True)
 
     recipe_ingredients = db.relationship('RecipeIngredient',
                                          back_populates='ingredient')
@@ -37,6 +66,7 @@ class User(db.Model):
     joined_on = db.Column(db.DateTime, default=datetime.now)
 
     collected_recipes = db.relationship('UserRecipe', back_populates='user')
+    pantry_items = db.relationship('Pantry', back_populates='user')
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -44,6 +74,14 @@ class User(db.Model):
 
 class UserRecipe(db.Model):
     __tablename__ = 'user_recipe'
+    __table_args__ = (
+        db.Index('ix_user_recipe_recipe_id_user_id', 'recipe_id', 'user_id'),
+        db.Index('ix_user_recipe_user_id_collected_at', 'user_id',
+                 'collected_at'),
+        db.Index('ix_user_recipe_collected_at_recipe_id', 'collected_at',
+                 'recipe_id'),
+        {'schema': USER_SHARD_SCHEMA},
+    )
 
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id'),
@@ -58,6 +96,10 @@ class UserRecipe(db.Model):
 
 class RecipeIngredient(db.Model):
     __tablename__ = 'recipe_ingredient'
+    __table_args__ = (
+        db.Index('ix_recipe_ingredient_ingredient_id_recipe_id',
+                 'ingredient_id', 'recipe_id'),
+    )
 
     recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id'),
                           primary_key=True)
@@ -72,12 +114,143 @@ class RecipeIngredient(db.Model):
                                  back_populates='recipe_ingredients')
 
 
+class Pantry(db.Model):
+    __tablename__ = 'pantry'
+    __table_args__ = (
+        db.Index('ix_pantry_ingredient_id', 'ingredient_id'),
+        {'schema': USER_SHARD_SCHEMA},
+    )
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    ingredient_id = db.Column(db.Integer, db.ForeignKey('ingredient.id'),
+                              primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    unit = db.Column(db.String(10), nullable=False)
+
+    user = db.relationship('User', back_populates='pantry_items')
+    ingredient = db.relationship('Ingredient')
+
+
+class UserStats(db.Model):
+    __tablename__ = 'user_stats'
+    __table_args__ = {'schema': USER_SHARD_SCHEMA}
+
+    # Denormalized, kept current by counters.py; lives next to the user's
+    # rows so collecting a recipe writes only to the user's shard
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    collection_count = db.Column(db.Integer, default=0, nullable=False)
+
+
+class RecipeStats(db.Model):
+    __tablename__ = 'recipe_stats'
+    __table_args__ = (
+        db.Index('ix_recipe_stats_bucket_recipe_id_views', 'bucket',
+                 'recipe_id', 'views'),
+    )
+
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id'),
+                          primary_key=True)
+    granularity = db.Column(db.String(4), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    views = db.Column(db.Integer, default=0, nullable=False)
+
+
+class RecipeSignature(db.Model):
+    __tablename__ = 'recipe_signature'
+
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id'),
+                          primary_key=True)
+    # MinHash over ingredient names and instruction shingles, see dedup.py
+    signature = db.Column(db.LargeBinary, nullable=False)
+    # The same over name and instructions alone, which is all an import
+    # has to compare when it is checked
+    text_signature = db.Column(db.LargeBinary, nullable=False)
+
+
+class RecipeRevision(db.Model):
+    __tablename__ = 'recipe_revision'
+
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id'),
+                          primary_key=True)
+    revision = db.Column(db.Integer, primary_key=True)
+    changed_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    # Compact JSON, see revisions.py: the change made by this revision and,
+    # every few revisions, the full state after it
+    delta = db.Column(db.Text, nullable=False)
+    snapshot = db.Column(db.Text, nullable=True)
+
+
+class IdempotencyRecord(db.Model):
+    __tablename__ = 'idempotency_key'
+    __table_args__ = (
+        db.Index('ix_idempotency_key_created_at', 'created_at'),
+    )
+
+    # JWT identity of the caller, empty for anonymous requests
+    scope = db.Column(db.String(40), primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    # NULL while the first request with this key is still running
+    status = db.Column(db.Integer, nullable=True)
+    mimetype = db.Column(db.String(60), nullable=True)
+    body = db.Column(db.LargeBinary, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+
+
+class TokenFamily(db.Model):
+    __tablename__ = 'token_family'
+    __table_args__ = (
+        db.Index('ix_token_family_seq', 'seq'),
+        db.Index('ix_token_family_expires_at', 'expires_at'),
+    )
+
+    # One row per login that has rotated or logged out; see tokens.py
+    family = db.Column(db.String(36), primary_key=True)
+    # Only the refresh token of this generation may rotate
+    generation = db.Column(db.Integer, default=0, nullable=False)
+    revoked = db.Column(db.Boolean, default=False, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=True)
+    # Bumped on every write, so workers can sync from the last one seen
+    seq = db.Column(db.Integer, nullable=False)
+
+
+class ChangeLog(db.Model):
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        # Latest change per entity, for the catalog snapshot in catalog.py
+        db.Index('ix_change_log_entity_id', 'entity', 'id'),
+        {'sqlite_autoincrement': True},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_key = db.Column(db.String(40), nullable=False)
+    operation = db.Column(db.String(6), nullable=False)
+    changed_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+
+
+class UserChangeLog(db.Model):
+    __tablename__ = 'user_change_log'
+    __table_args__ = {'schema': USER_SHARD_SCHEMA}
+
+    # Changes to per-user rows, in the user's shard and numbered per user,
+    # so the numbers survive a reshard and only the owner can see them
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_key = db.Column(db.String(40), nullable=False)
+    operation = db.Column(db.String(6), nullable=False)
+    changed_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+
+
 class RecipeSchema(ma.SQLAlchemyAutoSchema):
     name = String(required=True, validate=validate.Length(min=3, max=50))
     prep_time = Integer(required=True, validate=validate.Range(min=0))
     cook_time = Integer(required=True, validate=validate.Range(min=0))
     servings = Integer(required=True, validate=validate.Range(min=1))
-    created_at = DateTime(validate=validate.Equal(datetime.now()))
+    created_at = DateTime(dump_only=True)
+    ingredient_count = Integer(dump_only=True)
+    total_time = Integer(dump_only=True)
 
     recipe_ingredients = Nested('RecipeIngredientSchema', many=True,
                                 dump_only=True)
@@ -86,6 +259,7 @@ class RecipeSchema(ma.SQLAlchemyAutoSchema):
         model = Recipe
         load_instance = True
         sqla_session = db.session
+        exclude = ['deleted_at']
 
 
 class IngredientSchema(ma.SQLAlchemyAutoSchema):
@@ -96,6 +270,7 @@ class IngredientSchema(ma.SQLAlchemyAutoSchema):
         model = Ingredient
         load_instance = True
         sqla_session = db.session
+        exclude = ['deleted_at']
 
 
 class RecipeIngredientSchema(ma.SQLAlchemyAutoSchema):
@@ -127,6 +302,22 @@ class UserRecipeSchema(ma.SQLAlchemyAutoSchema):
         include_fk = True
 
 
+class PantrySchema(ma.SQLAlchemyAutoSchema):
+    quantity = Integer(required=True,
+                       validate=validate.Range(min=0, min_inclusive=False))
+    unit = String(validate=validate.Length(min=3, max=10),
+                  load_default='each')
+
+    ingredient = Nested('IngredientSchema', only=['name', 'category'],
+                        dump_only=True)
+
+    class Meta:
+        model = Pantry
+        load_instance = True
+        sqla_session = db.session
+        include_fk = True
+
+
 class UserSchema(ma.SQLAlchemyAutoSchema):
     username = String(required=True, validate=validate.Length(min=3,
                                                               max=40))
@@ -166,3 +357,40 @@ user_schema = UserSchema()
 
 user_recipe_schema = UserRecipeSchema()
 user_recipes_schema = UserRecipeSchema(many=True)
+
+pantry_item_schema = PantrySchema()
+pantry_items_schema = PantrySchema(many=True)
+
+
+_schema_pool = threading.local()
+
+
+def pooled_schema(schema_class, **options):
+    # load() parks the target instance on the schema object, so the shared
+    # module-level schemas are only safe for dumping. Loads go through one
+    # cached instance per thread and option set instead of a new schema per
+    # request. Pass transient=True when the route has already checked for an
+    # existing row, which skips the primary key lookup load() would do.
+    key = (schema_class, tuple(sorted(options.items())))
+    schemas = _schema_pool.__dict__.setdefault('schemas', {})
+    schema = schemas.get(key)
+    if schema is None:
+        schema = schemas[key] = schema_class(**options)
+    return schema
+
+
+def warm_schemas():
+    # Nested schemas are otherwise built on the first dump that reaches them
+    pending = [recipe_schema, recipes_schema, ingredient_schema,
+               ingredients_schema, recipe_ingredient_schema,
+               recipe_ingredients_schema, user_schema, user_recipe_schema,
+               user_recipes_schema, pantry_item_schema, pantry_items_schema]
+    seen = set()
+    while pending:
+        schema = pending.pop()
+        if id(schema) in seen:
+            continue
+        seen.add(id(schema))
+        for field in schema.fields.values():
+            if isinstance(field, Nested):
+                pending.append(field.schema)
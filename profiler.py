@@ -0,0 +1,154 @@
+import os
+import sys
+import threading
+from collections import Counter
+from flask import current_app, request
+
+MAX_DEPTH = 128
+
+
+def _short_path(filename):
+    # Trims the longest sys.path entry, so frames read as module paths
+    # without leaking where the interpreter lives
+    prefixes = [path for path in sys.path
+                if path and filename.startswith(path + os.sep)]
+    if prefixes:
+        return filename[len(max(prefixes, key=len)) + 1:]
+    return filename
+
+
+class SamplingProfiler:
+    # Wall clock sampling: a thread wakes every interval and records the
+    # stack of each thread that is serving a request, under the route it
+    # serves, so time spent waiting on the database shows up as well
+    def __init__(self, interval, sampling=False):
+        self.interval = interval
+        self.sampling = sampling
+        self.active = {}
+        self.stacks = Counter()
+        self.frames = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def enter(self):
+        self.active[threading.get_ident()] = request.endpoint or '(unmatched)'
+        # Started lazily, so a prefork worker runs its own sampling thread
+        if self.sampling and self.thread is None:
+            self.start()
+
+    def leave(self, *args):
+        self.active.pop(threading.get_ident(), None)
+
+    def start(self, interval=None):
+        with self.start_lock:
+            self.sampling = True
+            self.interval = interval or self.interval
+            if self.thread is None:
+                self.stopped.clear()
+                self.thread = threading.Thread(
+                    target=self.run, name='profiler', daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        with self.start_lock:
+            self.sampling = False
+            self.stopped.set()
+            if self.thread is not None:
+                self.thread.join()
+                self.thread = None
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+
+    def frame(self, code):
+        # One entry per code object; labels are built once, not per sample
+        label = self.frames.get(code)
+        if label is None:
+            label = self.frames[code] = (
+                code.co_name, _short_path(code.co_filename),
+                code.co_firstlineno)
+        return label
+
+    def sample(self):
+        frames = sys._current_frames()
+        samples = []
+        for thread_id, endpoint in list(self.active.items()):
+            frame = frames.get(thread_id)
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                stack.append(self.frame(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                samples.append((endpoint, tuple(reversed(stack))))
+        if samples:
+            with self.lock:
+                self.stacks.update(samples)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def snapshot(self, endpoint=None):
+        with self.lock:
+            return {key: count for key, count in self.stacks.items()
+                    if endpoint is None or key[0] == endpoint}
+
+    def summary(self):
+        endpoints = Counter()
+        for (endpoint, _), count in self.snapshot().items():
+            endpoints[endpoint] += count
+        return {"sampling": self.sampling, "interval": self.interval,
+                "pid": os.getpid(), "endpoints": dict(endpoints)}
+
+    def collapsed(self, endpoint=None):
+        # Brendan Gregg's folded format, one line per distinct stack with
+        # the route as the root frame, ready for flamegraph.pl
+        lines = []
+        for (route, stack), count in sorted(self.snapshot(endpoint).items()):
+            frames = ';'.join(f"{name} ({path}:{line})"
+                              for name, path, line in stack)
+            lines.append(f"{route};{frames} {count}")
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def speedscope(self, endpoint=None):
+        # One sampled profile per route sharing a frame table; weights are
+        # seconds of wall clock time
+        frames = {}
+        profiles = {}
+        for (route, stack), count in sorted(self.snapshot(endpoint).items()):
+            profile = profiles.setdefault(route, {
+                "type": "sampled", "name": route, "unit": "seconds",
+                "startValue": 0, "endValue": 0, "samples": [], "weights": []})
+            profile["samples"].append([frames.setdefault(frame, len(frames))
+                                       for frame in stack])
+            profile["weights"].append(count * self.interval)
+            profile["endValue"] += count * self.interval
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "exporter": "recipes-profiler",
+            "name": endpoint or "all routes",
+            "shared": {"frames": [{"name": name, "file": path, "line": line}
+                                  for name, path, line in frames]},
+            "profiles": list(profiles.values()),
+        }
+
+
+def init_app(app):
+    app.config.setdefault('PROFILER', False)
+    app.config.setdefault('PROFILER_INTERVAL', 0.01)
+    app.config.setdefault('PROFILER_SAMPLING', False)
+    # User ids allowed to use /api/health/profile
+    app.config.setdefault('PROFILER_ADMINS', [])
+    if not app.config['PROFILER']:
+        return
+    profiler = app.extensions['profiler'] = SamplingProfiler(
+        app.config['PROFILER_INTERVAL'], app.config['PROFILER_SAMPLING'])
+    app.before_request(profiler.enter)
+    app.teardown_request(profiler.leave)
+
+
+def get_profiler():
+    return current_app.extensions.get('profiler')
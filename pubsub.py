@@ -0,0 +1,191 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+from flask import current_app, has_app_context
+from sqlalchemy import column, event, func, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from config import db
+from models import ChangeLog, UserChangeLog
+from sharding import shard_execution_options
+
+
+def topics_for(entity, entity_key, user_id):
+    key = entity_key.split(':')
+    if entity in ('recipe', 'recipe_ingredient'):
+        return [f"recipe:{key[0]}"]
+    if entity == 'user_recipe':
+        # Who collected what is private, as in /api/sync
+        return [f"user:{user_id}"]
+    return []
+
+
+def message_for(entity, entity_key, operation, token=None):
+    message = {"entity": entity,
+               "key": [int(part) for part in entity_key.split(':')],
+               "operation": operation}
+    if token is not None:
+        message['token'] = token
+    return message
+
+
+class Subscription:
+    def __init__(self, broker, topics, maxsize):
+        self.broker = broker
+        self.topics = set(topics)
+        self.queue = queue.Queue(maxsize)
+        self.dropped = False
+
+    def deliver(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            # A consumer that cannot keep up is cut off rather than
+            # allowed to hold memory; it resyncs through /api/sync
+            self.dropped = True
+            self.broker.unsubscribe(self)
+
+    def get(self, timeout):
+        return self.queue.get(timeout=timeout)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.subscribers = defaultdict(set)
+
+    def subscribe(self, topics):
+        subscription = Subscription(self, topics, self.maxsize)
+        with self.lock:
+            for topic in subscription.topics:
+                self.subscribers[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for topic in subscription.topics:
+                self.subscribers[topic].discard(subscription)
+                if not self.subscribers[topic]:
+                    del self.subscribers[topic]
+
+    def publish(self, topic, message):
+        with self.lock:
+            subscriptions = list(self.subscribers.get(topic, ()))
+        for subscription in subscriptions:
+            subscription.deliver(message)
+
+    def publish_change(self, message, topics):
+        for topic in topics:
+            self.publish(topic, message)
+
+
+USER_LOG = UserChangeLog.__table__
+USER_ROWID = column('rowid')
+
+
+class ChangeLogBroker(LocalBroker):
+    # Stand-in for an external broker when several worker processes share
+    # one database: every worker tails change_log and fans out locally, so
+    # a write in any worker reaches subscribers in all of them
+    def __init__(self, app, interval, maxsize=100):
+        super().__init__(maxsize)
+        self.app = app
+        self.interval = interval
+        self.last_id = None
+        self.last_user_rowids = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def subscribe(self, topics):
+        if self.interval and self.thread is None:
+            with self.start_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self.run, name='change-log-broker',
+                        daemon=True)
+                    self.thread.start()
+        return super().subscribe(topics)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    self.poll(db.session)
+                except SQLAlchemyError:
+                    # Most likely a busy database; pick up from last_id
+                    # next round
+                    current_app.logger.exception("Change log poll failed")
+                finally:
+                    db.session.remove()
+
+    def poll(self, session, limit=500):
+        if self.last_id is None:
+            self.last_id = session.execute(
+                select(func.coalesce(func.max(ChangeLog.id), 0))).scalar()
+            self.last_user_rowids = [
+                session.execute(
+                    select(func.coalesce(func.max(USER_ROWID), 0))
+                    .select_from(USER_LOG),
+                    execution_options=options).scalar()
+                for options in shard_execution_options()]
+            return
+        rows = session.execute(
+            select(ChangeLog).where(ChangeLog.id > self.last_id)
+            .order_by(ChangeLog.id).limit(limit)).scalars().all()
+        for row in rows:
+            self.publish_change(
+                message_for(row.entity, row.entity_key, row.operation,
+                            row.id),
+                topics_for(row.entity, row.entity_key, None))
+            self.last_id = row.id
+        # Per-user changes sit in each shard's own log
+        for shard, options in enumerate(shard_execution_options()):
+            rows = session.execute(
+                select(USER_ROWID, USER_LOG)
+                .where(USER_ROWID > self.last_user_rowids[shard])
+                .order_by(USER_ROWID).limit(limit),
+                execution_options=options).all()
+            for row in rows:
+                self.publish_change(
+                    message_for(row.entity, row.entity_key, row.operation),
+                    topics_for(row.entity, row.entity_key, row.user_id))
+                self.last_user_rowids[shard] = row.rowid
+
+
+def init_app(app):
+    app.config.setdefault('STREAM_BROKER', 'local')
+    app.config.setdefault('STREAM_QUEUE_SIZE', 100)
+    app.config.setdefault('STREAM_POLL_INTERVAL',
+                          0 if app.config.get('TESTING') else 0.5)
+    if app.config['STREAM_BROKER'] == 'changelog':
+        broker = ChangeLogBroker(app, app.config['STREAM_POLL_INTERVAL'],
+                                 app.config['STREAM_QUEUE_SIZE'])
+    else:
+        broker = LocalBroker(app.config['STREAM_QUEUE_SIZE'])
+    app.extensions['stream_broker'] = broker
+
+
+def get_broker():
+    return current_app.extensions['stream_broker']
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_committed_changes(session):
+    entries = session.info.pop('committed_changes', [])
+    if not entries or not has_app_context():
+        return
+    broker = current_app.extensions.get('stream_broker')
+    if type(broker) is not LocalBroker:
+        return
+    for entry in entries:
+        broker.publish_change(
+            message_for(entry['entity'], entry['entity_key'],
+                        entry['operation']),
+            topics_for(entry['entity'], entry['entity_key'],
+                       entry['user_id']))
@@ -0,0 +1,123 @@
+import threading
+from collections import Counter, defaultdict
+from flask import has_request_context, request
+from sqlalchemy import bindparam, event, exists, or_, select
+from sqlalchemy.orm import selectinload
+from config import db
+from models import Ingredient, Pantry, Recipe, RecipeIngredient, User
+from models import UserRecipe
+from softdelete import hide_deleted_rows
+
+
+# Statements shared by the blueprints, built once at import with bound
+# parameters. Reusing the same object keeps its cache key memoized, so a
+# request neither rebuilds the construct nor walks it for the compiled
+# cache lookup; handlers pass the parameters to session.execute().
+# Listed in id order; otherwise SQLite may walk the live-name index and
+# return them sorted by name
+ALL_RECIPES = hide_deleted_rows(select(Recipe).order_by(Recipe.id))
+
+RECIPE_WITH_CHILDREN = hide_deleted_rows(
+    select(Recipe).where(Recipe.id == bindparam('recipe_id'))
+    .options(selectinload(Recipe.recipe_ingredients)
+             .joinedload(RecipeIngredient.ingredient)))
+
+RECIPE_NAMES = hide_deleted_rows(
+    select(Recipe.id, Recipe.name)
+    .where(Recipe.id.in_(bindparam('recipe_ids', expanding=True))))
+
+RECIPE_INGREDIENT_EXISTS = hide_deleted_rows(select(exists().where(
+    RecipeIngredient.recipe_id == bindparam('recipe_id'),
+    RecipeIngredient.ingredient_id == bindparam('ingredient_id'))))
+
+ALL_INGREDIENTS = hide_deleted_rows(select(Ingredient).order_by(Ingredient.id))
+
+RECIPES_WITH_INGREDIENT = hide_deleted_rows(
+    select(Recipe).join(RecipeIngredient)
+    .where(RecipeIngredient.ingredient_id == bindparam('ingredient_id')))
+
+# Users are never soft deleted, but without the option the hook would
+# still add the criteria on every execution
+USER_BY_ID = hide_deleted_rows(
+    select(User).where(User.id == bindparam('user_id')))
+
+USER_BY_USERNAME = hide_deleted_rows(
+    select(User).where(User.username == bindparam('username')))
+
+USER_RECIPE_EXISTS = hide_deleted_rows(select(exists().where(
+    UserRecipe.user_id == bindparam('user_id'),
+    UserRecipe.recipe_id == bindparam('recipe_id'))))
+
+USER_COLLECTION_PAGE = hide_deleted_rows(
+    select(UserRecipe.recipe_id, UserRecipe.user_notes,
+           UserRecipe.collected_at, Recipe.name, Recipe.servings,
+           Recipe.ingredient_count, Recipe.total_time)
+    .join(Recipe)
+    .where(UserRecipe.user_id == bindparam('user_id'))
+    .order_by(UserRecipe.collected_at.desc(), UserRecipe.recipe_id.desc())
+    .limit(bindparam('limit')).offset(bindparam('offset')))
+
+
+def _cookable_recipes():
+    # Anti-join: a recipe is cookable when none of its ingredient lines
+    # lacks a pantry row covering it. A pantry row in a different unit
+    # counts as covering, since units are not converted.
+    covered = exists().where(
+        Pantry.user_id == bindparam('user_id'),
+        Pantry.ingredient_id == RecipeIngredient.ingredient_id,
+        or_(Pantry.unit != RecipeIngredient.unit,
+            Pantry.quantity >= RecipeIngredient.quantity))
+    missing = exists().where(RecipeIngredient.recipe_id == Recipe.id,
+                             ~covered)
+    has_ingredients = exists().where(RecipeIngredient.recipe_id == Recipe.id)
+    return hide_deleted_rows(select(Recipe).where(has_ingredients, ~missing))
+
+
+COOKABLE_RECIPES = _cookable_recipes()
+
+
+class CacheStats:
+    # Compiled cache outcome of every statement, per route; statements run
+    # outside a request, like the writer and purge threads, share one entry
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = defaultdict(Counter)
+
+    def record(self, route, outcome):
+        with self.lock:
+            self.routes[route][outcome] += 1
+
+    def report(self):
+        with self.lock:
+            routes = {route: dict(counts)
+                      for route, counts in self.routes.items()}
+        for counts in routes.values():
+            total = sum(counts.values())
+            counts['statements'] = total
+            counts['hit_rate'] = round(counts.get('hit', 0) / total, 4)
+        return routes
+
+
+def init_app(app):
+    app.config.setdefault('QUERY_CACHE_STATS', True)
+    if not app.config['QUERY_CACHE_STATS']:
+        return
+    stats = app.extensions['query_cache_stats'] = CacheStats()
+    with app.app_context():
+        engine = db.engine
+    dialect = engine.dialect
+    outcomes = {dialect.CACHE_HIT: 'hit', dialect.CACHE_MISS: 'miss',
+                dialect.CACHING_DISABLED: 'disabled',
+                dialect.NO_CACHE_KEY: 'uncacheable'}
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_cache_outcome(conn, cursor, statement, parameters, context,
+                            executemany):
+        # Plain driver SQL such as PRAGMAs has no compiled form
+        outcome = outcomes.get(getattr(context, 'cache_hit', None))
+        if outcome is None:
+            return
+        if has_request_context():
+            stats.record(request.endpoint or '(unmatched)', outcome)
+        else:
+            stats.record('(background)', outcome)
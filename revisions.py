@@ -0,0 +1,187 @@
+import json
+from datetime import datetime
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, insert, inspect, select
+from sqlalchemy.orm import Session
+from models import Ingredient, Recipe, RecipeIngredient, RecipeRevision
+
+
+REVISED_FIELDS = ('name', 'instructions', 'prep_time', 'cook_time',
+                  'servings')
+
+
+# States and deltas share one shape: "f" maps fields to values, "i" maps
+# ingredient ids to [quantity, unit, notes] lines and, in deltas only, "d"
+# lists removed ingredient ids. Empty parts are left out.
+def _encode(data):
+    return json.dumps({key: value for key, value in data.items() if value},
+                      separators=(',', ':'), sort_keys=True)
+
+
+def _line(recipe_ingredient):
+    return [recipe_ingredient.quantity, recipe_ingredient.unit,
+            recipe_ingredient.notes]
+
+
+def apply_delta(state, delta):
+    state['f'].update(delta.get('f', {}))
+    state['i'].update(delta.get('i', {}))
+    for ingredient_id in delta.get('d', []):
+        state['i'].pop(ingredient_id, None)
+    return state
+
+
+def _collect_deltas(session):
+    deltas = {}
+    removed = set()
+
+    def delta_for(recipe_id):
+        return deltas.setdefault(recipe_id, {'f': {}, 'i': {}, 'd': []})
+
+    for obj in session.deleted:
+        if isinstance(obj, Recipe):
+            removed.add(obj.id)
+        elif isinstance(obj, RecipeIngredient):
+            delta_for(obj.recipe_id)['d'].append(str(obj.ingredient_id))
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Recipe):
+            state = inspect(obj)
+            for field in REVISED_FIELDS:
+                if obj in session.new or \
+                        state.attrs[field].history.has_changes():
+                    delta_for(obj.id)['f'][field] = getattr(obj, field)
+        elif isinstance(obj, RecipeIngredient) and (
+                obj in session.new or session.is_modified(obj)):
+            delta_for(obj.recipe_id)['i'][str(obj.ingredient_id)] = \
+                _line(obj)
+    return {recipe_id: delta for recipe_id, delta in deltas.items()
+            if recipe_id not in removed and any(delta.values())}
+
+
+def _current_states(connection, recipe_ids):
+    states = {recipe_id: {'f': {}, 'i': {}} for recipe_id in recipe_ids}
+    for row in connection.execute(
+            select(Recipe.id, *[getattr(Recipe, field)
+                                for field in REVISED_FIELDS])
+            .where(Recipe.id.in_(recipe_ids))):
+        states[row.id]['f'] = {field: getattr(row, field)
+                               for field in REVISED_FIELDS}
+    for row in connection.execute(
+            select(RecipeIngredient)
+            .where(RecipeIngredient.recipe_id.in_(recipe_ids))):
+        states[row.recipe_id]['i'][str(row.ingredient_id)] = _line(row)
+    return states
+
+
+@event.listens_for(Session, 'after_flush')
+def record_revisions(session, flush_context):
+    if not has_app_context():
+        return
+    deltas = _collect_deltas(session)
+    if not deltas:
+        return
+    interval = current_app.config['REVISION_SNAPSHOT_INTERVAL']
+    connection = session.connection()
+    # Soft deleted recipes are left out; their lines go when they are purged
+    latest = {recipe_id: revision or 0 for recipe_id, revision in
+              connection.execute(
+                  select(Recipe.id, func.max(RecipeRevision.revision))
+                  .outerjoin(RecipeRevision,
+                             RecipeRevision.recipe_id == Recipe.id)
+                  .where(Recipe.id.in_(deltas), Recipe.deleted_at.is_(None))
+                  .group_by(Recipe.id))}
+    deltas = {recipe_id: delta for recipe_id, delta in deltas.items()
+              if recipe_id in latest}
+    if not deltas:
+        return
+    # A snapshot every `interval` revisions caps replay at that many deltas
+    snapshot_ids = [recipe_id for recipe_id in deltas
+                    if latest[recipe_id] % interval == 0]
+    states = _current_states(connection, snapshot_ids) if snapshot_ids \
+        else {}
+    now = datetime.now()
+    connection.execute(insert(RecipeRevision), [
+        {"recipe_id": recipe_id,
+         "revision": latest[recipe_id] + 1,
+         "changed_at": now,
+         "delta": _encode(delta),
+         "snapshot": _encode(states[recipe_id])
+         if recipe_id in states else None}
+        for recipe_id, delta in deltas.items()])
+
+
+def init_app(app):
+    app.config.setdefault('REVISION_SNAPSHOT_INTERVAL', 10)
+
+
+def revision_history(session, recipe_id):
+    history = []
+    for row in session.execute(
+            select(RecipeRevision.revision, RecipeRevision.changed_at,
+                   RecipeRevision.delta)
+            .where(RecipeRevision.recipe_id == recipe_id)
+            .order_by(RecipeRevision.revision)):
+        delta = json.loads(row.delta)
+        history.append({
+            "revision": row.revision,
+            "changed_at": row.changed_at.isoformat(),
+            "fields": delta.get('f', {}),
+            "ingredients": {ingredient_id: dict(zip(
+                ('quantity', 'unit', 'notes'), line))
+                for ingredient_id, line in delta.get('i', {}).items()},
+            "removed_ingredients": [int(ingredient_id) for ingredient_id
+                                    in delta.get('d', [])]})
+    return history
+
+
+def state_as_of(session, recipe_id, as_of):
+    # Nearest snapshot at or before as_of, then the deltas after it
+    base = session.execute(
+        select(RecipeRevision.revision, RecipeRevision.snapshot)
+        .where(RecipeRevision.recipe_id == recipe_id,
+               RecipeRevision.snapshot.is_not(None),
+               RecipeRevision.changed_at <= as_of)
+        .order_by(RecipeRevision.revision.desc()).limit(1)).first()
+    if base is None:
+        return None, None
+    state = json.loads(base.snapshot)
+    state.setdefault('f', {})
+    state.setdefault('i', {})
+    revision = base.revision
+    for revision, delta in session.execute(
+            select(RecipeRevision.revision, RecipeRevision.delta)
+            .where(RecipeRevision.recipe_id == recipe_id,
+                   RecipeRevision.revision > base.revision,
+                   RecipeRevision.changed_at <= as_of)
+            .order_by(RecipeRevision.revision)):
+        apply_delta(state, json.loads(delta))
+    return state, revision
+
+
+def recipe_as_of(session, recipe, as_of):
+    # Shaped like a RecipeSchema dump of the row; ingredient names and
+    # categories are the current ones since ingredients are not versioned
+    state, revision = state_as_of(session, recipe.id, as_of)
+    if state is None:
+        return None, None
+    ingredients = {}
+    if state['i']:
+        ingredients = {ingredient.id: ingredient for ingredient in
+                       session.execute(select(Ingredient).where(
+                           Ingredient.id.in_([int(ingredient_id) for
+                                              ingredient_id in state['i']])))
+                       .scalars()}
+    fields = state['f']
+    return {"id": recipe.id,
+            "created_at": recipe.created_at,
+            "ingredient_count": len(state['i']),
+            "total_time": (fields.get('prep_time') or 0) +
+            (fields.get('cook_time') or 0),
+            "recipe_ingredients": [
+                {"recipe_id": recipe.id,
+                 "ingredient_id": int(ingredient_id),
+                 "quantity": quantity, "unit": unit, "notes": notes,
+                 "ingredient": ingredients.get(int(ingredient_id))}
+                for ingredient_id, (quantity, unit, notes)
+                in sorted(state['i'].items(), key=lambda i: int(i[0]))],
+            **fields}, revision
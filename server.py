@@ -0,0 +1,116 @@
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+from werkzeug.serving import make_server
+from config import create_preloaded_app, db
+
+
+class Supervisor:
+    def __init__(self, app, host, port, workers):
+        self.app = app
+        self.workers = workers
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        # Workers share the socket and race for each connection; a loser
+        # must get EAGAIN instead of blocking in accept() where shutdown
+        # can no longer reach it
+        self.sock.setblocking(False)
+        self.sock.set_inheritable(True)
+        self.address = self.sock.getsockname()
+        self.pids = set()
+        self.retiring = set()
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.pids.add(pid)
+            return
+        # The worker must never return into the supervisor's loop, or a
+        # failed start would leave two supervisors forking workers
+        status = 1
+        try:
+            for sig in (signal.SIGHUP, signal.SIGINT, signal.SIGCHLD):
+                signal.signal(sig, signal.SIG_DFL)
+            # Connections inherited from the parent's pool must not be
+            # shared between processes, so each worker starts with an
+            # empty pool
+            with self.app.app_context():
+                db.engine.dispose(close=False)
+            server = make_server(*self.address, self.app, threaded=True,
+                                 fd=self.sock.fileno())
+            signal.signal(signal.SIGTERM, lambda *args: threading.Thread(
+                target=server.shutdown).start())
+            server.serve_forever()
+            server.server_close()
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def reload(self, *args):
+        # Zero downtime: the new generation shares the listening socket, so
+        # it accepts connections while the old one drains and exits
+        if self.stopping:
+            return
+        old = set(self.pids)
+        self.pids -= old
+        for _ in range(self.workers):
+            self.spawn()
+        for pid in old:
+            os.kill(pid, signal.SIGTERM)
+        self.retiring |= old
+
+    def stop(self, *args):
+        self.stopping = True
+        for pid in self.pids | self.retiring:
+            os.kill(pid, signal.SIGTERM)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        for _ in range(self.workers):
+            self.spawn()
+        print(f"Serving on http://{self.address[0]}:{self.address[1]} "
+              f"with {self.workers} workers", flush=True)
+        while self.pids or self.retiring:
+            try:
+                pid, _ = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            elif pid in self.pids:
+                # A worker died on its own; replace it
+                self.pids.discard(pid)
+                if not self.stopping:
+                    self.spawn()
+        self.sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prefork production server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--config-type', default='development')
+    parser.add_argument('--database-uri')
+    args = parser.parse_args(argv)
+
+    config = {}
+    if args.database_uri:
+        config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    app = create_preloaded_app(args.config_type, config)
+    Supervisor(app, args.host, args.port, args.workers).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+import os
+import zlib
+import click
+from flask import current_app, has_app_context
+from sqlalchemy import MetaData, delete, event, func, insert, select
+from sqlalchemy.orm import Session, scoped_session
+from config import db
+from models import USER_SHARD_SCHEMA, Pantry, UserChangeLog, UserRecipe
+from models import UserStats
+
+
+SHARDED_TABLES = [UserRecipe.__table__, Pantry.__table__,
+                  UserStats.__table__, UserChangeLog.__table__]
+SHARDED_TABLE_NAMES = {table.name for table in SHARDED_TABLES}
+# SQLite attaches at most 10 databases to a connection; one is kept free
+# for the resharding target
+MAX_SHARDS = 9
+
+
+def shard_for(user_id, count):
+    return zlib.crc32(str(user_id).encode()) % count
+
+
+def shard_schema(shard):
+    return None if shard is None else f'shard_{shard}'
+
+
+def translate_map(shard=None):
+    if shard is None and current_app.config['USER_SHARDS']:
+        shard = 0
+    return {USER_SHARD_SCHEMA: shard_schema(shard)}
+
+
+def shard_path(app, shard, count):
+    template = app.config['USER_SHARD_PATH']
+    if template is None:
+        with app.app_context():
+            database = db.engine.url.database
+        if not database or database == ':memory:':
+            return ':memory:'
+        root, ext = os.path.splitext(database)
+        template = root + '.shard-{shard}-of-{count}' + ext
+    return template.format(shard=shard, count=count)
+
+
+def init_app(app):
+    app.config.setdefault('USER_SHARDS', 0)
+    app.config.setdefault('USER_SHARD_PATH', None)
+    count = app.config['USER_SHARDS']
+    if not 0 <= count <= MAX_SHARDS:
+        raise ValueError(f"USER_SHARDS must be between 0 and {MAX_SHARDS}")
+    paths = [shard_path(app, shard, count) for shard in range(count)]
+
+    with app.app_context():
+        engine = db.engine
+        engine.update_execution_options(
+            schema_translate_map=translate_map())
+
+    @event.listens_for(engine, 'connect')
+    def attach_shards(dbapi_connection, connection_record):
+        dbapi_connection.create_function('user_shard', 2, shard_for,
+                                         deterministic=True)
+        for shard, path in enumerate(paths):
+            dbapi_connection.execute(
+                f"ATTACH DATABASE ? AS {shard_schema(shard)}", (path,))
+
+    @app.cli.command('reshard')
+    @click.argument('count', type=click.IntRange(0, MAX_SHARDS))
+    def reshard_command(count):
+        """Move per-user rows to a layout of COUNT shards."""
+        moved = reshard(count)
+        click.echo(f"Moved {moved} rows to {count} shards; "
+                   f"set USER_SHARDS={count} before restarting")
+
+
+class MigrationTarget:
+    # What Flask-Migrate compares with the main database. Without shards
+    # the per-user tables live there under their plain names, so
+    # autogenerate gets the metadata with the placeholder schema removed;
+    # otherwise every migration would drop them and create them again.
+    # Shard files are not migrated: create_all() and reshard create their
+    # tables.
+    def __init__(self, db):
+        self.db = db
+
+    @staticmethod
+    def include_object(obj, name, type_, reflected, compare_to):
+        # Per-user tables are created without foreign keys, which SQLite
+        # cannot enforce across database files
+        return not (type_ == 'foreign_key_constraint' and
+                    obj.table.name in SHARDED_TABLE_NAMES)
+
+    @property
+    def engine(self):
+        return self.db.engine
+
+    @property
+    def metadata(self):
+        metadata = MetaData(naming_convention=self.db.metadata
+                            .naming_convention)
+        for table in self.db.metadata.sorted_tables:
+            table.to_metadata(metadata, schema=(
+                None if table.schema == USER_SHARD_SCHEMA else table.schema))
+        return metadata
+
+
+def route(session, user_id):
+    # Called once the request's user is known; every statement in the
+    # session then reads and writes that user's shard
+    count = current_app.config['USER_SHARDS']
+    if count:
+        use_shard(session, shard_for(user_id, count))
+
+
+def use_shard(session, shard):
+    if isinstance(session, scoped_session):
+        session = session()
+    session.info['user_shard'] = shard
+    if session.get_transaction() is not None:
+        session.connection().execution_options(
+            schema_translate_map=translate_map(shard))
+
+
+@event.listens_for(Session, 'after_begin')
+def route_connection(session, transaction, connection):
+    shard = session.info.get('user_shard')
+    if shard is not None:
+        connection.execution_options(
+            schema_translate_map=translate_map(shard))
+
+
+def shard_execution_options():
+    count = current_app.config['USER_SHARDS']
+    if not count:
+        return [{}]
+    return [{'schema_translate_map': translate_map(shard)}
+            for shard in range(count)]
+
+
+def execute_all(session, statement):
+    # For the few readers that aggregate over every user
+    for options in shard_execution_options():
+        yield from session.execute(statement, execution_options=options)
+
+
+def _each_shard_table(connection):
+    count = current_app.config['USER_SHARDS'] if has_app_context() else 0
+    original = connection.get_execution_options().get('schema_translate_map')
+    try:
+        for shard in range(1, count):
+            connection.execution_options(
+                schema_translate_map=translate_map(shard))
+            yield from SHARDED_TABLES
+    finally:
+        connection.execution_options(schema_translate_map=original)
+
+
+# create_all() and drop_all() only see shard 0 through the engine's
+# translate map, so the other shards are handled alongside it
+@event.listens_for(db.metadata, 'after_create')
+def create_shard_tables(metadata, connection, **kw):
+    for table in _each_shard_table(connection):
+        table.create(connection, checkfirst=True)
+
+
+@event.listens_for(db.metadata, 'after_drop')
+def drop_shard_tables(metadata, connection, **kw):
+    for table in _each_shard_table(connection):
+        table.drop(connection, checkfirst=True)
+
+
+def _copies(schema):
+    metadata = MetaData()
+    return [table.to_metadata(metadata, schema=schema)
+            for table in SHARDED_TABLES]
+
+
+def reshard(count):
+    app = current_app._get_current_object()
+    current = app.config['USER_SHARDS']
+    if count == current:
+        return 0
+    sources = ([_copies(shard_schema(shard)) for shard in range(current)]
+               if current else [_copies('main')])
+    moved = 0
+    with db.engine.connect() as connection:
+        for shard in range(count or 1):
+            if count:
+                connection.exec_driver_sql(
+                    "ATTACH DATABASE ? AS reshard_target",
+                    (shard_path(app, shard, count),))
+            schema = 'reshard_target' if count else 'main'
+            connection.execution_options(
+                schema_translate_map={USER_SHARD_SCHEMA: schema})
+            targets = _copies(schema)
+            for table, target in zip(SHARDED_TABLES, targets):
+                table.create(connection, checkfirst=True)
+                connection.execute(delete(target))
+            for tables in sources:
+                for source, target in zip(tables, targets):
+                    query = select(source)
+                    if count:
+                        query = query.where(
+                            func.user_shard(source.c.user_id, count) == shard)
+                    moved += connection.execute(insert(target).from_select(
+                        list(source.c.keys()), query)).rowcount
+            connection.commit()
+            if count:
+                connection.exec_driver_sql("DETACH DATABASE reshard_target")
+        for tables in sources:
+            for source in tables:
+                connection.execute(delete(source))
+        connection.commit()
+    return moved
@@ -0,0 +1,153 @@
+import threading
+from collections import defaultdict
+from math import sqrt
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from changes import latest_change, latest_user_changes
+from config import db
+from models import RecipeIngredient, UserRecipe
+from sharding import execute_all
+
+
+def _pair_scores(groups, max_group):
+    # groups maps a key (user or ingredient) to the recipe ids sharing it;
+    # returns cosine similarity for every recipe pair that co-occurs.
+    # Groups larger than max_group, such as salt, are skipped like stop
+    # words: they say little about similarity and their pairs grow with
+    # the square of their size.
+    occurrences = defaultdict(int)
+    pairs = defaultdict(int)
+    for recipe_ids in groups.values():
+        recipe_ids = sorted(set(recipe_ids))
+        if len(recipe_ids) > max_group:
+            continue
+        for i, a in enumerate(recipe_ids):
+            occurrences[a] += 1
+            for b in recipe_ids[i + 1:]:
+                pairs[(a, b)] += 1
+    return {(a, b): count / sqrt(occurrences[a] * occurrences[b])
+            for (a, b), count in pairs.items()}
+
+
+def watermark(session):
+    # Collections are logged in the users' shards, the catalog in main
+    return latest_change(session), latest_user_changes(session)
+
+
+class SimilarityIndex:
+    # Requests only read self.neighbors. Rebuilds run on a background
+    # thread every interval seconds and replace the whole mapping at
+    # once, so a request sees either the old index or the new one. With
+    # no interval, as under tests, requests rebuild it themselves.
+    def __init__(self, app, interval, top_k=20, collection_weight=0.6,
+                 ingredient_weight=0.4, max_group=200):
+        self.app = app
+        self.interval = interval
+        self.top_k = top_k
+        self.collection_weight = collection_weight
+        self.ingredient_weight = ingredient_weight
+        self.max_group = max_group
+        self.neighbors = {}
+        self.built_at_change = None
+        self.build_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def build(self, session):
+        # Taken first, so writes made while building trigger another one
+        change = watermark(session)
+        collections = defaultdict(list)
+        for user_id, recipe_id in execute_all(
+                session, select(UserRecipe.user_id, UserRecipe.recipe_id)):
+            collections[user_id].append(recipe_id)
+        ingredients = defaultdict(list)
+        for ingredient_id, recipe_id in session.execute(
+                select(RecipeIngredient.ingredient_id,
+                       RecipeIngredient.recipe_id)):
+            ingredients[ingredient_id].append(recipe_id)
+
+        scores = defaultdict(float)
+        for pair, score in _pair_scores(collections,
+                                        self.max_group).items():
+            scores[pair] += self.collection_weight * score
+        for pair, score in _pair_scores(ingredients,
+                                        self.max_group).items():
+            scores[pair] += self.ingredient_weight * score
+
+        candidates = defaultdict(list)
+        for (a, b), score in scores.items():
+            candidates[a].append((score, b))
+            candidates[b].append((score, a))
+        self.neighbors = {
+            recipe_id: sorted(found, key=lambda s: (-s[0], s[1]))[:self.top_k]
+            for recipe_id, found in candidates.items()}
+        self.built_at_change = change
+
+    def refresh(self, session):
+        # Any worker's write moves the change log on
+        with self.build_lock:
+            if watermark(session) != self.built_at_change:
+                self.build(session)
+                return True
+        return False
+
+    def current(self, session):
+        if not self.interval:
+            self.refresh(session)
+        elif self.thread is None:
+            with self.start_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self.run, name='similarity-index',
+                        daemon=True)
+                    self.thread.start()
+        # Until the first build finishes there are no neighbours to offer
+        return self
+
+    def run(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    self.refresh(db.session)
+                except SQLAlchemyError:
+                    current_app.logger.exception(
+                        "Similarity index rebuild failed")
+                finally:
+                    db.session.remove()
+            if self.stopped.wait(self.interval):
+                return
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def similar(self, recipe_id, limit=10):
+        return [(other, score)
+                for score, other in self.neighbors.get(recipe_id, [])[:limit]]
+
+    def recommend(self, recipe_ids, limit=10):
+        owned = set(recipe_ids)
+        totals = defaultdict(float)
+        for recipe_id in owned:
+            for score, other in self.neighbors.get(recipe_id, []):
+                if other not in owned:
+                    totals[other] += score
+        ranked = sorted(totals.items(), key=lambda s: (-s[1], s[0]))
+        return ranked[:limit]
+
+
+def init_app(app):
+    app.config.setdefault('SIMILARITY_MAX_GROUP', 200)
+    app.config.setdefault('SIMILARITY_REBUILD_INTERVAL',
+                          0 if app.config.get('TESTING') else 30)
+    app.extensions['similarity_index'] = SimilarityIndex(
+        app, app.config['SIMILARITY_REBUILD_INTERVAL'],
+        top_k=app.config.get('SIMILARITY_TOP_K', 20),
+        max_group=app.config['SIMILARITY_MAX_GROUP'])
+
+
+def get_index(session):
+    return current_app.extensions['similarity_index'].current(session)
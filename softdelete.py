@@ -0,0 +1,177 @@
+import threading
+from datetime import datetime
+import click
+from flask import current_app
+from sqlalchemy import event, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session, with_loader_criteria
+from config import db
+from models import Ingredient, Pantry, Recipe, RecipeIngredient
+from models import RecipeRevision, RecipeStats, UserRecipe
+from sharding import SHARDED_TABLES, use_shard
+
+
+# Rows that refer to a soft deleted recipe or ingredient, in the order the
+# purge removes them; the recipe or ingredient itself goes last
+DEPENDENTS = [
+    (RecipeIngredient, RecipeIngredient.recipe_id, Recipe),
+    (RecipeIngredient, RecipeIngredient.ingredient_id, Ingredient),
+    (UserRecipe, UserRecipe.recipe_id, Recipe),
+    (Pantry, Pantry.ingredient_id, Ingredient),
+    (RecipeStats, RecipeStats.recipe_id, Recipe),
+    (RecipeRevision, RecipeRevision.recipe_id, Recipe),
+]
+
+
+def deleted_ids(model):
+    # Core columns, so the criteria below do not apply to the subquery;
+    # it reads the small partial index on deleted_at
+    table = model.__table__
+    return select(table.c.id).where(table.c.deleted_at.is_not(None))
+
+
+CRITERIA = [
+    with_loader_criteria(Recipe, lambda cls: cls.deleted_at.is_(None),
+                         include_aliases=True),
+    with_loader_criteria(Ingredient, lambda cls: cls.deleted_at.is_(None),
+                         include_aliases=True),
+    with_loader_criteria(
+        RecipeIngredient,
+        lambda cls: cls.recipe_id.not_in(deleted_ids(Recipe)) &
+        cls.ingredient_id.not_in(deleted_ids(Ingredient))),
+    with_loader_criteria(
+        UserRecipe, lambda cls: cls.recipe_id.not_in(deleted_ids(Recipe))),
+    with_loader_criteria(
+        Pantry, lambda cls: cls.ingredient_id.not_in(deleted_ids(Ingredient))),
+]
+
+
+# Relationship loads inherit the criteria from the query that loaded
+# their parent; include_deleted=True turns them off for a statement
+@event.listens_for(Session, 'do_orm_execute')
+def hide_deleted(execute_state):
+    options = execute_state.execution_options
+    if (execute_state.is_select and not execute_state.is_column_load and
+            not execute_state.is_relationship_load and
+            not options.get('include_deleted') and
+            not options.get('deleted_hidden')):
+        execute_state.statement = execute_state.statement.options(*CRITERIA)
+
+
+def hide_deleted_rows(statement):
+    # For statements built once and reused: with the criteria applied up
+    # front the hook leaves them alone, so they keep a memoized cache key
+    return statement.options(*CRITERIA).execution_options(deleted_hidden=True)
+
+
+def soft_delete(obj):
+    obj.deleted_at = datetime.now()
+
+
+def _shards(model):
+    count = current_app.config['USER_SHARDS']
+    if count and model.__table__ in SHARDED_TABLES:
+        return range(count)
+    return [None]
+
+
+def _delete_rows(session, query, limit):
+    rows = session.execute(query.limit(limit), execution_options={
+        'include_deleted': True}).scalars().all()
+    for row in rows:
+        session.delete(row)
+    session.flush()
+    return len(rows)
+
+
+def purge_batch(session, batch_size):
+    # Removes at most batch_size rows in one transaction through the ORM,
+    # so counters, indexes and the change log see every row go
+    removed = 0
+    try:
+        for model, column, parent in DEPENDENTS:
+            for shard in _shards(model):
+                if removed < batch_size:
+                    if shard is not None:
+                        use_shard(session, shard)
+                    removed += _delete_rows(
+                        session,
+                        select(model).where(column.in_(deleted_ids(parent))),
+                        batch_size - removed)
+        use_shard(session, None)
+        if removed < batch_size:
+            # Nothing refers to the deleted rows any more
+            for model in (Recipe, Ingredient):
+                removed += _delete_rows(
+                    session,
+                    select(model).where(model.deleted_at.is_not(None)),
+                    batch_size - removed)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return removed
+
+
+def purge_deleted(session, batch_size):
+    total = 0
+    while True:
+        removed = purge_batch(session, batch_size)
+        total += removed
+        if removed < batch_size:
+            return total
+
+
+class Purger:
+    def __init__(self, app, interval, batch_size):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def schedule(self):
+        if self.interval and self.thread is None:
+            with self.start_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self.run, name='purge-deleted', daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    purge_deleted(db.session, self.batch_size)
+                except SQLAlchemyError:
+                    # Most likely a busy database; try again next round
+                    current_app.logger.exception("Purge failed")
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def init_app(app):
+    app.config.setdefault('PURGE_INTERVAL',
+                          0 if app.config.get('TESTING') else 5)
+    app.config.setdefault('PURGE_BATCH_SIZE', 500)
+    purger = app.extensions['purger'] = Purger(
+        app, app.config['PURGE_INTERVAL'], app.config['PURGE_BATCH_SIZE'])
+    # Started by the first request, not here, so that each prefork worker
+    # runs its own thread; rows left by an earlier run get purged too
+    app.before_request(purger.schedule)
+
+    @app.cli.command('purge-deleted')
+    def purge_deleted_command():
+        """Remove soft deleted recipes and ingredients for good."""
+        removed = purge_deleted(db.session, app.config['PURGE_BATCH_SIZE'])
+        click.echo(f"Purged {removed} rows")
+
+
+def get_purger():
+    return current_app.extensions['purger']
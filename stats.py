@@ -0,0 +1,175 @@
+import re
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import SQLAlchemyError
+from config import db
+from models import Recipe, RecipeStats, UserRecipe
+from sharding import execute_all
+
+
+COLLECTION_WEIGHT = 10
+HOURLY_RETENTION = timedelta(days=2)
+WINDOW_PATTERN = re.compile(r'^(\d+)([hd])$')
+
+
+class ViewCounter:
+    # Views are counted in memory and written in batches. Threads pick a
+    # shard by thread id, so increments rarely wait on each other and a
+    # flush only holds each shard's lock long enough to swap its Counter.
+    def __init__(self, shards=16):
+        self.shards = [(threading.Lock(), Counter()) for _ in range(shards)]
+
+    def increment(self, recipe_id):
+        lock, counts = self.shards[threading.get_ident() % len(self.shards)]
+        with lock:
+            counts[recipe_id] += 1
+
+    def drain(self):
+        totals = Counter()
+        for index, (lock, _) in enumerate(self.shards):
+            with lock:
+                _, counts = self.shards[index]
+                self.shards[index] = (lock, Counter())
+            totals.update(counts)
+        return totals
+
+    def restore(self, counts):
+        # Puts back counts whose write failed, to go out with the next flush
+        lock, shard = self.shards[threading.get_ident() % len(self.shards)]
+        with lock:
+            shard.update(counts)
+
+
+class StatsRecorder:
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self.views = ViewCounter()
+        self.flush_lock = threading.Lock()
+        self.rolled_up_at = None
+        self.stopped = threading.Event()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def record_view(self, recipe_id):
+        self.views.increment(recipe_id)
+        if self.interval and self.thread is None:
+            with self.start_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self.run, name='recipe-stats', daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    self.flush(db.session)
+                except SQLAlchemyError:
+                    # Most likely a busy database; the views are kept for
+                    # the next round
+                    current_app.logger.exception("Stats flush failed")
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def flush(self, session, now=None):
+        now = now or datetime.now()
+        with self.flush_lock:
+            counts = self.views.drain()
+            hour = now.replace(minute=0, second=0, microsecond=0)
+            try:
+                if counts:
+                    statement = insert(RecipeStats).values(
+                        [{"recipe_id": recipe_id, "granularity": 'hour',
+                          "bucket": hour, "views": views}
+                         for recipe_id, views in counts.items()])
+                    session.execute(statement.on_conflict_do_update(
+                        index_elements=['recipe_id', 'granularity',
+                                        'bucket'],
+                        set_={"views": RecipeStats.views +
+                              statement.excluded.views}))
+                if self.rolled_up_at != hour:
+                    roll_up(session, now)
+                session.commit()
+            except SQLAlchemyError:
+                session.rollback()
+                self.views.restore(counts)
+                raise
+            self.rolled_up_at = hour
+
+
+def roll_up(session, now):
+    # Hourly buckets older than the retention period are folded into one
+    # row per recipe and day so the windowed ranking query stays small
+    cutoff = (now - HOURLY_RETENTION).replace(hour=0, minute=0, second=0,
+                                              microsecond=0)
+    day = func.datetime(func.date(RecipeStats.bucket))
+    daily = (select(RecipeStats.recipe_id, day.label('day'),
+                    func.sum(RecipeStats.views))
+             .where(RecipeStats.granularity == 'hour',
+                    RecipeStats.bucket < cutoff)
+             .group_by(RecipeStats.recipe_id, day))
+    rows = [{"recipe_id": recipe_id, "granularity": 'day',
+             "bucket": datetime.fromisoformat(bucket), "views": views}
+            for recipe_id, bucket, views in session.execute(daily)]
+    if not rows:
+        return
+    statement = insert(RecipeStats).values(rows)
+    session.execute(statement.on_conflict_do_update(
+        index_elements=['recipe_id', 'granularity', 'bucket'],
+        set_={"views": RecipeStats.views + statement.excluded.views}))
+    session.execute(delete(RecipeStats).where(
+        RecipeStats.granularity == 'hour', RecipeStats.bucket < cutoff))
+
+
+def parse_window(window):
+    match = WINDOW_PATTERN.match(window or '')
+    if not match:
+        return None
+    amount, unit = int(match.group(1)), match.group(2)
+    span = timedelta(hours=amount) if unit == 'h' else timedelta(days=amount)
+    if not timedelta(hours=1) <= span <= timedelta(days=90):
+        return None
+    return span
+
+
+def trending(session, window, limit=10, now=None):
+    since = (now or datetime.now()) - window
+    scores = Counter()
+    views = (select(RecipeStats.recipe_id, func.sum(RecipeStats.views))
+             .where(RecipeStats.bucket >= since)
+             .group_by(RecipeStats.recipe_id))
+    for recipe_id, count in session.execute(views):
+        scores[recipe_id] += count
+    collections = (select(UserRecipe.recipe_id, func.count())
+                   .where(UserRecipe.collected_at >= since)
+                   .group_by(UserRecipe.recipe_id))
+    for recipe_id, count in execute_all(session, collections):
+        scores[recipe_id] += COLLECTION_WEIGHT * count
+    ranked = sorted(scores.items(), key=lambda s: (-s[1], s[0]))[:limit]
+    if not ranked:
+        return []
+    names = dict(session.execute(select(Recipe.id, Recipe.name).where(
+        Recipe.id.in_([recipe_id for recipe_id, _ in ranked]))).all())
+    return [{"id": recipe_id, "name": names[recipe_id], "score": score}
+            for recipe_id, score in ranked if recipe_id in names]
+
+
+def init_app(app):
+    app.config.setdefault('STATS_FLUSH_INTERVAL',
+                          0 if app.config.get('TESTING') else 10)
+    app.extensions['recipe_stats'] = StatsRecorder(
+        app, app.config['STATS_FLUSH_INTERVAL'])
+
+
+def get_recorder():
+    return current_app.extensions['recipe_stats']
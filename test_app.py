@@ -1,22 +1,92 @@
 import pytest
 import json
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from sqlalchemy import event, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import Select, visitors
 from config import create_app, db
+import group_commit
 from datetime import datetime, timedelta
 # from models import recipe_schema, ingredient_schema, recipe_ingredient_schema
 
 
+STARTUP_BUDGET_MS = 2000
+
+
+def is_filtered(context, statement):
+    # Looks for criteria written into the statement itself. The soft
+    # delete criteria are loader options that only appear once the ORM
+    # compiles it, so a listing that just hides deleted rows still counts
+    # as unfiltered.
+    compiled = getattr(context, 'compiled', None)
+    if compiled is None or not isinstance(compiled.statement, Select):
+        return 'WHERE' in statement.upper()
+    return any(getattr(element, '_where_criteria', ())
+               for element in visitors.iterate(compiled.statement))
+
+
+class QueryPlanChecker:
+    # Runs EXPLAIN QUERY PLAN for every filtered SELECT the app issues and
+    # records full-table scans, i.e. a missing index. Unfiltered listings
+    # and covering-index scans are expected and ignored.
+    def __init__(self, engine):
+        self.engine = engine
+        self.full_scans = []
+        event.listen(engine, 'before_cursor_execute', self.explain)
+
+    def explain(self, conn, cursor, statement, parameters, context,
+                executemany):
+        if executemany or not statement.lstrip().upper().startswith('SELECT'):
+            return
+        if not is_filtered(context, statement):
+            return
+        plan = cursor.connection.execute('EXPLAIN QUERY PLAN ' + statement,
+                                         parameters).fetchall()
+        for row in plan:
+            detail = row[-1]
+            if (detail.startswith('SCAN ') and 'INDEX' not in detail
+                    and detail != 'SCAN CONSTANT ROW'):
+                self.full_scans.append((detail.split()[1], detail,
+                                        ' '.join(statement.split())))
+
+    def close(self):
+        event.remove(self.engine, 'before_cursor_execute', self.explain)
+
+    def unexpected_scans(self, allowed_tables):
+        return [scan for scan in self.full_scans
+                if scan[0] not in allowed_tables]
+
+
+@pytest.fixture
+def allowed_scans():
+    return set()
+
+
+@pytest.fixture
+def app_config():
+    return {}
+
+
 @pytest.fixture
-def client():
-    test_app = create_app(config_type='testing')
+def client(allowed_scans, app_config):
+    test_app = create_app(config_type='testing', config=app_config)
 
     with test_app.test_client() as client:
         with test_app.app_context():
             db.create_all()
+            plan_checker = QueryPlanChecker(db.engine)
 
             yield client
 
+            plan_checker.close()
+            group_commit.stop(test_app)
             db.session.remove()
             db.drop_all()
+            assert plan_checker.unexpected_scans(allowed_scans) == []
 
 
 def create_test_user(client, username="johndoe123", password="1234secret",
@@ -783,3 +853,1583 @@ def test_update_user_recipe_allowed_fields(client):
         data = response.get_json()
         assert data['recipe_id'] == 1
         assert data['user_id'] == 1
+
+
+def test_similar_recipes_share_ingredients(client):
+    first = create_test_recipe(client, name="First").get_json()['id']
+    second = create_test_recipe(client, name="Second").get_json()['id']
+    create_test_recipe(client, name="Unrelated")
+    ingredient_id = create_test_ingredient(client).get_json()['id']
+    create_test_recipe_ingredient(client, first, ingredient_id)
+    create_test_recipe_ingredient(client, second, ingredient_id)
+    response = client.get(f'/api/recipes/{first}/similar')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert [r['id'] for r in data] == [second]
+    assert data[0]['score'] > 0
+
+
+@pytest.mark.parametrize('app_config', [{'SIMILARITY_MAX_GROUP': 2}])
+def test_similar_recipes_skip_common_ingredients(client):
+    recipe_ids = [create_test_recipe(client, name=name).get_json()['id']
+                  for name in ("First", "Second", "Third")]
+    salt = create_test_ingredient(client, name="Salt").get_json()['id']
+    basil = create_test_ingredient(client, name="Basil").get_json()['id']
+    for recipe_id in recipe_ids:
+        create_test_recipe_ingredient(client, recipe_id, salt)
+    create_test_recipe_ingredient(client, recipe_ids[0], basil)
+    create_test_recipe_ingredient(client, recipe_ids[2], basil)
+    data = client.get(f'/api/recipes/{recipe_ids[0]}/similar').get_json()
+    assert [r['id'] for r in data] == [recipe_ids[2]]
+
+
+def shared_database_workers(tmp_path):
+    # Two apps over one database file, like two prefork workers
+    config = {'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path}/shared.db"}
+    first = create_app(config_type='testing', config=config)
+    second = create_app(config_type='testing', config=config)
+    with first.app_context():
+        db.create_all()
+    return first.test_client(), second.test_client()
+
+
+def test_similar_recipes_see_writes_from_other_workers(tmp_path):
+    client, other = shared_database_workers(tmp_path)
+    first = create_test_recipe(client, name="First").get_json()['id']
+    second = create_test_recipe(client, name="Second").get_json()['id']
+    assert other.get(f'/api/recipes/{first}/similar').get_json() == []
+    ingredient_id = create_test_ingredient(client).get_json()['id']
+    create_test_recipe_ingredient(client, first, ingredient_id)
+    create_test_recipe_ingredient(client, second, ingredient_id)
+    data = other.get(f'/api/recipes/{first}/similar').get_json()
+    assert [r['id'] for r in data] == [second]
+
+
+@pytest.mark.parametrize('app_config',
+                         [{'SIMILARITY_REBUILD_INTERVAL': 3600}])
+def test_similar_recipes_rebuilt_in_the_background(client):
+    first = create_test_recipe(client, name="First").get_json()['id']
+    second = create_test_recipe(client, name="Second").get_json()['id']
+    ingredient_id = create_test_ingredient(client).get_json()['id']
+    create_test_recipe_ingredient(client, first, ingredient_id)
+    create_test_recipe_ingredient(client, second, ingredient_id)
+    client.get(f'/api/recipes/{first}/similar')
+    index = client.application.extensions['similarity_index']
+    # The thread builds once on start, then waits out the interval
+    index.stop()
+    data = client.get(f'/api/recipes/{first}/similar').get_json()
+    assert [r['id'] for r in data] == [second]
+    third = create_test_recipe(client, name="Third").get_json()['id']
+    create_test_recipe_ingredient(client, third, ingredient_id)
+    data = client.get(f'/api/recipes/{first}/similar').get_json()
+    assert [r['id'] for r in data] == [second]
+
+
+def test_similar_recipes_non_existent_recipe(client):
+    response = client.get('/api/recipes/101/similar')
+    assert response.status_code == 404
+
+
+def test_user_recommendations_from_collections(client):
+    create_test_user(client)
+    create_test_user(client, username="janedoe", email="jane@example.com")
+    first = create_test_recipe(client, name="First").get_json()['id']
+    second = create_test_recipe(client, name="Second").get_json()['id']
+    other_headers = get_auth_headers(
+        client, lambda c: login_test_user(c, username="janedoe"))
+    create_test_user_recipe(client, first, other_headers)
+    create_test_user_recipe(client, second, other_headers)
+    headers = get_auth_headers(client)
+    response = client.get('/api/users/recommendations', headers=headers)
+    assert response.get_json() == []
+    create_test_user_recipe(client, first, headers)
+    response = client.get('/api/users/recommendations', headers=headers)
+    assert response.status_code == 200
+    assert [r['id'] for r in response.get_json()] == [second]
+
+
+def generate_test_mealplan(client, headers, **options):
+    plan_data = {"start_date": "2025-01-06", "end_date": "2025-01-07"}
+    plan_data.update(options)
+    return client.post('/api/users/mealplans/generate',
+                       data=json.dumps(plan_data),
+                       content_type='application/json', headers=headers)
+
+
+def test_generate_mealplan_prefers_shared_ingredients(client):
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    shared = create_test_ingredient(client, name="Shared").get_json()['id']
+    extra = create_test_ingredient(client, name="Extra").get_json()['id']
+    first = create_test_recipe(client, name="First").get_json()['id']
+    second = create_test_recipe(client, name="Second").get_json()['id']
+    third = create_test_recipe(client, name="Third").get_json()['id']
+    create_test_recipe_ingredient(client, first, shared)
+    create_test_recipe_ingredient(client, second, shared)
+    create_test_recipe_ingredient(client, third, extra)
+    create_test_recipe_ingredient(client, third, shared)
+    response = generate_test_mealplan(client, headers, collected_only=False)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert [day['date'] for day in data['days']] == ['2025-01-06',
+                                                     '2025-01-07']
+    chosen = {r['id'] for day in data['days'] for r in day['recipes']}
+    assert chosen == {first, second}
+    assert data['distinct_ingredients'] == 1
+
+
+def test_generate_mealplan_respects_exclusions_and_time(client):
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    excluded = create_test_ingredient(client).get_json()['id']
+    first = create_test_recipe(client, name="First").get_json()['id']
+    create_test_recipe(client, name="Second")
+    create_test_recipe(client, name="Slow", prep_time=60)
+    create_test_recipe_ingredient(client, first, excluded)
+    response = generate_test_mealplan(client, headers, collected_only=False,
+                                      exclude_ingredients=[excluded],
+                                      max_time_per_day=30)
+    assert response.status_code == 422
+
+
+def test_generate_mealplan_uses_collection(client):
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    recipe_id = create_test_recipe(client).get_json()['id']
+    create_test_recipe(client, name="Not collected")
+    create_test_user_recipe(client, recipe_id, headers)
+    response = generate_test_mealplan(client, headers,
+                                      end_date="2025-01-06")
+    assert response.status_code == 200
+    day = response.get_json()['days'][0]
+    assert [r['id'] for r in day['recipes']] == [recipe_id]
+
+
+def test_generate_mealplan_invalid_range(client):
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    response = generate_test_mealplan(client, headers, end_date="2025-01-01")
+    assert response.status_code == 400
+
+
+def create_test_pantry_item(client, ingredient_id, headers, quantity=2,
+                            unit="cups"):
+    pantry_data = {
+        "ingredient_id": ingredient_id,
+        "quantity": quantity,
+        "unit": unit
+    }
+    return client.post('/api/users/pantry', data=json.dumps(pantry_data),
+                       content_type='application/json', headers=headers)
+
+
+def test_add_pantry_item(client):
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    ingredient_id = create_test_ingredient(client).get_json()['id']
+    response = create_test_pantry_item(client, ingredient_id, headers)
+    assert response.status_code == 201
+    assert response.get_json()['ingredient']['name'] == "Test ingredient"
+    response = create_test_pantry_item(client, ingredient_id, headers)
+    assert response.status_code == 409
+    response = client.get('/api/users/pantry', headers=headers)
+    assert len(response.get_json()) == 1
+
+
+def test_add_non_existent_pantry_item(client):
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    response = create_test_pantry_item(client, 101, headers)
+    assert response.status_code == 404
+
+
+def test_update_and_delete_pantry_item(client):
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    ingredient_id = create_test_ingredient(client).get_json()['id']
+    create_test_pantry_item(client, ingredient_id, headers)
+    response = client.patch(f'/api/users/pantry/{ingredient_id}',
+                            data=json.dumps({"quantity": 5}),
+                            content_type='application/json',
+                            headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()['quantity'] == 5
+    response = client.delete(f'/api/users/pantry/{ingredient_id}',
+                             headers=headers)
+    assert response.status_code == 200
+    response = client.delete(f'/api/users/pantry/{ingredient_id}',
+                             headers=headers)
+    assert response.status_code == 404
+
+
+def test_cookable_recipes_from_pantry(client, allowed_scans):
+    # Every recipe is a candidate, so the anti-join drives from a scan
+    allowed_scans.add('recipe')
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    flour = create_test_ingredient(client, name="Flour").get_json()['id']
+    eggs = create_test_ingredient(client, name="Eggs").get_json()['id']
+    bread = create_test_recipe(client, name="Bread").get_json()['id']
+    cake = create_test_recipe(client, name="Cake").get_json()['id']
+    create_test_recipe(client, name="Empty")
+    create_test_recipe_ingredient(client, bread, flour, quantity=2)
+    create_test_recipe_ingredient(client, cake, flour, quantity=2)
+    create_test_recipe_ingredient(client, cake, eggs, quantity=3)
+    create_test_pantry_item(client, flour, headers, quantity=2)
+    create_test_pantry_item(client, eggs, headers, quantity=1)
+    response = client.get('/api/users/pantry/cookable', headers=headers)
+    assert response.status_code == 200
+    assert [r['name'] for r in response.get_json()] == ["Bread"]
+    client.patch(f'/api/users/pantry/{eggs}', data=json.dumps({"quantity": 3}),
+                 content_type='application/json', headers=headers)
+    response = client.get('/api/users/pantry/cookable', headers=headers)
+    assert [r['name'] for r in response.get_json()] == ["Bread", "Cake"]
+
+
+def test_get_recipes_by_ingredient(client):
+    ingredient_id = create_test_ingredient(client).get_json()['id']
+    other_id = create_test_ingredient(client, name="Other").get_json()['id']
+    first = create_test_recipe(client, name="First").get_json()['id']
+    second = create_test_recipe(client, name="Second").get_json()['id']
+    create_test_recipe_ingredient(client, first, ingredient_id)
+    create_test_recipe_ingredient(client, second, other_id)
+    response = client.get(f'/api/ingredients/{ingredient_id}/recipes')
+    assert response.status_code == 200
+    assert [r['id'] for r in response.get_json()] == [first]
+
+
+def test_get_recipes_by_non_existent_ingredient(client):
+    response = client.get('/api/ingredients/101/recipes')
+    assert response.status_code == 404
+
+
+def test_query_plan_checker_flags_unindexed_lookup(client, allowed_scans):
+    allowed_scans.add('recipe')
+    checker = QueryPlanChecker(db.engine)
+    db.session.execute(db.text("SELECT * FROM recipe "
+                               "WHERE instructions = 'x'"))
+    db.session.execute(db.text("SELECT * FROM recipe WHERE name = 'x'"))
+    checker.close()
+    assert [scan[0] for scan in checker.unexpected_scans(set())] == ['recipe']
+
+
+def test_suggest_ingredients_by_prefix(client):
+    create_test_ingredient(client, name="Tomato", category="Produce")
+    create_test_ingredient(client, name="Tomato paste", category="Pantry")
+    create_test_ingredient(client, name="Tofu", category="Protein")
+    response = client.get('/api/ingredients/suggest?prefix=tom')
+    assert response.status_code == 200
+    assert [i['name'] for i in response.get_json()] == ["Tomato",
+                                                        "Tomato paste"]
+    response = client.get('/api/ingredients/suggest?prefix=to&limit=1')
+    assert [i['name'] for i in response.get_json()] == ["Tofu"]
+    response = client.get('/api/ingredients/suggest?prefix=tom'
+                          '&category=Pantry')
+    assert [i['name'] for i in response.get_json()] == ["Tomato paste"]
+    # Limits below one are raised to one, with or without a match
+    response = client.get('/api/ingredients/suggest?prefix=to&limit=0')
+    assert [i['name'] for i in response.get_json()] == ["Tofu"]
+    response = client.get('/api/ingredients/suggest?prefix=zzz&limit=-1')
+    assert response.status_code == 200
+    assert response.get_json() == []
+
+
+def test_suggest_ingredients_typo_fallback(client):
+    create_test_ingredient(client, name="Tomato", category="Produce")
+    response = client.get('/api/ingredients/suggest?prefix=tomm')
+    assert [i['name'] for i in response.get_json()] == ["Tomato"]
+
+
+def test_suggest_ingredients_tracks_writes(client):
+    basil = create_test_ingredient(client, name="Basil")
+    ingredient_id = basil.get_json()['id']
+    client.get('/api/ingredients/suggest?prefix=b')
+    create_test_ingredient(client, name="Bay leaf")
+    client.patch(f'/api/ingredients/{ingredient_id}',
+                 data=json.dumps({"name": "Thai basil"}),
+                 content_type='application/json')
+    response = client.get('/api/ingredients/suggest?prefix=b')
+    assert [i['name'] for i in response.get_json()] == ["Bay leaf"]
+    response = client.get('/api/ingredients/suggest?prefix=thai')
+    assert [i['name'] for i in response.get_json()] == ["Thai basil"]
+    client.delete(f'/api/ingredients/{ingredient_id}')
+    response = client.get('/api/ingredients/suggest?prefix=thai')
+    assert response.get_json() == []
+
+
+def test_suggest_ingredients_sees_writes_from_other_workers(tmp_path):
+    client, other = shared_database_workers(tmp_path)
+    basil = create_test_ingredient(client, name="Basil")
+    ingredient_id = basil.get_json()['id']
+    response = other.get('/api/ingredients/suggest?prefix=b')
+    assert [i['name'] for i in response.get_json()] == ["Basil"]
+    create_test_ingredient(client, name="Bay leaf")
+    client.patch(f'/api/ingredients/{ingredient_id}',
+                 data=json.dumps({"name": "Thai basil"}),
+                 content_type='application/json')
+    response = other.get('/api/ingredients/suggest?prefix=b')
+    assert [i['name'] for i in response.get_json()] == ["Bay leaf"]
+    client.delete(f'/api/ingredients/{ingredient_id}')
+    response = other.get('/api/ingredients/suggest?prefix=thai')
+    assert response.get_json() == []
+
+
+def test_ingredient_index_concurrent_writes():
+    import threading
+    from autocomplete import IngredientIndex
+    # Switch threads often so unlocked updates would interleave
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    index = IngredientIndex()
+
+    def rename(thread):
+        for round in range(2000):
+            index.add(round % 10, f"Name {thread} {round}", None)
+    threads = [threading.Thread(target=rename, args=(thread,))
+               for thread in range(4)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert len(index.entries) == len(index.by_id) == 10
+    assert sorted(index.entries) == index.entries
+
+
+def test_patch_recipe_rejects_created_at(client):
+    create_test_recipe(client)
+    update = {"created_at": datetime.now().isoformat()}
+    response = client.patch('/api/recipes/1', data=json.dumps(update),
+                            content_type='application/json')
+    assert response.status_code == 400
+
+
+def test_pooled_schema_is_cached_per_thread(client):
+    import threading
+    from models import RecipeSchema, pooled_schema
+    schema = pooled_schema(RecipeSchema)
+    assert pooled_schema(RecipeSchema) is schema
+    assert pooled_schema(RecipeSchema, transient=True) is not schema
+    other = []
+    thread = threading.Thread(
+        target=lambda: other.append(pooled_schema(RecipeSchema)))
+    thread.start()
+    thread.join()
+    assert other[0] is not schema
+
+
+def test_transient_pooled_schema_skips_instance_lookup(client):
+    from models import RecipeIngredientSchema, pooled_schema
+    recipe_id = create_test_recipe(client).get_json()['id']
+    ingredient_id = create_test_ingredient(client).get_json()['id']
+    data = {"recipe_id": recipe_id, "ingredient_id": ingredient_id,
+            "quantity": 2}
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    pooled_schema(RecipeIngredientSchema).load(data)
+    assert len(statements) == 1
+    loaded = pooled_schema(RecipeIngredientSchema, transient=True).load(data)
+    event.remove(db.engine, 'before_cursor_execute', record)
+    assert len(statements) == 1
+    assert loaded.unit == 'each'
+
+
+@pytest.mark.parametrize('app_config', [{'GROUP_COMMIT': True}])
+def test_group_commit_round_trip(client):
+    response = create_test_recipe(client)
+    assert response.status_code == 201
+    recipe = response.get_json()
+    assert recipe['id'] == 1
+    assert recipe['created_at']
+    assert create_test_recipe(client).status_code == 409
+    response = client.patch('/api/recipes/1', data=json.dumps({"servings": 6}),
+                            content_type='application/json')
+    assert response.get_json()['servings'] == 6
+    ingredient_id = create_test_ingredient(client).get_json()['id']
+    response = create_test_recipe_ingredient(client, 1, ingredient_id)
+    assert response.get_json()['ingredient']['name'] == "Test ingredient"
+    assert client.delete('/api/recipes/1/ingredients/1').status_code == 200
+    assert client.get('/api/recipes/1/ingredients').get_json() == []
+
+
+@pytest.mark.parametrize('app_config', [{'GROUP_COMMIT': True}])
+def test_group_commit_isolates_failed_writes(client):
+    from models import Ingredient
+    committer = group_commit.get_committer(client.application)
+    jobs = [group_commit.WriteJob(new=[(None, Ingredient,
+                                        {"name": name, "category": "cat"})])
+            for name in ("Salt", "Salt", "Pepper")]
+    committer.write(jobs)
+    assert jobs[0].future.result() == [(1,)]
+    assert isinstance(jobs[1].future.exception(), IntegrityError)
+    assert jobs[2].future.result() == [(2,)]
+    names = [i['name'] for i in client.get('/api/ingredients/').get_json()]
+    assert names == ["Salt", "Pepper"]
+
+
+def test_startup_import_budget():
+    code = "from config import create_app; create_app('testing')"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and 'self [us]' not in line:
+            self_us, _, name = line[len('import time:'):].split('|')
+            modules[name.strip()] = int(self_us)
+    assert 'alembic' not in modules
+    assert sum(modules.values()) / 1000 < STARTUP_BUDGET_MS
+
+
+def test_create_app_with_selected_blueprints():
+    test_app = create_app(config_type='testing',
+                          config={'BLUEPRINTS': ['ingredients']})
+    assert list(test_app.blueprints) == ['ingredients']
+
+
+def test_health_check(client):
+    response = client.get('/api/health/')
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'ok'
+
+
+def test_prefork_server_reloads_workers(tmp_path):
+    def worker_pids(base_url, requests=10):
+        pids = set()
+        for _ in range(requests):
+            with urllib.request.urlopen(f"{base_url}/api/health/") as reply:
+                health = json.loads(reply.read())
+                pids.add(health['pid'])
+                uptimes.append(health['uptime'])
+        return pids
+
+    uptimes = []
+
+    server = subprocess.Popen(
+        [sys.executable, 'server.py', '--port', '0', '--workers', '2',
+         '--database-uri', f"sqlite:///{tmp_path}/server.db"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        base_url = server.stdout.readline().split()[2]
+        before = worker_pids(base_url)
+        time.sleep(1)
+        server.send_signal(signal.SIGHUP)
+        time.sleep(1)
+        del uptimes[:]
+        after = worker_pids(base_url)
+        assert before and after and not before & after
+        # Counted from each worker's fork, not from the supervisor's start
+        assert max(uptimes) < 1.9
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(timeout=10) == 0
+    finally:
+        server.kill()
+
+
+def test_prefork_worker_exits_when_its_server_fails(client, monkeypatch):
+    import os
+    import server
+
+    def broken_server(*args, **kwargs):
+        raise OSError("cannot serve")
+    monkeypatch.setattr(server, 'make_server', broken_server)
+    supervisor = server.Supervisor(client.application, '127.0.0.1', 0, 1)
+    parent = os.getpid()
+    try:
+        supervisor.spawn()
+        if os.getpid() != parent:
+            # A worker got back here as if it were the supervisor
+            os._exit(99)
+        pid, = supervisor.pids
+        _, status = os.waitpid(pid, 0)
+    finally:
+        supervisor.sock.close()
+    assert os.waitstatus_to_exitcode(status) == 1
+
+
+def test_recipe_counters_track_ingredients(client):
+    recipe_id = create_test_recipe(client, prep_time=5,
+                                   cook_time=20).get_json()['id']
+    first = create_test_ingredient(client, name="First").get_json()['id']
+    second = create_test_ingredient(client, name="Second").get_json()['id']
+    third = create_test_ingredient(client, name="Third").get_json()['id']
+    create_test_recipe_ingredient(client, recipe_id, first)
+    bulk = [{"ingredient_id": second, "quantity": 1},
+            {"ingredient_id": third, "quantity": 1}]
+    client.post(f'/api/recipes/{recipe_id}/ingredients/bulk',
+                data=json.dumps(bulk), content_type='application/json')
+    client.delete(f'/api/recipes/{recipe_id}/ingredients/{first}')
+    response = client.patch(f'/api/recipes/{recipe_id}',
+                            data=json.dumps({"cook_time": 30}),
+                            content_type='application/json')
+    data = response.get_json()
+    assert data['ingredient_count'] == 2
+    assert data['total_time'] == 35
+
+
+def test_recipe_counters_are_read_only(client):
+    recipe_id = create_test_recipe(client).get_json()['id']
+    response = client.patch(f'/api/recipes/{recipe_id}',
+                            data=json.dumps({"ingredient_count": 9}),
+                            content_type='application/json')
+    assert response.status_code == 400
+
+
+def test_user_recipes_summary(client):
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    ingredient_id = create_test_ingredient(client).get_json()['id']
+    for name in ("First", "Second", "Third"):
+        recipe_id = create_test_recipe(client, name=name).get_json()['id']
+        create_test_recipe_ingredient(client, recipe_id, ingredient_id)
+        create_test_user_recipe(client, recipe_id, headers)
+    client.delete('/api/users/recipes/2', headers=headers)
+    response = client.get('/api/users/recipes/summary?per_page=1',
+                          headers=headers)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['collection_count'] == 2
+    assert data['recipes'] == [{
+        "recipe_id": 3, "name": "Third", "servings": 3,
+        "ingredient_count": 1, "total_time": 20, "user_notes": "Test",
+        "collected_at": data['recipes'][0]['collected_at']}]
+    response = client.get('/api/users/recipes/summary?per_page=1&page=2',
+                          headers=headers)
+    assert [r['recipe_id'] for r in response.get_json()['recipes']] == [1]
+    etag = response.headers['ETag']
+    response = client.get('/api/users/recipes/summary?per_page=1&page=2',
+                          headers=dict(headers, **{"If-None-Match": etag}))
+    assert response.status_code == 304
+
+
+def test_trending_recipes_ranks_views_and_collections(client):
+    import stats
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    viewed = create_test_recipe(client, name="Viewed").get_json()['id']
+    collected = create_test_recipe(client, name="Collected").get_json()['id']
+    create_test_recipe(client, name="Ignored")
+    for _ in range(3):
+        client.get(f'/api/recipes/{viewed}')
+    create_test_user_recipe(client, collected, headers)
+    recorder = stats.get_recorder()
+    recorder.flush(db.session)
+    response = client.get('/api/recipes/trending?window=24h')
+    assert response.status_code == 200
+    assert response.get_json() == [
+        {"id": collected, "name": "Collected", "score": 10},
+        {"id": viewed, "name": "Viewed", "score": 3}]
+    client.get(f'/api/recipes/{viewed}')
+    response = client.get('/api/recipes/trending')
+    assert response.get_json()[1]['score'] == 3
+    recorder.flush(db.session)
+    response = client.get('/api/recipes/trending')
+    assert response.get_json()[1]['score'] == 4
+
+
+def test_recipe_stats_kept_when_a_flush_fails(client, monkeypatch):
+    import stats
+    from sqlalchemy.exc import OperationalError
+    recipe_id = create_test_recipe(client).get_json()['id']
+    client.get(f'/api/recipes/{recipe_id}')
+    recorder = stats.get_recorder()
+
+    def locked():
+        raise OperationalError("COMMIT", {}, Exception("database is locked"))
+    with monkeypatch.context() as patch:
+        patch.setattr(db.session, 'commit', locked)
+        with pytest.raises(OperationalError):
+            recorder.flush(db.session)
+    recorder.flush(db.session)
+    response = client.get('/api/recipes/trending')
+    assert response.get_json()[0]['score'] == 1
+
+
+def test_trending_recipes_invalid_window(client):
+    for window in ("week", "0d", "365d"):
+        response = client.get(f'/api/recipes/trending?window={window}')
+        assert response.status_code == 400
+
+
+def test_recipe_stats_roll_up_to_daily_buckets(client):
+    import stats
+    from models import RecipeStats
+    recipe_id = create_test_recipe(client).get_json()['id']
+    recorder = stats.get_recorder()
+    old = datetime(2025, 1, 1, 9, 30)
+    for hour in (9, 10):
+        recorder.views.increment(recipe_id)
+        recorder.flush(db.session, now=old.replace(hour=hour))
+    recorder.flush(db.session, now=old + timedelta(days=5))
+    rows = db.session.execute(db.select(RecipeStats)).scalars().all()
+    assert [(r.granularity, r.bucket, r.views) for r in rows] == [
+        ('day', datetime(2025, 1, 1), 2)]
+    assert stats.trending(db.session, timedelta(days=7),
+                          now=old + timedelta(days=5))[0]['score'] == 2
+
+
+def test_sync_returns_deltas_since_token(client):
+    recipe_id = create_test_recipe(client).get_json()['id']
+    ingredient_id = create_test_ingredient(client).get_json()['id']
+    unused_id = create_test_ingredient(client, name="Unused").get_json()['id']
+    response = client.get('/api/sync/')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert [(c['entity'], c['operation']) for c in data['changes']] == [
+        ('recipe', 'upsert'), ('ingredient', 'upsert'),
+        ('ingredient', 'upsert')]
+    assert data['changes'][0]['data']['name'] == "Test recipe"
+    assert 'recipe_ingredients' not in data['changes'][0]['data']
+    token = data['next']
+
+    create_test_recipe_ingredient(client, recipe_id, ingredient_id)
+    client.patch(f'/api/recipes/{recipe_id}', data=json.dumps({"servings": 8}),
+                 content_type='application/json')
+    client.patch(f'/api/recipes/{recipe_id}', data=json.dumps({"servings": 9}),
+                 content_type='application/json')
+    client.delete(f'/api/ingredients/{unused_id}')
+    data = client.get(f'/api/sync/?since={token}').get_json()
+    assert [(c['entity'], c['key'], c['operation'])
+            for c in data['changes']] == [
+        ('recipe_ingredient', [recipe_id, ingredient_id], 'upsert'),
+        ('recipe', [recipe_id], 'upsert'),
+        ('ingredient', [unused_id], 'delete')]
+    assert data['changes'][1]['data']['servings'] == 9
+    assert data['changes'][2]['data'] is None
+    assert client.get(f"/api/sync/?since={data['next']}").get_json() == {
+        "changes": [], "next": data['next'], "has_more": False}
+
+
+def test_sync_pages_and_scopes_user_changes(client):
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    for name in ("First", "Second", "Third"):
+        create_test_recipe(client, name=name)
+    create_test_user_recipe(client, 1, headers)
+    data = client.get('/api/sync/?limit=2').get_json()
+    assert len(data['changes']) == 2
+    assert data['has_more'] is True
+    data = client.get(f"/api/sync/?since={data['next']}").get_json()
+    assert [c['entity'] for c in data['changes']] == ['recipe']
+    assert data['next'] == "3:0"
+    # Tokens hold a position in the catalog log and in the user's own log
+    data = client.get('/api/sync/?since=2:0', headers=headers).get_json()
+    assert [c['entity'] for c in data['changes']] == ['recipe',
+                                                      'user_recipe']
+    assert [c['token'] for c in data['changes']] == ["3:0", "3:1"]
+    data = client.get(f"/api/sync/?since={data['next']}",
+                      headers=headers).get_json()
+    assert data['changes'] == []
+    assert client.get('/api/sync/?since=x').status_code == 400
+
+
+def read_stream_event(response):
+    chunk = next(response.response)
+    return chunk.decode() if isinstance(chunk, bytes) else chunk
+
+
+def test_stream_pushes_recipe_and_collection_changes(client):
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    recipe_id = create_test_recipe(client).get_json()['id']
+    response = client.get(f'/api/stream/?recipes={recipe_id}',
+                          headers=headers, buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    assert read_stream_event(response) == ": connected\n\n"
+    client.patch(f'/api/recipes/{recipe_id}', data=json.dumps({"servings": 5}),
+                 content_type='application/json')
+    create_test_user_recipe(client, recipe_id, headers)
+    event_text = read_stream_event(response)
+    assert event_text.startswith("event: change\n")
+    assert json.loads(event_text.split("data: ")[1]) == {
+        "entity": "recipe", "key": [recipe_id], "operation": "upsert"}
+    event_text = read_stream_event(response)
+    assert json.loads(event_text.split("data: ")[1])['entity'] == \
+        'user_recipe'
+    response.close()
+
+
+def test_stream_hides_collections_from_recipe_subscribers(client):
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    recipe_id = create_test_recipe(client).get_json()['id']
+    response = client.get(f'/api/stream/?recipes={recipe_id}',
+                          buffered=False)
+    assert read_stream_event(response) == ": connected\n\n"
+    create_test_user_recipe(client, recipe_id, headers)
+    client.patch(f'/api/recipes/{recipe_id}', data=json.dumps({"servings": 5}),
+                 content_type='application/json')
+    # The collection came first, so it would be the first event
+    event_text = read_stream_event(response)
+    assert json.loads(event_text.split("data: ")[1])['entity'] == 'recipe'
+    response.close()
+
+
+def test_stream_requires_subscription(client):
+    assert client.get('/api/stream/').status_code == 400
+    assert client.get('/api/stream/?recipes=a,b').status_code == 400
+
+
+def test_stream_drops_slow_consumers():
+    import pubsub
+    broker = pubsub.LocalBroker(maxsize=1)
+    subscription = broker.subscribe(['recipe:1'])
+    broker.publish('recipe:1', {"n": 1})
+    broker.publish('recipe:1', {"n": 2})
+    assert subscription.dropped
+    assert broker.subscribers == {}
+    assert subscription.get(timeout=0) == {"n": 1}
+
+
+@pytest.mark.parametrize('app_config', [{'STREAM_BROKER': 'changelog'}])
+def test_change_log_broker_relays_writes_from_any_worker(client):
+    import pubsub
+    broker = pubsub.get_broker()
+    broker.poll(db.session)
+    subscription = broker.subscribe(['recipe:1'])
+    create_test_recipe(client)
+    assert subscription.queue.empty()
+    broker.poll(db.session)
+    assert subscription.get(timeout=0) == {
+        "entity": "recipe", "key": [1], "operation": "upsert", "token": 1}
+
+
+def create_test_catalog(client, recipes=20):
+    ingredient_ids = [create_test_ingredient(client, name=f"Ingredient {i}")
+                      .get_json()['id'] for i in range(3)]
+    for i in range(recipes):
+        recipe_id = create_test_recipe(client, name=f"Recipe {i}",
+                                       instructions="Mix well " * 5
+                                       ).get_json()['id']
+        bulk = [{"ingredient_id": ingredient_id, "quantity": 1}
+                for ingredient_id in ingredient_ids]
+        client.post(f'/api/recipes/{recipe_id}/ingredients/bulk',
+                    data=json.dumps(bulk), content_type='application/json')
+
+
+def test_large_responses_are_gzipped(client):
+    import gzip
+    create_test_catalog(client)
+    plain = client.get('/api/recipes/')
+    assert 'Content-Encoding' not in plain.headers
+    response = client.get('/api/recipes/',
+                          headers={"Accept-Encoding": "gzip"})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert len(response.data) < len(plain.data) / 4
+    assert json.loads(gzip.decompress(response.data)) == plain.get_json()
+
+
+def test_small_responses_are_not_compressed(client):
+    create_test_recipe(client)
+    response = client.get('/api/recipes/1',
+                          headers={"Accept-Encoding": "gzip"})
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_streamed_responses_are_compressed_per_chunk(client):
+    import zlib
+    recipe_id = create_test_recipe(client).get_json()['id']
+    response = client.get(f'/api/stream/?recipes={recipe_id}',
+                          headers={"Accept-Encoding": "gzip"},
+                          buffered=False)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    decompressor = zlib.decompressobj(31)
+    assert decompressor.decompress(next(response.response)) == \
+        b": connected\n\n"
+    response.close()
+
+
+def test_columnar_recipe_list(client):
+    create_test_catalog(client, recipes=2)
+    rows = client.get('/api/recipes/').get_json()
+    data = client.get('/api/recipes/?format=columnar').get_json()
+    assert sorted(data['fields']) == sorted(rows[0])
+    assert len(data['rows']) == 2
+    assert data['lookups']['ingredient'] == {
+        "fields": ["name", "category"],
+        "rows": [[f"Ingredient {i}", "Test cat"] for i in range(3)]}
+    lines = data['rows'][1][data['fields'].index('recipe_ingredients')]
+    ingredient_column = lines['fields'].index('ingredient')
+    assert [row[ingredient_column] for row in lines['rows']] == [0, 1, 2]
+
+
+def test_msgpack_responses_match_json(client):
+    msgpack = pytest.importorskip('msgpack')
+    create_test_catalog(client, recipes=2)
+    plain = client.get('/api/recipes/')
+    assert plain.mimetype == 'application/json'
+    response = client.get('/api/recipes/',
+                          headers={"Accept": "application/msgpack"})
+    assert response.mimetype == 'application/msgpack'
+    assert 'Accept' in response.headers['Vary']
+    assert msgpack.unpackb(response.data) == plain.get_json()
+    missing = client.get('/api/recipes/999',
+                         headers={"Accept": "application/msgpack"})
+    assert missing.status_code == 404
+    assert msgpack.unpackb(missing.data)['status'] == 404
+
+
+def test_msgpack_request_bodies(client):
+    msgpack = pytest.importorskip('msgpack')
+    response = client.post('/api/recipes/', data=msgpack.packb({
+        "name": "Packed", "instructions": "Steps", "prep_time": 5,
+        "cook_time": 5, "servings": 2}), content_type='application/msgpack')
+    assert response.status_code == 201
+    assert response.get_json()['name'] == "Packed"
+    ingredient_id = create_test_ingredient(client).get_json()['id']
+    bulk = [{"ingredient_id": ingredient_id, "quantity": 1, "unit": "cup"}]
+    response = client.post(
+        f"/api/recipes/{response.get_json()['id']}/ingredients/bulk",
+        data=msgpack.packb(bulk), content_type='application/msgpack')
+    assert response.status_code == 201
+    response = client.post('/api/ingredients/', data=b'\xc1',
+                           content_type='application/msgpack')
+    assert response.status_code == 400
+
+
+def create_test_collectors(client, recipe_id, users=6):
+    headers = []
+    for n in range(users):
+        create_test_user(client, username=f"collector{n}",
+                         email=f"collector{n}@example.com")
+        headers.append(get_auth_headers(
+            client, lambda c: login_test_user(c, username=f"collector{n}")))
+        create_test_user_recipe(client, recipe_id, headers[-1])
+    return headers
+
+
+@pytest.mark.parametrize('app_config', [{'USER_SHARDS': 3}])
+def test_user_rows_are_routed_to_their_shard(client, allowed_scans):
+    from sqlalchemy import inspect, text
+    from sharding import shard_for
+    recipe_id = create_test_recipe(client).get_json()['id']
+    headers = create_test_collectors(client, recipe_id)
+    for shard in range(3):
+        rows = db.session.execute(text(
+            f"SELECT user_id FROM shard_{shard}.user_recipe")).scalars()
+        assert all(shard_for(user_id, 3) == shard for user_id in rows)
+    allowed_scans.add('sqlite_master')
+    assert 'user_recipe' not in inspect(db.engine).get_table_names()
+    for user_headers in headers:
+        response = client.get('/api/users/recipes', headers=user_headers)
+        assert [row['recipe_id'] for row in response.get_json()] == \
+            [recipe_id]
+    trending = client.get('/api/recipes/trending?window=1d').get_json()
+    assert trending[0]['score'] == 6 * 10
+
+
+@pytest.mark.parametrize('app_config', [{'USER_SHARDS': 3}])
+def test_collecting_writes_only_to_the_users_shard(client):
+    from sharding import shard_for
+    recipe_id = create_test_recipe(client).get_json()['id']
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    statements = []
+    event.listen(db.engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args:
+                 statements.append(statement))
+    create_test_user_recipe(client, recipe_id, headers)
+    writes = [statement for statement in statements
+              if not statement.lstrip().upper().startswith('SELECT')]
+    # The collected row, the user's counter and the user's change log
+    assert len(writes) == 3
+    assert all(f"shard_{shard_for(1, 3)}." in statement
+               for statement in writes)
+    summary = client.get('/api/users/recipes/summary',
+                         headers=headers).get_json()
+    assert summary['collection_count'] == 1
+
+
+def test_migrations_compare_per_user_tables_with_main(tmp_path):
+    pytest.importorskip('alembic')
+    from alembic.autogenerate import compare_metadata
+    from alembic.migration import MigrationContext
+    from sharding import MigrationTarget
+    app = create_app('testing', config={
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path}/recipes.db"})
+    with app.app_context():
+        db.create_all()
+        with db.engine.connect() as connection:
+            context = MigrationContext.configure(connection, opts={
+                'include_object': MigrationTarget.include_object})
+            # A later `flask db migrate` must not drop and re-create them
+            assert compare_metadata(context,
+                                    MigrationTarget(db).metadata) == []
+
+
+def test_reshard_moves_user_rows(tmp_path):
+    uri = f"sqlite:///{tmp_path}/recipes.db"
+    sharded = create_app('testing', config={
+        'SQLALCHEMY_DATABASE_URI': uri, 'USER_SHARDS': 2})
+    client = sharded.test_client()
+    with sharded.app_context():
+        db.create_all()
+    recipe_id = create_test_recipe(client).get_json()['id']
+    headers = create_test_collectors(client, recipe_id)
+    result = sharded.test_cli_runner().invoke(args=['reshard', '3'])
+    # Each user's collected recipe, counter and change log row
+    assert "Moved 18 rows to 3 shards" in result.output
+    with sharded.app_context():
+        db.engine.dispose()
+
+    for count in (3, 0):
+        resharded = create_app('testing', config={
+            'SQLALCHEMY_DATABASE_URI': uri, 'USER_SHARDS': count})
+        client = resharded.test_client()
+        for user_headers in headers:
+            response = client.get('/api/users/recipes',
+                                  headers=user_headers)
+            assert len(response.get_json()) == 1
+            response = client.get('/api/users/recipes/summary',
+                                  headers=user_headers)
+            assert response.get_json()['collection_count'] == 1
+            response = client.get('/api/sync/', headers=user_headers)
+            assert response.get_json()['next'] == "1:1"
+        resharded.test_cli_runner().invoke(args=['reshard', '0'])
+        with resharded.app_context():
+            db.engine.dispose()
+
+
+PANCAKE_STEPS = ("Whisk the flour, sugar and baking powder. Beat in the "
+                 "eggs and milk until smooth, rest the batter for ten "
+                 "minutes, then fry ladlefuls in a buttered pan until "
+                 "golden on both sides.")
+
+
+def test_near_duplicate_recipes(client):
+    original = create_test_recipe(client, name="Fluffy pancakes",
+                                  instructions=PANCAKE_STEPS).get_json()
+    copy = create_test_recipe(client, name="FLUFFY Pancakes!",
+                              instructions=PANCAKE_STEPS.replace(
+                                  "ten", "10")).get_json()
+    create_test_recipe(client, name="Tomato soup",
+                       instructions="Simmer tomatoes with stock and blend.")
+    ingredient_ids = [create_test_ingredient(client, name=name)
+                      .get_json()['id'] for name in ("Flour", "Eggs")]
+    for recipe in (original, copy):
+        client.post(f"/api/recipes/{recipe['id']}/ingredients/bulk",
+                    data=json.dumps([{"ingredient_id": i, "quantity": 1,
+                                      "unit": "cup"}
+                                     for i in ingredient_ids]),
+                    content_type='application/json')
+
+    response = client.get(f"/api/recipes/{original['id']}/duplicates")
+    assert response.status_code == 200
+    duplicates = response.get_json()
+    assert [d['id'] for d in duplicates] == [copy['id']]
+    assert duplicates[0]['score'] >= 0.8
+    assert client.get(f"/api/recipes/{original['id']}/duplicates"
+                      "?threshold=2").status_code == 400
+
+
+def test_near_duplicates_see_writes_from_other_workers(tmp_path):
+    client, other = shared_database_workers(tmp_path)
+    original = create_test_recipe(client, name="Fluffy pancakes",
+                                  instructions=PANCAKE_STEPS).get_json()
+    response = other.get(f"/api/recipes/{original['id']}/duplicates")
+    assert response.get_json() == []
+    copy = create_test_recipe(client, name="FLUFFY Pancakes!",
+                              instructions=PANCAKE_STEPS).get_json()
+    response = other.get(f"/api/recipes/{original['id']}/duplicates")
+    assert [d['id'] for d in response.get_json()] == [copy['id']]
+    client.delete(f"/api/recipes/{copy['id']}")
+    response = other.get(f"/api/recipes/{original['id']}/duplicates")
+    assert response.get_json() == []
+
+
+def test_import_time_dedup(client):
+    original = create_test_recipe(client, name="Fluffy pancakes",
+                                  instructions=PANCAKE_STEPS).get_json()
+    copy = {"name": "Fluffy Pancakes", "instructions": PANCAKE_STEPS,
+            "prep_time": 5, "cook_time": 5, "servings": 2}
+    response = client.post('/api/recipes/?dedup=true',
+                           data=json.dumps(copy),
+                           content_type='application/json')
+    assert response.status_code == 409
+    assert [d['id'] for d in response.get_json()['duplicates']] == \
+        [original['id']]
+    client.delete(f"/api/recipes/{original['id']}")
+    response = client.post('/api/recipes/?dedup=true',
+                           data=json.dumps(copy),
+                           content_type='application/json')
+    assert response.status_code == 201
+
+
+def test_import_time_dedup_of_recipes_with_ingredients(client):
+    original = create_test_recipe(client, name="Fluffy pancakes",
+                                  instructions=PANCAKE_STEPS).get_json()
+    ingredient_ids = [create_test_ingredient(client, name=name)
+                      .get_json()['id']
+                      for name in ("Flour", "Eggs", "Milk", "Sugar",
+                                   "Butter", "Salt", "Baking powder",
+                                   "Vanilla", "Lemon", "Maple syrup")]
+    client.post(f"/api/recipes/{original['id']}/ingredients/bulk",
+                data=json.dumps([{"ingredient_id": i, "quantity": 1,
+                                  "unit": "cup"} for i in ingredient_ids]),
+                content_type='application/json')
+    copy = {"name": "Fluffy Pancakes", "instructions": PANCAKE_STEPS,
+            "prep_time": 5, "cook_time": 5, "servings": 2}
+    response = client.post('/api/recipes/?dedup=true',
+                           data=json.dumps(copy),
+                           content_type='application/json')
+    assert response.status_code == 409
+    assert [d['id'] for d in response.get_json()['duplicates']] == \
+        [original['id']]
+
+
+def test_duplicate_index_concurrent_writes_and_lookups():
+    import random
+    import threading
+    from dedup import DuplicateIndex, NUM_PERM
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    index = DuplicateIndex()
+    errors = []
+
+    def write(seed):
+        rng = random.Random(seed)
+        for round in range(500):
+            values = [rng.randrange(4) for _ in range(NUM_PERM)]
+            index.add(round % 20, (values, values))
+            index.remove(rng.randrange(20))
+
+    def look_up():
+        try:
+            for round in range(2000):
+                index.duplicates(round % 20, 0.1)
+        except Exception as err:
+            errors.append(err)
+    threads = ([threading.Thread(target=write, args=(seed,))
+                for seed in range(3)] + [threading.Thread(target=look_up)])
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
+    assert all(recipe_id in index.recipes.signatures
+               for bucket in index.recipes.buckets.values()
+               for recipe_id in bucket)
+
+
+def test_idempotent_retries_replay_the_stored_response(client):
+    headers = {"Idempotency-Key": "retry-1"}
+    recipe = {"name": "Retried", "instructions": "Steps", "prep_time": 5,
+              "cook_time": 5, "servings": 2}
+    first = client.post('/api/recipes/', data=json.dumps(recipe),
+                        content_type='application/json', headers=headers)
+    assert first.status_code == 201
+
+    statements = []
+    event.listen(db.engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args:
+                 statements.append(statement))
+    retry = client.post('/api/recipes/', data=json.dumps(recipe),
+                        content_type='application/json', headers=headers)
+    assert retry.status_code == 201
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json() == first.get_json()
+    assert statements == []
+
+    client.application.extensions['idempotency'].cache.clear()
+    retry = client.post('/api/recipes/', data=json.dumps(recipe),
+                        content_type='application/json', headers=headers)
+    assert retry.get_json() == first.get_json()
+    assert all('idempotency_key' in statement for statement in statements)
+    assert len(client.get('/api/recipes/').get_json()) == 1
+
+    recipe['name'] = "Something else"
+    response = client.post('/api/recipes/', data=json.dumps(recipe),
+                           content_type='application/json', headers=headers)
+    assert response.status_code == 422
+
+
+def test_idempotent_retry_in_another_format_is_rejected(client):
+    pytest.importorskip('msgpack')
+    headers = {"Idempotency-Key": "retry-2"}
+    recipe = json.dumps({"name": "Retried", "instructions": "Steps",
+                         "prep_time": 5, "cook_time": 5, "servings": 2})
+    first = client.post('/api/recipes/', data=recipe,
+                        content_type='application/json', headers=headers)
+    assert first.status_code == 201
+    response = client.post('/api/recipes/', data=recipe,
+                           content_type='application/json',
+                           headers=dict(headers,
+                                        Accept="application/msgpack"))
+    assert response.status_code == 422
+    assert response.mimetype == 'application/msgpack'
+    response = client.post('/api/recipes/', data=recipe,
+                           content_type='application/json', headers=headers)
+    assert response.headers['Idempotent-Replayed'] == 'true'
+
+
+def test_idempotency_keys_are_scoped_per_user(client):
+    recipe_id = create_test_recipe(client).get_json()['id']
+    for n in range(2):
+        create_test_user(client, username=f"retrier{n}",
+                         email=f"retrier{n}@example.com")
+        headers = get_auth_headers(
+            client, lambda c: login_test_user(c, username=f"retrier{n}"))
+        headers["Idempotency-Key"] = "same-key"
+        for _ in range(2):
+            response = create_test_user_recipe(client, recipe_id, headers)
+            assert response.status_code == 201
+
+
+def test_in_flight_idempotency_keys(client):
+    import threading
+    from idempotency import IN_PROGRESS, IdempotencyStore
+    store = client.application.extensions['idempotency']
+    key = ('', 'in-flight')
+    assert store.begin(key, 'fingerprint', wait=5) is None
+
+    other_worker = IdempotencyStore(10, store.ttl, store.lock_timeout)
+    assert other_worker.begin(key, 'fingerprint', wait=5) is IN_PROGRESS
+
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(
+        store.begin(key, 'fingerprint', wait=5)))
+    waiter.start()
+    time.sleep(0.05)
+    assert results == []
+    with client.application.test_request_context():
+        store.finish(key, 'fingerprint',
+                     client.application.response_class(b'{}', status=201))
+    waiter.join()
+    assert results[0].status == 201
+    assert other_worker.begin(key, 'fingerprint', wait=5).status == 201
+
+
+@pytest.mark.parametrize('app_config', [{'REVISION_SNAPSHOT_INTERVAL': 2}])
+def test_recipe_revisions(client):
+    recipe_id = create_test_recipe(client, name="Soup").get_json()['id']
+    onion = create_test_ingredient(client, name="Onion").get_json()['id']
+    leek = create_test_ingredient(client, name="Leek").get_json()['id']
+    create_test_recipe_ingredient(client, recipe_id, onion, quantity=1)
+    client.patch(f'/api/recipes/{recipe_id}',
+                 data=json.dumps({"name": "Onion soup", "cook_time": 30}),
+                 content_type='application/json')
+    create_test_recipe_ingredient(client, recipe_id, leek, quantity=2)
+    client.patch(f'/api/recipes/{recipe_id}/ingredients/{onion}',
+                 data=json.dumps({"quantity": 3}),
+                 content_type='application/json')
+    client.delete(f'/api/recipes/{recipe_id}/ingredients/{leek}')
+
+    response = client.get(f'/api/recipes/{recipe_id}/revisions')
+    assert response.status_code == 200
+    history = response.get_json()
+    assert [revision['revision'] for revision in history] == list(range(1, 7))
+    assert history[0]['fields']['name'] == "Soup"
+    assert history[2]['fields'] == {"name": "Onion soup", "cook_time": 30}
+    assert history[4]['ingredients'] == {
+        str(onion): {"quantity": 3, "unit": "cups", "notes": "diced"}}
+    assert history[5]['removed_ingredients'] == [leek]
+
+    current = client.get(f'/api/recipes/{recipe_id}').get_json()
+    for revision in history:
+        response = client.get(f'/api/recipes/{recipe_id}',
+                              query_string={"as_of": revision['changed_at']})
+        assert response.status_code == 200
+        assert response.get_json()['revision'] == revision['revision']
+    past = client.get(f'/api/recipes/{recipe_id}', query_string={
+        "as_of": history[3]['changed_at']}).get_json()
+    assert past['name'] == "Onion soup"
+    assert past['total_time'] == 40
+    assert [(line['ingredient']['name'], line['quantity'])
+            for line in past['recipe_ingredients']] == [("Onion", 1),
+                                                        ("Leek", 2)]
+    latest = client.get(f'/api/recipes/{recipe_id}', query_string={
+        "as_of": history[5]['changed_at']}).get_json()
+    del latest['revision']
+    assert latest == current
+
+    response = client.get(f'/api/recipes/{recipe_id}',
+                          query_string={"as_of": "2000-01-01T00:00:00"})
+    assert response.status_code == 404
+    response = client.get(f'/api/recipes/{recipe_id}',
+                          query_string={"as_of": "yesterday"})
+    assert response.status_code == 400
+
+
+def test_recipe_revisions_store_deltas(client):
+    from models import RecipeRevision
+    recipe_id = create_test_recipe(client).get_json()['id']
+    for n in range(12):
+        client.patch(f'/api/recipes/{recipe_id}',
+                     data=json.dumps({"servings": n + 1}),
+                     content_type='application/json')
+    with client.application.app_context():
+        rows = db.session.execute(select(RecipeRevision)
+                                  .order_by(RecipeRevision.revision)
+                                  ).scalars().all()
+        assert [row.revision for row in rows if row.snapshot] == [1, 11]
+        assert rows[5].delta == '{"f":{"servings":5}}'
+
+
+def test_soft_deleted_recipe_is_purged_in_batches(client):
+    import softdelete
+    from models import Recipe, RecipeIngredient
+    recipe_id = create_test_recipe(client, name="Gone soon").get_json()['id']
+    for n in range(3):
+        ingredient_id = create_test_ingredient(
+            client, name=f"Part {n}").get_json()['id']
+        create_test_recipe_ingredient(client, recipe_id, ingredient_id)
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    create_test_user_recipe(client, recipe_id, headers)
+
+    statements = []
+    event.listen(db.engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args:
+                 statements.append(statement))
+    response = client.delete(f'/api/recipes/{recipe_id}')
+    assert response.status_code == 200
+    assert not any('recipe_ingredient' in statement or
+                   'user_recipe' in statement for statement in statements)
+
+    assert client.get(f'/api/recipes/{recipe_id}').status_code == 404
+    assert client.get('/api/recipes/').get_json() == []
+    assert client.get('/api/users/recipes', headers=headers).get_json() == []
+    assert client.get(f'/api/ingredients/{ingredient_id}/recipes'
+                      ).get_json() == []
+
+    # Three lines, one collection, four revisions and the recipe itself
+    assert softdelete.purge_batch(db.session, 2) == 2
+    assert softdelete.purge_deleted(db.session, 2) == 7
+    assert db.session.execute(
+        select(RecipeIngredient), execution_options={'include_deleted': True}
+    ).all() == []
+    assert db.session.execute(
+        select(Recipe), execution_options={'include_deleted': True}
+    ).all() == []
+    summary = client.get('/api/users/recipes/summary',
+                         headers=headers).get_json()
+    assert summary['collection_count'] == 0
+    assert create_test_recipe(client, name="Gone soon").status_code == 201
+
+
+def test_purger_starts_with_the_first_request(tmp_path):
+    from models import Recipe
+    app = create_app(config_type='testing', config={
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path}/purge.db",
+        'PURGE_INTERVAL': 0.05})
+    with app.app_context():
+        db.create_all()
+        # Left behind by a worker that stopped before purging it
+        db.session.add(Recipe(name="Gone", instructions="Steps",
+                              prep_time=1, cook_time=1, servings=1,
+                              deleted_at=datetime.now()))
+        db.session.commit()
+    purger = app.extensions['purger']
+    assert purger.thread is None
+    app.test_client().get('/api/recipes/')
+    try:
+        assert purger.thread is not None
+        deadline = time.monotonic() + 5
+        with app.app_context():
+            while db.session.execute(
+                    select(Recipe),
+                    execution_options={'include_deleted': True}).all():
+                assert time.monotonic() < deadline
+                db.session.remove()
+                time.sleep(0.05)
+    finally:
+        purger.stop()
+
+
+def test_deleted_names_can_be_used_again(client):
+    import softdelete
+    recipe_id = create_test_recipe(client, name="Reused").get_json()['id']
+    ingredient_id = create_test_ingredient(
+        client, name="Reused").get_json()['id']
+    assert client.delete(f'/api/recipes/{recipe_id}').status_code == 200
+    assert client.delete(
+        f'/api/ingredients/{ingredient_id}').status_code == 200
+    recipe = create_test_recipe(client, name="Reused")
+    assert recipe.status_code == 201
+    ingredient = create_test_ingredient(client, name="Reused")
+    assert ingredient.status_code == 201
+    # Live rows still have unique names
+    assert create_test_recipe(client, name="Reused").status_code == 409
+    assert create_test_ingredient(client, name="Reused").status_code != 201
+    # The recipe, its revision and the ingredient
+    assert softdelete.purge_deleted(db.session, 500) == 3
+    assert [r['id'] for r in client.get('/api/recipes/').get_json()] == \
+        [recipe.get_json()['id']]
+    assert [i['id'] for i in client.get('/api/ingredients/').get_json()] == \
+        [ingredient.get_json()['id']]
+
+
+def test_soft_deleted_ingredient_leaves_recipes(client):
+    import softdelete
+    recipe_id = create_test_recipe(client).get_json()['id']
+    kept = create_test_ingredient(client, name="Flour").get_json()['id']
+    dropped = create_test_ingredient(client, name="Raisins").get_json()['id']
+    create_test_recipe_ingredient(client, recipe_id, kept)
+    create_test_recipe_ingredient(client, recipe_id, dropped)
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    create_test_pantry_item(client, dropped, headers)
+
+    assert client.delete(f'/api/ingredients/{dropped}').status_code == 200
+    recipe = client.get(f'/api/recipes/{recipe_id}').get_json()
+    assert [line['ingredient_id'] for line in recipe['recipe_ingredients']
+            ] == [kept]
+    assert client.get('/api/users/pantry', headers=headers).get_json() == []
+    assert [i['name'] for i in client.get('/api/ingredients/').get_json()
+            ] == ["Flour"]
+
+    assert softdelete.purge_deleted(db.session, 500) == 3
+    recipe = client.get(f'/api/recipes/{recipe_id}').get_json()
+    assert recipe['ingredient_count'] == 1
+
+
+def test_query_cache_stats_per_route(client):
+    recipe_id = create_test_recipe(client).get_json()['id']
+    for _ in range(3):
+        assert client.get(f'/api/recipes/{recipe_id}').status_code == 200
+    stats = client.get('/api/health/queries').get_json()
+    route = stats['recipes.get_recipe_by_id']
+    # The recipe and its lines load with two statements per request;
+    # only the first request compiles them
+    assert route['statements'] == 6
+    assert route['hit'] == 4
+    assert route['hit_rate'] == round(4 / 6, 4)
+    assert 'recipes.add_recipe' in stats
+
+
+def test_registry_statements_are_not_rebuilt_per_execution():
+    import queries
+    from sqlalchemy.sql import Select
+    statements = {name: value for name, value in vars(queries).items()
+                  if isinstance(value, Select)}
+    assert 'USER_BY_ID' in statements
+    assert [name for name, statement in statements.items()
+            if not statement.get_execution_options().get('deleted_hidden')
+            ] == []
+
+
+@pytest.mark.parametrize('app_config', [{'QUERY_CACHE_STATS': False}])
+def test_query_cache_stats_can_be_disabled(client):
+    assert client.get('/api/health/queries').status_code == 404
+
+
+@pytest.mark.parametrize('app_config', [{'PROFILER': True,
+                                         'PROFILER_ADMINS': [1]}])
+def test_profiler_samples_per_route(client):
+    create_test_recipe(client)
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    response = client.post('/api/health/profile',
+                           data=json.dumps({"sampling": True,
+                                            "interval": 0.001}),
+                           content_type='application/json', headers=headers)
+    assert response.get_json()['sampling'] is True
+    assert str(response.get_json()['pid']) in response.get_json()['message']
+    try:
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            client.get('/api/recipes/')
+            summary = client.get('/api/health/profile',
+                                 headers=headers).get_json()
+            if summary['endpoints'].get('recipes.get_recipes', 0) >= 5:
+                break
+        assert summary['endpoints']['recipes.get_recipes'] >= 5
+    finally:
+        client.post('/api/health/profile', data=json.dumps({
+            "sampling": False}), content_type='application/json',
+            headers=headers)
+    collapsed = client.get('/api/health/profile/collapsed?'
+                           'endpoint=recipes.get_recipes', headers=headers)
+    assert collapsed.mimetype == 'text/plain'
+    lines = collapsed.get_data(as_text=True).splitlines()
+    assert lines and all(line.startswith('recipes.get_recipes;')
+                         for line in lines)
+    assert any('get_recipes (api/recipes.py:' in line for line in lines)
+    speedscope = client.get('/api/health/profile/speedscope',
+                            headers=headers).get_json()
+    frames = speedscope['shared']['frames']
+    profile = next(profile for profile in speedscope['profiles']
+                   if profile['name'] == 'recipes.get_recipes')
+    assert len(profile['samples']) == len(profile['weights'])
+    assert all(0 <= index < len(frames)
+               for sample in profile['samples'] for index in sample)
+    summary = client.post('/api/health/profile',
+                          data=json.dumps({"reset": True}),
+                          content_type='application/json',
+                          headers=headers).get_json()
+    assert summary['sampling'] is False
+    assert 'recipes.get_recipes' not in summary['endpoints']
+
+
+@pytest.mark.parametrize('app_config', [{'PROFILER': True}])
+def test_profiler_requires_login(client):
+    assert client.get('/api/health/profile').status_code == 401
+    response = client.post('/api/health/profile',
+                           data=json.dumps({"sampling": True}),
+                           content_type='application/json')
+    assert response.status_code == 401
+    assert client.get('/api/health/profile/collapsed').status_code == 401
+    assert client.get('/api/health/profile/speedscope').status_code == 401
+
+
+@pytest.mark.parametrize('app_config', [{'PROFILER': True,
+                                         'PROFILER_ADMINS': [1]}])
+def test_profiler_requires_an_admin(client):
+    create_test_user(client)
+    create_test_user(client, username="janedoe", email="jane@example.com")
+    other_headers = get_auth_headers(
+        client, lambda c: login_test_user(c, username="janedoe"))
+    for path in ('', '/collapsed', '/speedscope'):
+        response = client.get(f'/api/health/profile{path}',
+                              headers=other_headers)
+        assert response.status_code == 403
+    response = client.post('/api/health/profile',
+                           data=json.dumps({"sampling": True}),
+                           content_type='application/json',
+                           headers=other_headers)
+    assert response.status_code == 403
+    headers = get_auth_headers(client)
+    response = client.post('/api/health/profile',
+                           data=json.dumps({"interval": 0.0001}),
+                           content_type='application/json', headers=headers)
+    assert response.status_code == 400
+    assert client.get('/api/health/profile',
+                      headers=headers).get_json()['sampling'] is False
+
+
+@pytest.mark.parametrize('app_config', [{'PROFILER_ADMINS': [1]}])
+def test_profiler_is_opt_in(client):
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    assert client.get('/api/health/profile',
+                      headers=headers).status_code == 404
+    assert client.get('/api/health/profile/collapsed',
+                      headers=headers).status_code == 404
+
+
+def refresh_tokens(client, refresh_token):
+    return client.post('/api/auth/refresh', headers={
+        "Authorization": f"Bearer {refresh_token}"})
+
+
+def test_refresh_token_rotation(client):
+    from models import TokenFamily
+    create_test_user(client)
+    tokens = login_test_user(client).get_json()
+    rotated = refresh_tokens(client, tokens['refresh_token'])
+    assert rotated.status_code == 200
+    data = rotated.get_json()
+    assert data['user'] == "johndoe123"
+    assert data['refresh_token'] != tokens['refresh_token']
+    headers = {"Authorization": f"Bearer {data['access_token']}"}
+    assert client.get('/api/users/recipes', headers=headers).status_code == 200
+    newest = refresh_tokens(client, data['refresh_token']).get_json()
+    # One row per login, however often it rotates
+    assert db.session.execute(select(TokenFamily.generation)).all() == [(2,)]
+    data = newest
+    headers = {"Authorization": f"Bearer {data['access_token']}"}
+    # Replaying the spent refresh token ends every session of that login
+    assert refresh_tokens(client, tokens['refresh_token']).status_code == 401
+    assert refresh_tokens(client, data['refresh_token']).status_code == 401
+    assert client.get('/api/users/recipes', headers=headers).status_code == 401
+    # Other logins are unaffected
+    assert client.get('/api/users/recipes',
+                      headers=get_auth_headers(client)).status_code == 200
+
+
+def test_logout_revokes_tokens_of_the_login(client):
+    create_test_user(client)
+    tokens = login_test_user(client).get_json()
+    headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+    response = client.post('/api/auth/logout', headers=headers)
+    assert response.status_code == 200
+    assert client.get('/api/users/recipes', headers=headers).status_code == 401
+    assert refresh_tokens(client, tokens['refresh_token']).status_code == 401
+    assert client.post('/api/auth/refresh',
+                       headers=headers).status_code == 422
+
+
+def test_expired_token_families_are_purged(client):
+    create_test_user(client)
+    for _ in range(3):
+        tokens = login_test_user(client).get_json()
+        refresh_tokens(client, tokens['refresh_token'])
+    families = client.application.extensions['token_families']
+    later = datetime.now() + timedelta(days=31)
+    # The newest row stays behind to keep the sequence going
+    assert families.purge(later) == 2
+    families.sync(later)
+    assert families.families == {}
+
+
+def test_revocations_sync_between_workers(tmp_path):
+    config = {'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path}/tokens.db"}
+    first = create_app(config_type='testing', config=config)
+    second = create_app(config_type='testing', config=config)
+    with first.app_context():
+        db.create_all()
+    client = first.test_client()
+    create_test_user(client)
+    headers = get_auth_headers(client)
+    other = second.test_client()
+    assert other.get('/api/users/recipes', headers=headers).status_code == 200
+    client.post('/api/auth/logout', headers=headers)
+    # The second worker answers from its own set until the next sync
+    assert other.get('/api/users/recipes', headers=headers).status_code == 200
+    with second.app_context():
+        second.extensions['token_families'].sync()
+    assert other.get('/api/users/recipes', headers=headers).status_code == 401
+    with first.app_context():
+        db.drop_all()
+
+
+def test_catalog_snapshot_serves_without_queries(tmp_path):
+    app = create_app(config_type='testing', config={
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path}/catalog.db",
+        'CATALOG_SNAPSHOT': str(tmp_path / 'catalog.bin')})
+    with app.app_context():
+        db.create_all()
+    client = app.test_client()
+    recipe_id = create_test_recipe(client).get_json()['id']
+    salt = create_test_ingredient(client, name="Salt").get_json()['id']
+    pepper = create_test_ingredient(client, name="Pepper").get_json()['id']
+    create_test_recipe_ingredient(client, recipe_id, pepper)
+    create_test_recipe_ingredient(client, recipe_id, salt, notes=None)
+    paths = ['/api/recipes/', f'/api/recipes/{recipe_id}',
+             '/api/ingredients/', '/api/ingredients/?format=columnar']
+    expected = {path: client.get(path).get_json() for path in paths}
+
+    statements = []
+    with app.app_context():
+        catalog = app.extensions['catalog']
+        assert catalog.refresh(db.session)
+        assert not catalog.refresh(db.session)
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda *args: statements.append(args[2]))
+    first = catalog.snapshot
+    for path in paths:
+        assert client.get(path).get_json() == expected[path]
+    assert statements == []
+
+    # Stale until rebuilt; misses still reach the database
+    created = create_test_recipe(client, name="Later").get_json()['id']
+    assert len(client.get('/api/recipes/').get_json()) == 1
+    assert client.get(f'/api/recipes/{created}').status_code == 200
+    assert client.get('/api/recipes/999').status_code == 404
+    with app.app_context():
+        assert catalog.refresh(db.session)
+    assert catalog.snapshot is not first
+    assert len(client.get('/api/recipes/').get_json()) == 2
+    # A request still holding the old mapping reads it unharmed
+    assert first.recipe_by_id(recipe_id) == expected[paths[1]]
+    with app.app_context():
+        db.drop_all()
@@ -0,0 +1,198 @@
+import threading
+import time
+import uuid
+from datetime import datetime
+from flask import current_app
+from flask_jwt_extended import create_access_token, create_refresh_token
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from config import db, jwt
+from models import TokenFamily
+
+
+def family_of(payload):
+    # Tokens issued before families existed stand for themselves
+    return payload.get('fam') or payload['jti']
+
+
+def _next_seq(table):
+    # Writers are serialized by SQLite, so this cannot hand out a number
+    # twice
+    return (select(func.coalesce(func.max(table.c.seq), 0) + 1)
+            .scalar_subquery())
+
+
+class TokenFamilies:
+    # Every token from one login belongs to a family. The token_family
+    # table holds one row per family that has rotated or been revoked:
+    # the generation of its current refresh token and whether it is
+    # revoked. Each worker keeps the rows in a dict, so the blocklist
+    # check on a request is a lookup with no query; a write made by
+    # another worker shows up here within one sync interval, and the
+    # conditional update in rotate() catches replays in between.
+    def __init__(self, app, interval, purge_interval):
+        self.app = app
+        self.interval = interval
+        self.purge_interval = purge_interval
+        self.families = {}
+        self.last_seq = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def lookup(self, payload):
+        if self.last_seq is None:
+            # Families written before this worker started
+            self.sync()
+        if self.interval and self.thread is None:
+            with self.start_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self.run, name='token-families', daemon=True)
+                    self.thread.start()
+        return self.families.get(family_of(payload))
+
+    def _remember(self, family, generation, revoked, expires_at):
+        with self.lock:
+            self.families[family] = (generation, revoked, expires_at)
+
+    def rotate(self, payload):
+        # Moves the family to the next generation, only if the presented
+        # refresh token is the current one; False means it was spent or
+        # the family is revoked
+        table = TokenFamily.__table__
+        family = family_of(payload)
+        generation = payload.get('gen', 0)
+        expires_at = family_expiry()
+        try:
+            with db.engine.begin() as connection:
+                if generation == 0:
+                    connection.execute(insert(table).values(
+                        family=family, generation=1, revoked=False,
+                        expires_at=expires_at, seq=_next_seq(table)))
+                else:
+                    rotated = connection.execute(
+                        update(table)
+                        .where(table.c.family == family,
+                               table.c.generation == generation,
+                               table.c.revoked.is_(False))
+                        .values(generation=generation + 1,
+                                expires_at=expires_at,
+                                seq=_next_seq(table))).rowcount
+                    if not rotated:
+                        return False
+        except IntegrityError:
+            return False
+        self._remember(family, generation + 1, False, expires_at)
+        return True
+
+    def revoke(self, payload):
+        table = TokenFamily.__table__
+        family = family_of(payload)
+        expires_at = family_expiry()
+        statement = insert(table).values(
+            family=family, generation=payload.get('gen', 0), revoked=True,
+            expires_at=expires_at, seq=_next_seq(table))
+        with db.engine.begin() as connection:
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=[table.c.family],
+                set_={"revoked": True, "expires_at": expires_at,
+                      "seq": statement.excluded.seq}))
+        self._remember(family, payload.get('gen', 0), True, expires_at)
+
+    def sync(self, now=None):
+        now = now or datetime.now()
+        table = TokenFamily.__table__
+        with self.lock:
+            with db.engine.connect() as connection:
+                rows = connection.execute(
+                    select(table.c.seq, table.c.family, table.c.generation,
+                           table.c.revoked, table.c.expires_at)
+                    .where(table.c.seq > (self.last_seq or 0))
+                    .order_by(table.c.seq)).all()
+            for _, family, generation, revoked, expires_at in rows:
+                self.families[family] = (generation, revoked, expires_at)
+            self.last_seq = rows[-1].seq if rows else self.last_seq or 0
+            # A family past its expiry has no valid token left
+            for family, (_, _, expires_at) in list(self.families.items()):
+                if expires_at is not None and expires_at < now:
+                    del self.families[family]
+
+    def purge(self, now=None):
+        # The newest row stays, so sequence numbers never go back
+        table = TokenFamily.__table__
+        with db.engine.begin() as connection:
+            return connection.execute(delete(table).where(
+                table.c.expires_at < (now or datetime.now()),
+                table.c.seq < select(func.max(table.c.seq))
+                .scalar_subquery())).rowcount
+
+    def run(self):
+        purged_at = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    self.sync()
+                    if time.monotonic() - purged_at >= self.purge_interval:
+                        purged_at = time.monotonic()
+                        self.purge()
+                except SQLAlchemyError:
+                    current_app.logger.exception("Token family sync failed")
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def get_token_families():
+    return current_app.extensions['token_families']
+
+
+def family_expiry():
+    # Outlives every token the family can still issue
+    lifetime = current_app.config['JWT_REFRESH_TOKEN_EXPIRES']
+    return datetime.now() + lifetime if lifetime else None
+
+
+def issue_tokens(user, family=None, generation=0):
+    # Every token from one login carries the same family claim, so a
+    # logout or a replayed refresh token revokes all of them at once
+    family = family or uuid.uuid4().hex
+    return {"access_token": create_access_token(
+                identity=user, additional_claims={"fam": family}),
+            "refresh_token": create_refresh_token(
+                identity=user,
+                additional_claims={"fam": family, "gen": generation})}
+
+
+def revoke_family(payload):
+    get_token_families().revoke(payload)
+
+
+@jwt.token_in_blocklist_loader
+def token_in_blocklist(_jwt_header, payload):
+    families = get_token_families()
+    entry = families.lookup(payload)
+    if entry is None:
+        return False
+    generation, revoked, _ = entry
+    if revoked:
+        return True
+    if payload['type'] == 'refresh' and payload.get('gen', 0) < generation:
+        # A rotated refresh token came back: either the client or someone
+        # who stole it still holds it, so end the whole session
+        families.revoke(payload)
+        return True
+    return False
+
+
+def init_app(app):
+    app.config.setdefault('TOKEN_REVOCATION_SYNC_INTERVAL',
+                          0 if app.config.get('TESTING') else 1)
+    app.config.setdefault('TOKEN_FAMILY_PURGE_INTERVAL', 3600)
+    app.extensions['token_families'] = TokenFamilies(
+        app, app.config['TOKEN_REVOCATION_SYNC_INTERVAL'],
+        app.config['TOKEN_FAMILY_PURGE_INTERVAL'])